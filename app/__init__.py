@@ -1,7 +1,16 @@
 from flask import Flask
 from flask_cors import CORS
-from .routes import main_bp, mobile_bp, embedded_bp
+from .routes import main_bp, mobile_bp, embedded_bp, cluster_bp
 from .models import db
+from .audio_jobs import audio_jobs
+from .audio_handles import audio_handles
+from .api_clients import api_clients
+from .sample_writer import sample_writer
+from .device_snapshots import device_snapshots
+from .storage_backends import storage_backends
+from .redis_store import redis_store
+from .shard_map import shard_router
+from .sound_gen import audio_store, scenario_cache, sound_settings
 from .config import Config
 
 def create_app():
@@ -13,8 +22,21 @@ def create_app():
     app.config.from_object(Config)  # Załadowanie konfiguracji z klasy Config
 
     db.init_app(app)  # Inicjalizacja bazy danych
+    storage_backends.init_app(app)  # Backend buforów sensorów (pamięć procesu lub współdzielona)
+    redis_store.init_app(app)  # Stan współdzielony przez węzły i workery (STORAGE_BACKEND=redis/shared_memory)
+    shard_router.init_app(app)  # Mapa shardów urządzeń między węzłami (CLUSTER_NODES)
+    sample_writer.init_app(app)  # Zapis próbek sensorów do bazy w tle (write-behind)
+    device_snapshots.init_app(app)  # Snapshoty okien sensorów do odtworzenia po restarcie
+    api_clients.init_app(app)  # Współdzieleni klienci DeepSeek/ElevenLabs (pula połączeń, timeouty)
+    audio_jobs.init_app(app)  # Kolejka zadań generowania audio w tle
+    audio_handles.init_app(app)  # Rejestr plików audio do pobrania (handle zamiast ścieżek w sesji)
+    audio_store.init_app(app)  # Magazyn plików audio z manifestem i sprzątaniem w tle
+    scenario_cache.init_app(app)  # Cache rozwinięć scenariuszy DeepSeek (pamięć + dysk)
+    sound_settings.init_app(app)  # Pula wątków ElevenLabs, formaty i renderowanie audio
     app.register_blueprint(main_bp)
     app.register_blueprint(embedded_bp)
     app.register_blueprint(mobile_bp)
+    if app.config.get('CLUSTER_NODES'):
+        app.register_blueprint(cluster_bp)  # Endpointy klastra tylko przy włączonym shardingu
 
     return app
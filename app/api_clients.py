@@ -0,0 +1,191 @@
+import threading
+import time
+
+import httpx
+from openai import OpenAI
+from elevenlabs.client import ElevenLabs
+
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+
+# Połączenie nawiązywane jest szybko albo wcale - limit connect niezależny od limitu etapu
+CONNECT_TIMEOUT_SECONDS = 5.0
+
+
+class CircuitOpenError(Exception):
+    """Obwód dostawcy jest otwarty - wywołanie pominięte, należy użyć fallbacku"""
+
+
+class CircuitBreaker:
+    """
+    Prosty circuit breaker: po failure_threshold kolejnych błędach (w tym timeoutach) obwód
+    otwiera się na reset_seconds i wywołania kończą się od razu CircuitOpenError. Po tym czasie
+    przepuszczane jest jedno wywołanie próbne - sukces zamyka obwód, błąd otwiera go ponownie.
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_seconds=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is not None:
+                if self._trial_running or time.monotonic() - self._opened_at < self.reset_seconds:
+                    self._counters['rejected'] += 1
+                    return False
+                self._trial_running = True
+            self._counters['calls'] += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._counters['failures'] += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_running:
+                    self._counters['opened'] += 1
+                self._opened_at = time.monotonic()
+                self._trial_running = False
+
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return 'half_open'
+            return 'open'
+
+    def stats(self):
+        state = self.state()
+        with self._lock:
+            return {'state': state, 'consecutive_failures': self._failures, **self._counters}
+
+
+class ApiClients:
+    """
+    Długo żyjący klienci DeepSeek (OpenAI SDK) i ElevenLabs współdzieleni w obrębie procesu.
+
+    Klienci tworzeni są leniwie przy pierwszym użyciu i trzymają pulę połączeń HTTP
+    (keep-alive, sesje TLS), zamiast zakładać nowe przy każdym scenariuszu. Każdy etap
+    generowania ma własny limit czasu i liczbę ponowień, a circuit breaker per dostawca
+    pozwala od razu przejść do fallbacku, gdy dostawca nie odpowiada.
+
+    Konfiguracja (app.config):
+        API_STAGE_TIMEOUTS: Limity czasu etapów w sekundach ({'scenario', 'tts', 'sound_effect'})
+        API_STAGE_MAX_RETRIES: Liczba ponowień etapów
+        API_HTTP_MAX_CONNECTIONS: Rozmiar puli połączeń HTTP per dostawca
+        API_CIRCUIT_FAILURE_THRESHOLD: Liczba kolejnych błędów otwierająca obwód
+        API_CIRCUIT_RESET_SECONDS: Czas otwarcia obwodu przed wywołaniem próbnym
+    """
+
+    # Etap generowania -> dostawca (circuit breaker jest wspólny dla etapów dostawcy)
+    STAGE_PROVIDERS = {'scenario': 'deepseek', 'tts': 'elevenlabs', 'sound_effect': 'elevenlabs'}
+
+    def __init__(self, app=None):
+        self.stage_timeouts = {'scenario': 20, 'tts': 30, 'sound_effect': 60}
+        self.stage_max_retries = {'scenario': 1, 'tts': 1, 'sound_effect': 1}
+        self.max_connections = 16
+        self._clients = {}  # (dostawca, klucz API) -> klient
+        self._lock = threading.Lock()
+        self._breakers = {
+            provider: CircuitBreaker(provider) for provider in set(self.STAGE_PROVIDERS.values())
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.stage_timeouts.update(app.config.get('API_STAGE_TIMEOUTS', {}))
+        self.stage_max_retries.update(app.config.get('API_STAGE_MAX_RETRIES', {}))
+        self.max_connections = app.config.get('API_HTTP_MAX_CONNECTIONS', self.max_connections)
+        for breaker in self._breakers.values():
+            breaker.failure_threshold = app.config.get('API_CIRCUIT_FAILURE_THRESHOLD', breaker.failure_threshold)
+            breaker.reset_seconds = app.config.get('API_CIRCUIT_RESET_SECONDS', breaker.reset_seconds)
+        app.extensions['api_clients'] = self
+
+    def _http_client(self):
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=60
+        )
+        return httpx.Client(limits=limits, timeout=httpx.Timeout(60.0, connect=CONNECT_TIMEOUT_SECONDS))
+
+    def _get_client(self, provider, api_key, factory):
+        # Klucz API wchodzi do klucza - zmiana klucza w środowisku tworzy nowego klienta
+        cache_key = (provider, api_key)
+        client = self._clients.get(cache_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(cache_key)
+                if client is None:
+                    client = self._clients[cache_key] = factory()
+        return client
+
+    def deepseek(self, api_key):
+        """Klient DeepSeek (API zgodne z OpenAI); ponowienia ustawiane per wywołanie"""
+        return self._get_client('deepseek', api_key, lambda: OpenAI(
+            api_key=api_key,
+            base_url=DEEPSEEK_BASE_URL,
+            max_retries=0,
+            http_client=self._http_client()
+        ))
+
+    def elevenlabs(self, api_key):
+        """Klient ElevenLabs; limit czasu i ponowienia ustawiane per wywołanie (request_options)"""
+        return self._get_client('elevenlabs', api_key, lambda: ElevenLabs(
+            api_key=api_key,
+            httpx_client=self._http_client()
+        ))
+
+    def stage_timeout(self, stage):
+        return httpx.Timeout(float(self.stage_timeouts[stage]), connect=CONNECT_TIMEOUT_SECONDS)
+
+    def request_options(self, stage):
+        """Opcje wywołania ElevenLabs dla etapu (limit czasu i liczba ponowień)"""
+        return {
+            'timeout_in_seconds': int(self.stage_timeouts[stage]),
+            'max_retries': self.stage_max_retries[stage]
+        }
+
+    def breaker(self, stage):
+        return self._breakers[self.STAGE_PROVIDERS[stage]]
+
+    def call(self, stage, func, *args, **kwargs):
+        """
+        Wykonuje func(*args, **kwargs) jako etap generowania przez circuit breaker dostawcy
+
+        Raises:
+            CircuitOpenError: Gdy obwód dostawcy jest otwarty (bez wywołania func)
+        """
+        breaker = self.breaker(stage)
+        if not breaker.allow():
+            raise CircuitOpenError(f"{breaker.name} circuit open - skipping {stage}")
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result
+
+    def stats(self):
+        return {
+            'clients': len(self._clients),
+            'stage_timeouts': dict(self.stage_timeouts),
+            'stage_max_retries': dict(self.stage_max_retries),
+            'breakers': {provider: breaker.stats() for provider, breaker in self._breakers.items()}
+        }
+
+
+api_clients = ApiClients()
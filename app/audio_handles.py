@@ -0,0 +1,152 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from .redis_store import redis_store
+
+
+class AudioHandleRegistry:
+    """
+    Rejestr wygenerowanych plików audio po stronie serwera.
+
+    Każdy wynik generowania dostaje krótki, nieprzewidywalny identyfikator (handle), z którego
+    budowane są adresy pobierania - ścieżki plików nie trafiają do sesji cookie. Wpisy wygasają
+    po ttl_seconds; słownik uporządkowany wg czasu utworzenia pozwala usuwać wygasłe wpisy
+    od początku, a wyszukiwanie po handle i po kluczu źródła (np. job_id) jest O(1).
+
+    Nowe handle zapisywane są też w redis_store - handle nieznany lokalnie (utworzony przez
+    inny węzeł lub worker) jest odczytywany stamtąd.
+
+    Konfiguracja (app.config):
+        AUDIO_HANDLE_TTL_SECONDS: Czas ważności handle
+        AUDIO_HANDLE_MAX_ENTRIES: Maksymalna liczba pamiętanych handle
+    """
+
+    def __init__(self, app=None):
+        self.ttl_seconds = 24 * 3600
+        self.max_entries = 10000
+        self._handles = OrderedDict()  # handle_id -> wpis (kolejność = czas utworzenia)
+        self._by_source = {}  # klucz źródła -> handle_id
+        self._lock = threading.Lock()
+        self._register_hooks = []
+        self._expire_hooks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl_seconds = app.config.get('AUDIO_HANDLE_TTL_SECONDS', self.ttl_seconds)
+        self.max_entries = app.config.get('AUDIO_HANDLE_MAX_ENTRIES', self.max_entries)
+        app.extensions['audio_handles'] = self
+
+    def add_register_hook(self, hook):
+        """Rejestruje funkcję hook(entry) wywoływaną po utworzeniu nowego handle"""
+        self._register_hooks.append(hook)
+        return hook
+
+    def add_expire_hook(self, hook):
+        """Rejestruje funkcję hook(entry) wywoływaną po wygaśnięciu/usunięciu handle"""
+        self._expire_hooks.append(hook)
+        return hook
+
+    def _run_hooks(self, hooks, entry):
+        for hook in hooks:
+            try:
+                hook(entry)
+            except Exception as e:
+                print(f"Error in audio handle hook: {e}")
+
+    def prune(self):
+        """Usuwa wygasłe handle (wywoływane też okresowo przez sprzątanie magazynu audio)"""
+        with self._lock:
+            self._prune(time.time())
+
+    def _prune(self, now):
+        # Wpisy mają wspólny TTL, więc wygasłe są zawsze na początku słownika
+        while self._handles:
+            handle_id, entry = next(iter(self._handles.items()))
+            if entry['expires_at'] > now and len(self._handles) <= self.max_entries:
+                break
+            self._remove(handle_id)
+
+    def _remove(self, handle_id):
+        entry = self._handles.pop(handle_id, None)
+        if entry is None:
+            return
+        if entry['source_key'] is not None and self._by_source.get(entry['source_key']) == handle_id:
+            del self._by_source[entry['source_key']]
+        self._run_hooks(self._expire_hooks, entry)
+
+    def register(self, audio_files, source_key=None, metadata=None):
+        """
+        Rejestruje pliki audio wyniku generowania
+
+        Args:
+            audio_files (dict): {'tts_file': ścieżka, 'sound_file': ..., 'extended_file': ...}
+            source_key (str): Klucz źródła (np. job_id) - ponowna rejestracja zwraca ten sam handle
+            metadata (dict): Dodatkowe dane (mobile_id, key_words, ...)
+
+        Returns:
+            str: Identyfikator handle
+        """
+        now = time.time()
+        if source_key is not None:
+            with self._lock:
+                existing = self._by_source.get(source_key)
+                if existing in self._handles:
+                    return existing
+            # Handle źródła mógł już utworzyć inny węzeł (np. przy wcześniejszym odczycie wyniku zadania)
+            remote = redis_store.load_audio_handle(source_key=source_key)
+            if remote and remote['expires_at'] > now:
+                return remote['handle_id']
+
+        with self._lock:
+            self._prune(now)
+            if source_key is not None:
+                existing = self._by_source.get(source_key)
+                if existing in self._handles:
+                    return existing
+
+            handle_id = secrets.token_urlsafe(9)
+            while handle_id in self._handles:
+                handle_id = secrets.token_urlsafe(9)
+            entry = self._handles[handle_id] = {
+                'handle_id': handle_id,
+                'audio_files': dict(audio_files),
+                'source_key': source_key,
+                'metadata': dict(metadata or {}),
+                'created_at': now,
+                'expires_at': now + self.ttl_seconds
+            }
+            if source_key is not None:
+                self._by_source[source_key] = handle_id
+            self._run_hooks(self._register_hooks, entry)
+            self._prune(now)
+        redis_store.save_audio_handle(entry)
+        return handle_id
+
+    def get(self, handle_id):
+        """Zwraca wpis handle (kopia) lub None gdy nie istnieje albo wygasł"""
+        with self._lock:
+            entry = self._handles.get(handle_id)
+            if entry is not None:
+                if entry['expires_at'] <= time.time():
+                    self._remove(handle_id)
+                    return None
+                return {**entry, 'audio_files': dict(entry['audio_files'])}
+        # Handle utworzony przez inny węzeł lub worker
+        entry = redis_store.load_audio_handle(handle_id)
+        if entry is None or entry['expires_at'] <= time.time():
+            return None
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                'handles': len(self._handles),
+                'ttl_seconds': self.ttl_seconds,
+                'max_entries': self.max_entries
+            }
+
+
+audio_handles = AudioHandleRegistry()
@@ -0,0 +1,321 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from .redis_store import redis_store
+
+# Klasy priorytetu zadań (mniejsza wartość = ważniejsze)
+PRIORITY_REM = 0  # Początek fazy REM - liczy się każda sekunda
+PRIORITY_INTERACTIVE = 1  # Użytkownik czeka na wynik (/mobile/generate_audio)
+PRIORITY_BULK = 2  # Wstępne generowanie scenariuszy (/mobile/load_scenarios)
+PRIORITY_NAMES = {PRIORITY_REM: 'rem', PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk'}
+
+FINISHED_STATUSES = ('done', 'error')
+
+PREEMPTED_ERROR = 'Preempted by higher priority audio job'
+EXPIRED_ERROR = 'Job record expired from history'
+
+
+class JobQueueFull(Exception):
+    """Kolejka zadań audio jest pełna - zadanie nie zostało przyjęte"""
+
+
+class AudioJobQueue:
+    """
+    Kolejka zadań generowania audio wykonywanych w tle przez ograniczoną pulę wątków.
+
+    Endpointy (np. /embedded/flags) tylko zlecają zadanie i od razu odpowiadają; wynik
+    dostępny jest przez status zadania oraz hooki wywoływane po jego zakończeniu.
+
+    Zadania mają klasę priorytetu (REM > interactive > bulk). Wątek roboczy zawsze bierze
+    zadanie z najważniejszej niepustej klasy, a w obrębie klasy kolejni użytkownicy
+    obsługiwani są po kolei (round-robin), więc paczka scenariuszy jednego użytkownika nie
+    blokuje innych. Część wątków jest zarezerwowana dla REM, a przy pełnej kolejce nowe
+    zadanie o wyższym priorytecie wypiera najnowsze oczekujące zadanie niższej klasy.
+
+    Zmiany statusu zadań zapisywane są w redis_store, więc status i wynik zadania można
+    odczytać na każdym węźle (get); czekanie na zadanie (as_completed, wait) jest lokalne.
+
+    Konfiguracja (app.config):
+        AUDIO_JOB_WORKERS: Liczba wątków roboczych
+        AUDIO_JOB_QUEUE_SIZE: Maksymalna liczba zadań oczekujących + wykonywanych
+        AUDIO_JOB_HISTORY_SIZE: Liczba zakończonych zadań przechowywanych do odczytu statusu
+        AUDIO_JOB_REM_RESERVED_WORKERS: Liczba wątków, których nie zajmują zadania spoza REM
+    """
+
+    def __init__(self, app=None):
+        self.max_workers = 2
+        self.max_pending = 32
+        self.history_size = 200
+        self.rem_reserved_workers = 1
+        self._workers = []
+        self._jobs = OrderedDict()  # job_id -> rekord zadania
+        # priorytet -> użytkownik -> kolejka oczekujących (job, func, args, kwargs)
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self._pending = 0
+        self._running = {priority: 0 for priority in PRIORITY_NAMES}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._share_lock = threading.Lock()
+        self._completion_hooks = []
+        self._awaited = {}  # job_id -> liczba oczekujących (as_completed) - chronione przed _trim_history
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_workers = app.config.get('AUDIO_JOB_WORKERS', self.max_workers)
+        self.max_pending = app.config.get('AUDIO_JOB_QUEUE_SIZE', self.max_pending)
+        self.history_size = app.config.get('AUDIO_JOB_HISTORY_SIZE', self.history_size)
+        self.rem_reserved_workers = app.config.get('AUDIO_JOB_REM_RESERVED_WORKERS', self.rem_reserved_workers)
+        app.extensions['audio_jobs'] = self
+
+    def _ensure_workers(self):
+        # Wątki uruchamiane leniwie przy pierwszym zadaniu (wywoływane pod blokadą)
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._worker_loop, name=f'audio-job-{len(self._workers)}', daemon=True
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def add_completion_hook(self, hook):
+        """Rejestruje funkcję hook(job) wywoływaną po zakończeniu każdego zadania"""
+        self._completion_hooks.append(hook)
+        return hook
+
+    def submit(self, func, *args, kind='generic', metadata=None, priority=PRIORITY_INTERACTIVE, user=None, **kwargs):
+        """
+        Zleca wykonanie func(*args, **kwargs) w tle
+
+        Args:
+            func: Funkcja do wykonania (np. generate_sound)
+            kind (str): Rodzaj zadania (np. 'rem_phase', 'on_demand')
+            metadata (dict): Dodatkowe dane zadania (device_id, mobile_id, rem_phase, ...)
+            priority (int): Klasa priorytetu (PRIORITY_REM, PRIORITY_INTERACTIVE, PRIORITY_BULK)
+            user (str): Użytkownik (np. mobile_id) - podstawa sprawiedliwego przydziału w klasie
+
+        Returns:
+            dict: Rekord zadania (kopia)
+
+        Raises:
+            JobQueueFull: Gdy osiągnięto limit AUDIO_JOB_QUEUE_SIZE i nie ma czego wyprzeć
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            'job_id': job_id,
+            'kind': kind,
+            'priority': PRIORITY_NAMES[priority],
+            'user': user,
+            'status': 'queued',
+            'metadata': dict(metadata or {}),
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        preempted = None
+        with self._lock:
+            if self._pending >= self.max_pending:
+                preempted = self._preempt(priority)
+                if preempted is None:
+                    raise JobQueueFull(f"Audio job queue is full ({self.max_pending} pending jobs)")
+            else:
+                self._pending += 1
+            self._jobs[job_id] = job
+            self._queues[priority].setdefault(user, deque()).append((job, func, args, kwargs))
+            self._trim_history()
+            self._ensure_workers()
+            self._changed.notify_all()
+
+        self._share(job)
+        if preempted is not None:
+            print(f"Zadanie audio {preempted['job_id']} ({preempted['priority']}) wyparte przez {job_id} ({job['priority']})")
+            self._share(preempted)
+            self._run_hooks(preempted)
+        return dict(job)
+
+    def _preempt(self, priority):
+        # Wypiera najnowsze oczekujące zadanie najniższej klasy niższej niż priority - od
+        # użytkownika z najdłuższą kolejką (wywoływane pod blokadą; miejsce przechodzi na nowe zadanie)
+        for lower in sorted(PRIORITY_NAMES, reverse=True):
+            if lower <= priority:
+                break
+            users = self._queues[lower]
+            if not users:
+                continue
+            user = max(users, key=lambda key: len(users[key]))
+            job = users[user].pop()[0]
+            if not users[user]:
+                del users[user]
+            job['status'] = 'error'
+            job['error'] = PREEMPTED_ERROR
+            job['preempted'] = True
+            job['finished_at'] = datetime.now().isoformat()
+            return job
+        return None
+
+    def _next_job(self):
+        # Zadanie z najważniejszej niepustej klasy, round-robin po użytkownikach (pod blokadą)
+        non_rem_limit = max(1, self.max_workers - self.rem_reserved_workers)
+        non_rem_running = sum(count for priority, count in self._running.items() if priority != PRIORITY_REM)
+        for priority in sorted(PRIORITY_NAMES):
+            users = self._queues[priority]
+            if not users:
+                continue
+            if priority != PRIORITY_REM and non_rem_running >= non_rem_limit:
+                return None
+            user, user_queue = next(iter(users.items()))
+            entry = user_queue.popleft()
+            if user_queue:
+                users.move_to_end(user)
+            else:
+                del users[user]
+            self._running[priority] += 1
+            return priority, entry
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._changed:
+                selected = self._next_job()
+                while selected is None:
+                    self._changed.wait()
+                    selected = self._next_job()
+            priority, (job, func, args, kwargs) = selected
+            self._run(job, func, args, kwargs)
+            with self._changed:
+                self._running[priority] -= 1
+                self._changed.notify_all()
+
+    def _run(self, job, func, args, kwargs):
+        job['status'] = 'running'
+        job['started_at'] = datetime.now().isoformat()
+        self._share(job)
+        try:
+            result = func(*args, **kwargs)
+            job['result'] = result
+            # generate_sound zwraca błędy jako słownik ze statusem 'error'
+            if isinstance(result, dict) and result.get('status') == 'error':
+                job['status'] = 'error'
+                job['error'] = result.get('error')
+            else:
+                job['status'] = 'done'
+        except Exception as e:
+            print(f"ERROR w zadaniu audio {job['job_id']}: {str(e)}")
+            print(f"DEBUG traceback: {traceback.format_exc()}")
+            job['status'] = 'error'
+            job['error'] = str(e)
+        finally:
+            job['finished_at'] = datetime.now().isoformat()
+            with self._changed:
+                self._pending -= 1
+                self._changed.notify_all()
+
+        self._share(job)
+        self._run_hooks(job)
+
+    def _share(self, job):
+        # Rekord zadania widoczny dla innych węzłów i workerów (bez Redis nic nie robi).
+        # Kopia i zapis pod jedną blokadą - spóźniony zapis 'queued' z submit nie nadpisze 'done'
+        with self._share_lock:
+            redis_store.save_audio_job(dict(job))
+
+    def _run_hooks(self, job):
+        for hook in self._completion_hooks:
+            try:
+                hook(job)
+            except Exception as e:
+                print(f"ERROR w hooku zadania audio {job['job_id']}: {str(e)}")
+
+    def _trim_history(self):
+        # Usuwamy najstarsze zakończone zadania ponad limit historii (wywoływane pod blokadą)
+        excess = len(self._jobs) - self.history_size
+        if excess <= 0:
+            return
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id]['status'] in FINISHED_STATUSES and job_id not in self._awaited:
+                del self._jobs[job_id]
+                excess -= 1
+
+    def get(self, job_id):
+        """Zwraca rekord zadania (także zleconego na innym węźle) lub None jeśli nie istnieje"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = redis_store.load_audio_job(job_id)
+        return job
+
+    def as_completed(self, job_ids, timeout=None):
+        """
+        Zwraca rekordy zadań w kolejności ich zakończenia (blokuje do zakończenia wszystkich
+        albo upływu timeout - wtedy niezakończone zadania są pomijane).
+
+        Zadania usunięte już z historii zwracane są jako rekordy ze statusem 'error'
+        (EXPIRED_ERROR); oczekiwane zadania nie są usuwane z historii do końca iteracji.
+        """
+        with self._lock:
+            remaining = []
+            expired = []
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    expired.append({
+                        'job_id': job_id, 'status': 'error', 'error': EXPIRED_ERROR,
+                        'result': None, 'metadata': {}
+                    })
+                    continue
+                self._awaited[job_id] = self._awaited.get(job_id, 0) + 1
+                remaining.append(job)
+        awaited = [job['job_id'] for job in remaining]
+        try:
+            yield from expired
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while remaining:
+                with self._changed:
+                    finished = [job for job in remaining if job['status'] in FINISHED_STATUSES]
+                    if not finished:
+                        wait_seconds = None if deadline is None else deadline - time.monotonic()
+                        if wait_seconds is not None and wait_seconds <= 0:
+                            return
+                        self._changed.wait(wait_seconds)
+                        continue
+                for job in finished:
+                    remaining.remove(job)
+                    yield job
+        finally:
+            with self._lock:
+                for job_id in awaited:
+                    self._awaited[job_id] -= 1
+                    if not self._awaited[job_id]:
+                        del self._awaited[job_id]
+
+    def wait(self, job_id, timeout=None):
+        """Czeka na zakończenie zadania i zwraca jego rekord (None gdy upłynął timeout)"""
+        for job in self.as_completed([job_id], timeout):
+            return job
+        return None
+
+    def stats(self):
+        with self._lock:
+            statuses = [job['status'] for job in self._jobs.values()]
+            return {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'workers': self.max_workers,
+                'rem_reserved_workers': self.rem_reserved_workers,
+                'queued': {
+                    PRIORITY_NAMES[priority]: sum(len(user_queue) for user_queue in users.values())
+                    for priority, users in self._queues.items()
+                },
+                'running': {PRIORITY_NAMES[priority]: count for priority, count in self._running.items()},
+                'tracked_jobs': len(statuses),
+                'failed_jobs': statuses.count('error')
+            }
+
+
+audio_jobs = AudioJobQueue()
@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    content_hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+
+CREATE TABLE IF NOT EXISTS asset_refs (
+    asset_key TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS asset_refs_content_hash ON asset_refs (content_hash);
+
+CREATE TABLE IF NOT EXISTS holders (
+    holder TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (holder, content_hash)
+);
+CREATE INDEX IF NOT EXISTS holders_content_hash ON holders (content_hash);
+
+CREATE TABLE IF NOT EXISTS blob_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    total_bytes INTEGER NOT NULL
+);
+"""
+
+
+class AudioManifest:
+    """
+    Indeks magazynu audio w SQLite: rozmiar i czas ostatniego dostępu każdego bloba,
+    klucze zasobów wskazujące na blob oraz sesje/handle, które go używają.
+
+    Wybór kandydatów do usunięcia korzysta z indeksu po last_access, więc koszt eviction
+    zależy od liczby usuwanych plików, a nie od liczby plików w katalogu. Łączny rozmiar
+    blobów trzyma jednowierszowa tabela blob_totals, zmieniana w tej samej transakcji co
+    blobs - licznik jest wspólny dla workerów na hoście.
+
+    Args:
+        db_path (str): Ścieżka pliku bazy SQLite
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        # Połączenie tworzone leniwie i współdzielone między wątkami (dostęp pod blokadą)
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            # Licznik rozmiaru dla manifestu sprzed tabeli blob_totals (inny worker mógł go już utworzyć)
+            conn.execute(
+                "INSERT OR IGNORE INTO blob_totals (id, total_bytes) SELECT 0, COALESCE(SUM(size), 0) FROM blobs"
+            )
+            self._conn = conn
+        return self._conn
+
+    def is_empty(self):
+        with self._lock:
+            return self._connect().execute("SELECT 1 FROM blobs LIMIT 1").fetchone() is None
+
+    def record_blob(self, content_hash, size, asset_key=None, now=None):
+        """Rejestruje blob (lub odświeża czas dostępu istniejącego) i klucz zasobu na niego wskazujący"""
+        now = now or time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO blobs (content_hash, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                    (content_hash, size, now, now)
+                ).rowcount
+                if inserted:
+                    conn.execute("UPDATE blob_totals SET total_bytes = total_bytes + ? WHERE id = 0", (size,))
+                else:
+                    conn.execute("UPDATE blobs SET last_access = ? WHERE content_hash = ?", (now, content_hash))
+                if asset_key:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO asset_refs (asset_key, content_hash) VALUES (?, ?)",
+                        (asset_key, content_hash)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def touch(self, content_hash, now=None):
+        """Aktualizuje czas ostatniego dostępu bloba (kolejność LRU)"""
+        with self._lock:
+            self._connect().execute(
+                "UPDATE blobs SET last_access = ? WHERE content_hash = ?", (now or time.time(), content_hash)
+            )
+
+    def retain(self, holder, content_hashes):
+        """Oznacza bloby jako używane przez holder (np. 'handle:<id>') - nie będą usuwane"""
+        with self._lock:
+            self._connect().executemany(
+                "INSERT OR IGNORE INTO holders (holder, content_hash) VALUES (?, ?)",
+                [(holder, content_hash) for content_hash in content_hashes]
+            )
+
+    def release(self, holder):
+        """Zwalnia wszystkie bloby używane przez holder"""
+        with self._lock:
+            self._connect().execute("DELETE FROM holders WHERE holder = ?", (holder,))
+
+    def total_bytes(self):
+        """Łączny rozmiar blobów w magazynie (wszystkich workerów na hoście)"""
+        with self._lock:
+            return self._read_total_bytes(self._connect())
+
+    @staticmethod
+    def _read_total_bytes(conn):
+        return conn.execute("SELECT total_bytes FROM blob_totals WHERE id = 0").fetchone()[0]
+
+    def eviction_candidates(self, limit, older_than=None):
+        """
+        Zwraca do limit nieużywanych blobów od najdawniej używanych
+
+        Returns:
+            list: Krotki (content_hash, size, last_access)
+        """
+        query = (
+            "SELECT content_hash, size, last_access FROM blobs "
+            "WHERE NOT EXISTS (SELECT 1 FROM holders WHERE holders.content_hash = blobs.content_hash) "
+        )
+        params = ()
+        if older_than is not None:
+            query += "AND last_access < ? "
+            params = (older_than,)
+        query += "ORDER BY last_access LIMIT ?"
+        with self._lock:
+            return self._connect().execute(query, params + (limit,)).fetchall()
+
+    def remove_blob(self, content_hash, last_access):
+        """
+        Usuwa blob z indeksu, o ile nadal nie ma użytkowników i nie był używany po last_access
+        (czasie z eviction_candidates). Warunki sprawdza ta sama instrukcja DELETE, więc blob
+        zatrzymany (retain) lub użyty (touch) po wyborze kandydatów nie zostanie usunięty.
+
+        Returns:
+            list: Klucze zasobów, które wskazywały na usunięty blob; None gdy blob nie został usunięty
+        """
+        with self._lock:
+            conn = self._connect()
+            # IMMEDIATE - blokada zapisu od razu (manifest współdzielą workery na hoście)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT size FROM blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+                deleted = conn.execute(
+                    "DELETE FROM blobs WHERE content_hash = ? AND last_access <= ? "
+                    "AND NOT EXISTS (SELECT 1 FROM holders WHERE holders.content_hash = blobs.content_hash)",
+                    (content_hash, last_access)
+                ).rowcount
+                asset_keys = None
+                if deleted:
+                    asset_keys = [
+                        asset_key for (asset_key,) in conn.execute(
+                            "SELECT asset_key FROM asset_refs WHERE content_hash = ?", (content_hash,)
+                        )
+                    ]
+                    conn.execute("DELETE FROM asset_refs WHERE content_hash = ?", (content_hash,))
+                    conn.execute("UPDATE blob_totals SET total_bytes = total_bytes - ? WHERE id = 0", (row[0],))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return asset_keys
+
+    def stats(self):
+        with self._lock:
+            conn = self._connect()
+            return {
+                'blobs': conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0],
+                'asset_refs': conn.execute("SELECT COUNT(*) FROM asset_refs").fetchone()[0],
+                'held_blobs': conn.execute("SELECT COUNT(DISTINCT content_hash) FROM holders").fetchone()[0],
+                'total_bytes': self._read_total_bytes(conn)
+            }
@@ -0,0 +1,227 @@
+import math
+import shutil
+import subprocess
+
+# Formaty surowego PCM dla ffmpeg wg szerokości próbki (bajty)
+PCM_FORMATS = {1: 'u8', 2: 's16le', 4: 's32le'}
+
+# Cisza dla wzmocnienia zerowego (jak fade_in w pydub)
+SILENCE_DB = -120.0
+
+
+def amplitude_to_db(amplitude):
+    """Zamienia współczynnik amplitudy (0..1) na dB"""
+    if amplitude <= 0:
+        return SILENCE_DB
+    return max(SILENCE_DB, 20 * math.log10(amplitude))
+
+
+class StreamingMp3Encoder:
+    """
+    Przyrostowy enkoder MP3 - surowe PCM przekazywane jest kawałkami do procesu ffmpeg,
+    który zapisuje wynik bezpośrednio do pliku. W pamięci nie trzyma całego nagrania.
+
+    Args:
+        output_path (str): Ścieżka pliku wynikowego
+        frame_rate (int): Częstotliwość próbkowania
+        channels (int): Liczba kanałów
+        sample_width (int): Szerokość próbki w bajtach
+        bitrate (str): Bitrate MP3 (np. '128k')
+        encoder (str): Ścieżka do ffmpeg (domyślnie wyszukiwana w PATH)
+    """
+
+    def __init__(self, output_path, frame_rate, channels, sample_width=2, bitrate="128k", encoder=None):
+        encoder = encoder or shutil.which("ffmpeg")
+        if not encoder:
+            raise RuntimeError("ffmpeg not found - streaming MP3 encoder unavailable")
+        if sample_width not in PCM_FORMATS:
+            raise ValueError(f"Unsupported sample width: {sample_width}")
+
+        self.output_path = output_path
+        self._process = subprocess.Popen(
+            [
+                encoder, '-y', '-loglevel', 'error',
+                '-f', PCM_FORMATS[sample_width], '-ar', str(frame_rate), '-ac', str(channels),
+                '-i', 'pipe:0',
+                '-f', 'mp3', '-b:a', bitrate,
+                output_path
+            ],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+
+    def write(self, pcm_bytes):
+        self._process.stdin.write(pcm_bytes)
+
+    def close(self):
+        """Kończy kodowanie i czeka na ffmpeg"""
+        self._process.stdin.close()
+        stderr = self._process.stderr.read()
+        return_code = self._process.wait()
+        if return_code != 0:
+            raise RuntimeError(f"ffmpeg exited with code {return_code}: {stderr.decode(errors='replace').strip()}")
+
+    def abort(self):
+        try:
+            self._process.kill()
+        finally:
+            self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def _chunk_boundaries(duration_ms, chunk_ms, split_points):
+    # Granice kawałków co chunk_ms, dodatkowo dzielone na początku/końcu fade,
+    # aby każdy kawałek leżał w całości w jednym odcinku obwiedni
+    points = set(range(0, duration_ms, chunk_ms))
+    points.update(p for p in split_points if 0 < p < duration_ms)
+    points.add(duration_ms)
+    ordered = sorted(points)
+    return list(zip(ordered[:-1], ordered[1:]))
+
+
+def _loop_slice(sound_loop, start_ms, end_ms):
+    # Fragment [start_ms, end_ms) nieskończenie powtarzanej pętli
+    loop_ms = len(sound_loop)
+    position = start_ms % loop_ms
+    remaining = end_ms - start_ms
+    piece = sound_loop[position:position + remaining]
+    remaining -= len(piece)
+    while remaining > 0:
+        next_piece = sound_loop[:remaining]
+        piece += next_piece
+        remaining -= len(next_piece)
+    return piece
+
+
+def _envelope(position_ms, duration_ms, fade_in_ms, fade_out_ms):
+    # Amplituda obwiedni tła (liniowy fade-in i fade-out jak w pydub)
+    amplitude = 1.0
+    if fade_in_ms and position_ms < fade_in_ms:
+        amplitude = min(amplitude, position_ms / fade_in_ms)
+    fade_out_start = duration_ms - fade_out_ms
+    if fade_out_ms and position_ms > fade_out_start:
+        amplitude = min(amplitude, (duration_ms - position_ms) / fade_out_ms)
+    return amplitude
+
+
+def iter_extended_chunks(tts_segment, sound_loop, duration_ms, fade_in_ms=10000, fade_out_ms=5000,
+                         background_gain_db=-15, tts_start_ms=10000, chunk_ms=5000):
+    """
+    Generuje kolejne kawałki rozszerzonego audio: zapętlone tło z fade-in/fade-out,
+    ściszone o background_gain_db, z nałożonym TTS od tts_start_ms.
+
+    Każdy kawałek liczony jest niezależnie z pętli zdekodowanej raz, więc pamięć
+    nie zależy od długości nagrania, a czas renderowania rośnie liniowo.
+
+    Yields:
+        AudioSegment: Kolejne kawałki (maks. chunk_ms)
+    """
+    if len(sound_loop) == 0:
+        raise ValueError("Sound loop is empty")
+
+    # TTS dłuższe niż dostępny czas jest przycinane (jak w wersji nie-strumieniowej)
+    available_ms = max(0, duration_ms - tts_start_ms)
+    if len(tts_segment) > available_ms:
+        print(f"TTS too long ({len(tts_segment)}ms), trimming to {available_ms}ms")
+        tts_segment = tts_segment[:available_ms]
+    tts_end_ms = tts_start_ms + len(tts_segment)
+
+    split_points = (fade_in_ms, duration_ms - fade_out_ms, tts_start_ms, tts_end_ms)
+    for start_ms, end_ms in _chunk_boundaries(duration_ms, chunk_ms, split_points):
+        chunk = _loop_slice(sound_loop, start_ms, end_ms)
+
+        from_amplitude = _envelope(start_ms, duration_ms, fade_in_ms, fade_out_ms)
+        to_amplitude = _envelope(end_ms, duration_ms, fade_in_ms, fade_out_ms)
+        if from_amplitude < 1.0 or to_amplitude < 1.0:
+            chunk = chunk.fade(
+                from_gain=amplitude_to_db(from_amplitude),
+                to_gain=amplitude_to_db(to_amplitude),
+                start=0,
+                end=len(chunk)
+            )
+        chunk = chunk + background_gain_db
+
+        if start_ms < tts_end_ms and end_ms > tts_start_ms:
+            tts_piece = tts_segment[max(0, start_ms - tts_start_ms):end_ms - tts_start_ms]
+            chunk = chunk.overlay(tts_piece, position=max(0, tts_start_ms - start_ms))
+
+        yield chunk
+
+
+def render_extended_audio(tts_segment, sound_loop, output_path, duration_ms, bitrate="128k", **options):
+    """
+    Renderuje rozszerzone audio strumieniowo do pliku MP3
+
+    Args:
+        tts_segment (AudioSegment): Zdekodowany TTS
+        sound_loop (AudioSegment): Zdekodowana pętla tła
+        output_path (str): Plik wynikowy
+        duration_ms (int): Długość nagrania
+        bitrate (str): Bitrate MP3
+        **options: Parametry obwiedni i miksowania (patrz iter_extended_chunks)
+
+    Returns:
+        int: Długość wyrenderowanego audio w ms
+    """
+    # Wspólny format PCM dla tła i TTS - ustalany raz, a nie przy każdym overlay
+    sound_loop = sound_loop.set_sample_width(2)
+    tts_segment = (
+        tts_segment.set_frame_rate(sound_loop.frame_rate)
+        .set_channels(sound_loop.channels)
+        .set_sample_width(sound_loop.sample_width)
+    )
+
+    rendered_ms = 0
+    with StreamingMp3Encoder(
+        output_path, sound_loop.frame_rate, sound_loop.channels, sound_loop.sample_width, bitrate
+    ) as encoder:
+        for chunk in iter_extended_chunks(tts_segment, sound_loop, duration_ms, **options):
+            encoder.write(chunk.raw_data)
+            rendered_ms += len(chunk)
+    return rendered_ms
+
+
+def render_playlist_segments(tts_segment, sound_loop, output_paths, fade_in_ms=10000, fade_out_ms=5000,
+                             background_gain_db=-15, tts_start_ms=10000, bitrate="128k", chunk_ms=5000):
+    """
+    Renderuje segmenty odtwarzania w trybie playlisty: intro (fade-in + TTS), pojedynczą
+    pętlę tła oraz outro (pętla z fade-out). Intro ma długość całkowitej liczby pętli,
+    więc kolejne segmenty pętli zachowują ciągłość fazy.
+
+    Args:
+        output_paths (dict): {'intro': ścieżka, 'loop': ścieżka, 'outro': ścieżka}
+
+    Returns:
+        dict: Długości segmentów w ms ({'intro', 'loop', 'outro'})
+    """
+    loop_ms = len(sound_loop)
+    if loop_ms == 0:
+        raise ValueError("Sound loop is empty")
+    needed_ms = max(fade_in_ms, tts_start_ms + len(tts_segment))
+    intro_ms = max(1, math.ceil(needed_ms / loop_ms)) * loop_ms
+    no_tts = sound_loop[:0]
+    mix = {'background_gain_db': background_gain_db, 'chunk_ms': chunk_ms}
+
+    return {
+        'intro': render_extended_audio(
+            tts_segment, sound_loop, output_paths['intro'], intro_ms, bitrate,
+            fade_in_ms=fade_in_ms, fade_out_ms=0, tts_start_ms=tts_start_ms, **mix
+        ),
+        'loop': render_extended_audio(
+            no_tts, sound_loop, output_paths['loop'], loop_ms, bitrate,
+            fade_in_ms=0, fade_out_ms=0, tts_start_ms=0, **mix
+        ),
+        'outro': render_extended_audio(
+            no_tts, sound_loop, output_paths['outro'], loop_ms, bitrate,
+            fade_in_ms=0, fade_out_ms=min(fade_out_ms, loop_ms), tts_start_ms=0, **mix
+        )
+    }
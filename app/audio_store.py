@@ -0,0 +1,320 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from .audio_manifest import AudioManifest
+
+
+def make_asset_key(kind, **params):
+    """
+    Buduje klucz zasobu audio z parametrów wejściowych generowania
+
+    Args:
+        kind (str): Rodzaj zasobu ('tts', 'sound', 'extended', ...)
+        **params: Parametry wejściowe (tekst, voice_id, model_id, czas trwania, ...)
+
+    Returns:
+        str: Hash SHA-256 (hex)
+    """
+    payload = json.dumps({'kind': kind, **params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AudioAssetStore:
+    """
+    Magazyn plików audio adresowany zawartością.
+
+    Pliki MP3 zapisywane są raz jako blobs/<sha256 zawartości>.mp3. Klucz wejściowy zasobu
+    (hash tekstu, głosu, modelu, długości) wskazuje na blob przez mały plik referencji
+    refs/<klucz>.json, więc identyczne wyniki generowania współdzielą jeden plik na dysku.
+
+    Manifest SQLite (AudioManifest) śledzi rozmiar, czas ostatniego dostępu i użytkowników
+    (handle, sesje) każdego bloba. Wątek sprzątający usuwa nieużywane bloby w kolejności LRU,
+    gdy magazyn przekroczy limit miejsca, oraz bloby nieużywane dłużej niż max_age_seconds.
+
+    Konfiguracja (app.config):
+        AUDIO_STORE_QUOTA_BYTES: Limit miejsca na bloby (0 = bez limitu)
+        AUDIO_STORE_MAX_AGE_SECONDS: Maksymalny czas od ostatniego użycia (0 = bez limitu)
+        AUDIO_STORE_SWEEP_INTERVAL_SECONDS: Odstęp między przebiegami sprzątania (0 = wyłączone)
+
+    Args:
+        root_dir (str): Katalog główny magazynu (np. audio_files)
+        manifest_path (str): Plik bazy manifestu (domyślnie <root_dir>/manifest.sqlite3)
+    """
+
+    def __init__(self, root_dir, manifest_path=None):
+        self.root_dir = root_dir
+        self.blobs_dir = os.path.join(root_dir, 'blobs')
+        self.refs_dir = os.path.join(root_dir, 'refs')
+        self.tmp_dir = os.path.join(root_dir, 'tmp')
+        self.manifest = AudioManifest(manifest_path or os.path.join(root_dir, 'manifest.sqlite3'))
+        self.quota_bytes = 0
+        self.max_age_seconds = 0
+        self.sweep_interval = 0
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._indexed = False
+        self._sweep_hooks = []
+        self._sweeper = None
+        self._stop_sweeper = threading.Event()
+
+    def init_app(self, app):
+        self.quota_bytes = app.config.get('AUDIO_STORE_QUOTA_BYTES', self.quota_bytes)
+        self.max_age_seconds = app.config.get('AUDIO_STORE_MAX_AGE_SECONDS', self.max_age_seconds)
+        self.sweep_interval = app.config.get('AUDIO_STORE_SWEEP_INTERVAL_SECONDS', self.sweep_interval)
+        app.extensions['audio_store'] = self
+        if self.sweep_interval and self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_loop, name='audio-store-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def add_sweep_hook(self, hook):
+        """Rejestruje funkcję hook() wywoływaną przed każdym sprzątaniem (np. wygaszanie handle)"""
+        self._sweep_hooks.append(hook)
+        return hook
+
+    def _ensure_indexed(self):
+        # Jednorazowe dopisanie do manifestu blobów zapisanych przed jego wprowadzeniem
+        if self._indexed:
+            return
+        # Osobna blokada (wywoływane też pod self._lock); pozostałe wątki czekają na koniec indeksowania
+        with self._index_lock:
+            if not self._indexed:
+                self._index_existing_blobs()
+                self._indexed = True
+
+    def _index_existing_blobs(self):
+        if not os.path.isdir(self.blobs_dir) or not self.manifest.is_empty():
+            return
+        print("Indexing existing audio blobs into manifest...")
+        for filename in os.listdir(self.blobs_dir):
+            if filename.endswith('.mp3'):
+                stat = os.stat(os.path.join(self.blobs_dir, filename))
+                self.manifest.record_blob(filename[:-len('.mp3')], stat.st_size, now=stat.st_mtime)
+        if os.path.isdir(self.refs_dir):
+            for root, _, files in os.walk(self.refs_dir):
+                for filename in files:
+                    if not filename.endswith('.json'):
+                        continue
+                    try:
+                        with open(os.path.join(root, filename), 'r', encoding='utf-8') as f:
+                            ref = json.load(f)
+                    except (OSError, ValueError):
+                        continue
+                    blob = self.blob_path(ref['content_hash'])
+                    if os.path.exists(blob):
+                        self.manifest.record_blob(
+                            ref['content_hash'], ref.get('size') or os.path.getsize(blob),
+                            asset_key=filename[:-len('.json')], now=os.path.getmtime(blob)
+                        )
+
+    def _ref_path(self, asset_key):
+        return os.path.join(self.refs_dir, asset_key[:2], f"{asset_key}.json")
+
+    def blob_path(self, content_hash):
+        return os.path.join(self.blobs_dir, f"{content_hash}.mp3")
+
+    def content_hash_for_path(self, path):
+        """Zwraca hash zawartości gdy ścieżka wskazuje blob tego magazynu, inaczej None"""
+        directory, filename = os.path.split(os.path.abspath(path))
+        if directory != os.path.abspath(self.blobs_dir) or not filename.endswith('.mp3'):
+            return None
+        return filename[:-len('.mp3')]
+
+    def lookup(self, asset_key):
+        """
+        Zwraca opis zasobu dla klucza wejściowego lub None gdy go nie ma
+
+        Returns:
+            dict: {'asset_key', 'content_hash', 'path', 'size', 'kind', 'info'}
+        """
+        try:
+            with open(self._ref_path(asset_key), 'r', encoding='utf-8') as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Najpierw czas dostępu - eviction sprawdza go przy usuwaniu, więc blob istniejący
+        # po touch nie zostanie już usunięty przez trwający przebieg sprzątania
+        self._ensure_indexed()
+        self.manifest.touch(ref['content_hash'])
+        path = self.blob_path(ref['content_hash'])
+        if not os.path.exists(path):
+            return None
+        return {
+            'asset_key': asset_key,
+            'content_hash': ref['content_hash'],
+            'path': path,
+            'size': ref.get('size'),
+            'kind': ref.get('kind'),
+            'info': ref.get('info') or {}
+        }
+
+    def read(self, asset_key):
+        """Zwraca bajty zasobu lub None"""
+        asset = self.lookup(asset_key)
+        if not asset:
+            return None
+        with open(asset['path'], 'rb') as f:
+            return f.read()
+
+    def put(self, asset_key, data, kind=None, info=None):
+        """
+        Zapisuje bajty zasobu - blob tworzony jest tylko jeśli taka zawartość jeszcze nie istnieje
+
+        Returns:
+            dict: Opis zasobu (jak lookup)
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(content_hash)
+        with self._lock:
+            os.makedirs(self.blobs_dir, exist_ok=True)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            else:
+                print(f"Audio blob already stored, reusing: {content_hash[:12]}")
+            self._write_ref(asset_key, content_hash, len(data), kind, info)
+        return {
+            'asset_key': asset_key,
+            'content_hash': content_hash,
+            'path': path,
+            'size': len(data),
+            'kind': kind,
+            'info': info or {}
+        }
+
+    def temp_path(self, suffix='.mp3'):
+        """Ścieżka pliku tymczasowego na tym samym dysku co bloby (do put_file)"""
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}{suffix}")
+
+    def put_file(self, asset_key, source_path, kind=None, info=None):
+        """
+        Przenosi gotowy plik (np. wyrenderowany strumieniowo) do magazynu bez wczytywania go do pamięci
+
+        Returns:
+            dict: Opis zasobu (jak lookup)
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(source_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+                size += len(block)
+        content_hash = digest.hexdigest()
+        path = self.blob_path(content_hash)
+        with self._lock:
+            os.makedirs(self.blobs_dir, exist_ok=True)
+            if not os.path.exists(path):
+                os.replace(source_path, path)
+            else:
+                print(f"Audio blob already stored, reusing: {content_hash[:12]}")
+                os.remove(source_path)
+            self._write_ref(asset_key, content_hash, size, kind, info)
+        return {
+            'asset_key': asset_key,
+            'content_hash': content_hash,
+            'path': path,
+            'size': size,
+            'kind': kind,
+            'info': info or {}
+        }
+
+    def _write_ref(self, asset_key, content_hash, size, kind, info=None):
+        self._ensure_indexed()
+        self.manifest.record_blob(content_hash, size, asset_key=asset_key)
+        ref_path = self._ref_path(asset_key)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        tmp_path = f"{ref_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'content_hash': content_hash,
+                'size': size,
+                'kind': kind,
+                'info': info or {},
+                'created_at': time.time()
+            }, f)
+        os.replace(tmp_path, ref_path)
+
+    def retain(self, holder, paths):
+        """Chroni bloby wskazane ścieżkami przed usunięciem dopóki holder ich nie zwolni"""
+        content_hashes = [h for h in (self.content_hash_for_path(path) for path in paths if path) if h]
+        if content_hashes:
+            self.manifest.retain(holder, content_hashes)
+
+    def release(self, holder):
+        self.manifest.release(holder)
+
+    def evict(self, target_bytes=None, older_than=None):
+        """
+        Usuwa nieużywane bloby od najdawniej używanych - do zejścia poniżej target_bytes
+        i/lub wszystkie z ostatnim dostępem przed older_than
+
+        Returns:
+            dict: {'evicted': liczba plików, 'freed_bytes': ...}
+        """
+        self._ensure_indexed()
+        evicted = 0
+        freed_bytes = 0
+        while True:
+            if target_bytes is not None and older_than is None and self.manifest.total_bytes() <= target_bytes:
+                break
+            candidates = self.manifest.eviction_candidates(64, older_than=older_than)
+            if not candidates:
+                break
+            removed_in_batch = 0
+            for content_hash, size, last_access in candidates:
+                if target_bytes is not None and older_than is None and self.manifest.total_bytes() <= target_bytes:
+                    break
+                with self._lock:
+                    # Manifest usuwa blob tylko gdy nadal jest nieużywany - inaczej pomijamy go
+                    asset_keys = self.manifest.remove_blob(content_hash, last_access)
+                    if asset_keys is None:
+                        continue
+                    try:
+                        os.remove(self.blob_path(content_hash))
+                    except FileNotFoundError:
+                        pass
+                    for asset_key in asset_keys:
+                        try:
+                            os.remove(self._ref_path(asset_key))
+                        except FileNotFoundError:
+                            pass
+                evicted += 1
+                freed_bytes += size
+                removed_in_batch += 1
+            if not removed_in_batch:
+                break
+        if evicted:
+            print(f"Evicted {evicted} audio blobs ({freed_bytes} bytes)")
+        return {'evicted': evicted, 'freed_bytes': freed_bytes}
+
+    def sweep(self):
+        """Jeden przebieg sprzątania: hooki, bloby przestarzałe, potem limit miejsca (LRU do 90%)"""
+        for hook in self._sweep_hooks:
+            try:
+                hook()
+            except Exception as e:
+                print(f"Error in audio store sweep hook: {e}")
+        result = {'evicted': 0, 'freed_bytes': 0}
+        if self.max_age_seconds:
+            aged = self.evict(older_than=time.time() - self.max_age_seconds)
+            result = {key: result[key] + aged[key] for key in result}
+        if self.quota_bytes and self.manifest.total_bytes() > self.quota_bytes:
+            over = self.evict(target_bytes=int(self.quota_bytes * 0.9))
+            result = {key: result[key] + over[key] for key in result}
+        return result
+
+    def _sweep_loop(self):
+        while not self._stop_sweeper.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error during audio store sweep: {e}")
+
+    def stats(self):
+        return {**self.manifest.stats(), 'quota_bytes': self.quota_bytes}
@@ -42,5 +42,109 @@ class Config:
     if not ELEVENLABS_API_KEY:
         warnings.warn("ELEVENLABS_API_KEY not set in environment; audio generation will be limited to text only.")
 
+    # Pojemność bufora HR per urządzenie (liczba próbek 1 Hz, minimum 900 = okno detekcji REM)
+    HR_BUFFER_CAPACITY = int(os.getenv('HR_BUFFER_CAPACITY', '900'))
+
+    # Retencja danych MPU/EMG - próbki starsze niż okno są usuwane, pojemność ogranicza pamięć
+    SENSOR_RETENTION_SECONDS = int(os.getenv('SENSOR_RETENTION_SECONDS', '900'))
+    MPU_BUFFER_CAPACITY = int(os.getenv('MPU_BUFFER_CAPACITY', '1800'))
+    EMG_BUFFER_CAPACITY = int(os.getenv('EMG_BUFFER_CAPACITY', '1800'))
+
+    # Kolejka zadań generowania audio w tle (REM nie blokuje żądań urządzenia)
+    AUDIO_JOB_WORKERS = int(os.getenv('AUDIO_JOB_WORKERS', '4'))
+    AUDIO_JOB_QUEUE_SIZE = int(os.getenv('AUDIO_JOB_QUEUE_SIZE', '32'))
+    AUDIO_JOB_HISTORY_SIZE = int(os.getenv('AUDIO_JOB_HISTORY_SIZE', '200'))
+    # Wątki zarezerwowane dla generowania przy początku fazy REM (niedostępne dla zadań bulk/interactive)
+    AUDIO_JOB_REM_RESERVED_WORKERS = int(os.getenv('AUDIO_JOB_REM_RESERVED_WORKERS', '1'))
+
+    # Równoległe wywołania ElevenLabs (TTS i sound effect scenariuszy) - rozmiar puli wątków
+    ELEVENLABS_MAX_PARALLEL = int(os.getenv('ELEVENLABS_MAX_PARALLEL', '8'))
+
+    # Cache rozwinięć scenariuszy DeepSeek (LRU w pamięci + pliki JSON na dysku)
+    SCENARIO_CACHE_DIR = os.getenv('SCENARIO_CACHE_DIR')
+    SCENARIO_CACHE_MAX_ENTRIES = int(os.getenv('SCENARIO_CACHE_MAX_ENTRIES', '256'))
+    SCENARIO_CACHE_TTL_SECONDS = int(os.getenv('SCENARIO_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+    SCENARIO_CACHE_MAX_BYTES = int(os.getenv('SCENARIO_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+
+    # Renderowanie audio: długość kawałka PCM przekazywanego do enkodera i generowane formaty
+    # ('extended' - jeden 15-minutowy plik, 'playlist' - segmenty intro/pętla/outro dla m3u8)
+    EXTENDED_RENDER_CHUNK_MS = int(os.getenv('EXTENDED_RENDER_CHUNK_MS', '5000'))
+    AUDIO_OUTPUT_FORMATS = tuple(
+        fmt.strip() for fmt in os.getenv('AUDIO_OUTPUT_FORMATS', 'extended,playlist').split(',') if fmt.strip()
+    )
+
+    # Rejestr wygenerowanych plików audio (krótkie id w adresach pobierania)
+    AUDIO_HANDLE_TTL_SECONDS = int(os.getenv('AUDIO_HANDLE_TTL_SECONDS', str(24 * 3600)))
+    AUDIO_HANDLE_MAX_ENTRIES = int(os.getenv('AUDIO_HANDLE_MAX_ENTRIES', '10000'))
+
+    # Pobieranie audio: X-Sendfile (transfer przez serwer frontowy) i czas cache plików
+    # adresowanych zawartością (niezmiennych)
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
+    AUDIO_DOWNLOAD_MAX_AGE = int(os.getenv('AUDIO_DOWNLOAD_MAX_AGE', str(365 * 24 * 3600)))
+
+    # Magazyn plików audio: limit miejsca (eviction LRU nieużywanych blobów), maksymalny wiek
+    # od ostatniego użycia i odstęp przebiegów wątku sprzątającego (0 = wyłączone)
+    AUDIO_STORE_QUOTA_BYTES = int(os.getenv('AUDIO_STORE_QUOTA_BYTES', str(2 * 1024 * 1024 * 1024)))
+    AUDIO_STORE_MAX_AGE_SECONDS = int(os.getenv('AUDIO_STORE_MAX_AGE_SECONDS', str(30 * 24 * 3600)))
+    AUDIO_STORE_SWEEP_INTERVAL_SECONDS = int(os.getenv('AUDIO_STORE_SWEEP_INTERVAL_SECONDS', '600'))
+
+    # Maksymalna długość odtwarzania playlisty m3u8 (/mobile/playlist/<handle_id>.m3u8?minutes=)
+    PLAYLIST_MAX_MINUTES = int(os.getenv('PLAYLIST_MAX_MINUTES', str(12 * 60)))
+
+    # Long-polling /mobile/polling (?wait=) i kanał SSE /mobile/events
+    LONG_POLL_MAX_SECONDS = int(os.getenv('LONG_POLL_MAX_SECONDS', '25'))
+    SSE_KEEPALIVE_SECONDS = int(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+
+    # Klienci DeepSeek/ElevenLabs: limity czasu (s) i ponowienia per etap generowania,
+    # pula połączeń HTTP oraz circuit breaker (po N kolejnych błędach od razu fallback)
+    API_STAGE_TIMEOUTS = {
+        'scenario': int(os.getenv('DEEPSEEK_TIMEOUT_SECONDS', '20')),
+        'tts': int(os.getenv('ELEVENLABS_TTS_TIMEOUT_SECONDS', '30')),
+        'sound_effect': int(os.getenv('ELEVENLABS_SOUND_TIMEOUT_SECONDS', '60'))
+    }
+    API_STAGE_MAX_RETRIES = {
+        'scenario': int(os.getenv('DEEPSEEK_MAX_RETRIES', '1')),
+        'tts': int(os.getenv('ELEVENLABS_MAX_RETRIES', '1')),
+        'sound_effect': int(os.getenv('ELEVENLABS_MAX_RETRIES', '1'))
+    }
+    API_HTTP_MAX_CONNECTIONS = int(os.getenv('API_HTTP_MAX_CONNECTIONS', '16'))
+    API_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('API_CIRCUIT_FAILURE_THRESHOLD', '3'))
+    API_CIRCUIT_RESET_SECONDS = int(os.getenv('API_CIRCUIT_RESET_SECONDS', '60'))
+
+    # Zapis próbek sensorów do PostgreSQL w tle (write-behind, COPY do tabel partycjonowanych dziennie)
+    SAMPLE_PERSISTENCE_ENABLED = os.getenv('SAMPLE_PERSISTENCE_ENABLED', 'true').lower() == 'true'
+    SAMPLE_WRITER_MAX_PENDING_ROWS = int(os.getenv('SAMPLE_WRITER_MAX_PENDING_ROWS', '100000'))
+    SAMPLE_WRITER_BATCH_ROWS = int(os.getenv('SAMPLE_WRITER_BATCH_ROWS', '5000'))
+    SAMPLE_WRITER_FLUSH_INTERVAL_SECONDS = int(os.getenv('SAMPLE_WRITER_FLUSH_INTERVAL_SECONDS', '2'))
+
+    # Snapshoty okien sensorów i stanu REM (warm start po restarcie); starsze snapshoty są pomijane
+    DEVICE_SNAPSHOT_DIR = os.getenv('DEVICE_SNAPSHOT_DIR')
+    DEVICE_SNAPSHOT_INTERVAL_SECONDS = int(os.getenv('DEVICE_SNAPSHOT_INTERVAL_SECONDS', '60'))
+    DEVICE_SNAPSHOT_MAX_AGE_SECONDS = int(os.getenv('DEVICE_SNAPSHOT_MAX_AGE_SECONDS', '1800'))
+
+    # Backend buforów sensorów: 'memory' (per proces), 'shared_memory' (multiprocessing.shared_memory,
+    # wspólne dla wszystkich workerów gunicorna na hoście; indeks urządzeń ma stałą liczbę slotów)
+    # albo 'redis' (stan współdzielony przez węzły za load balancerem)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'memory')
+    SHARED_MEMORY_NAMESPACE = os.getenv('SHARED_MEMORY_NAMESPACE', 'battle_unicorn')
+    SHARED_MEMORY_MAX_DEVICES = int(os.getenv('SHARED_MEMORY_MAX_DEVICES', '256'))
+
+    # Redis (STORAGE_BACKEND=redis): strumienie próbek, hashe stanu REM z pub/sub, sesje mobile z TTL;
+    # przy STORAGE_BACKEND=shared_memory Redis (np. lokalny na hoście) dzieli między workery stan bez próbek
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+    REDIS_KEY_PREFIX = os.getenv('REDIS_KEY_PREFIX', 'battle_unicorn')
+    REDIS_SAMPLE_TTL_SECONDS = int(os.getenv('REDIS_SAMPLE_TTL_SECONDS', '1800'))
+    REDIS_SESSION_TTL_SECONDS = int(os.getenv('REDIS_SESSION_TTL_SECONDS', str(24 * 3600)))
+
+    # Sharding urządzeń między węzłami (spójne haszowanie device_id -> węzeł właściciela);
+    # żądania do innego węzła są przekazywane (forward) albo przekierowywane (redirect, 307)
+    CLUSTER_NODES = os.getenv('CLUSTER_NODES', '')
+    CLUSTER_NODE_URL = os.getenv('CLUSTER_NODE_URL', '')
+    SHARD_VIRTUAL_NODES = int(os.getenv('SHARD_VIRTUAL_NODES', '64'))
+    SHARD_ROUTING = os.getenv('SHARD_ROUTING', 'forward')
+    SHARD_FORWARD_TIMEOUT_SECONDS = int(os.getenv('SHARD_FORWARD_TIMEOUT_SECONDS', '10'))
+    # Wspólny sekret węzłów - wymagany na /cluster/* i w żądaniach przekazanych przez inny węzeł
+    CLUSTER_SECRET = os.getenv('CLUSTER_SECRET', '')
+
     # Set to True to use local vendor files, False to use CDN
     USE_LOCAL_FILES = True
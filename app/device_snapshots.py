@@ -0,0 +1,227 @@
+import atexit
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+
+SNAPSHOT_MAGIC = b'DSNAP1'
+HEADER_LENGTH = struct.Struct('<I')
+
+# Pola stanu REM zapisywane w snapshocie (wersje/rewizje są lokalne dla procesu)
+REM_STATE_FIELDS = (
+    'rem_detected', 'current_rem_phase', 'total_rem_phases', 'sleep_flag', 'atonia_flag', 'last_update'
+)
+
+
+class DeviceSnapshotStore:
+    """
+    Okresowe, zwarte snapshoty okien sensorów i stanu REM urządzeń na dysku.
+
+    Po restarcie procesu urządzenie przy pierwszym żądaniu odtwarza z ostatniego snapshotu
+    okno HR (15 minut wymagane przez rem_detection) i stan REM, zamiast zbierać je od zera.
+    Każde urządzenie ma jeden plik: nagłówek JSON i surowe bajty kolumn buforów, czytane
+    przez mmap. Snapshoty starsze niż max_age_seconds są pomijane.
+
+    Źródło danych do zapisu rejestruje moduł tras (dekorator snapshot_source).
+
+    Konfiguracja (app.config):
+        DEVICE_SNAPSHOT_DIR: Katalog snapshotów
+        DEVICE_SNAPSHOT_INTERVAL_SECONDS: Odstęp zapisów w tle (0 = wyłączone)
+        DEVICE_SNAPSHOT_MAX_AGE_SECONDS: Maksymalny wiek snapshotu użytego przy starcie
+    """
+
+    def __init__(self, snapshot_dir, app=None):
+        self.snapshot_dir = snapshot_dir
+        self.interval = 60
+        self.max_age_seconds = 1800
+        self._source = None
+        self._saved_markers = {}  # device_id -> znacznik zmian z ostatniego zapisu
+        self._lock = threading.Lock()
+        self._thread = None
+        self._counters = {'saved': 0, 'restored': 0, 'stale': 0, 'errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.snapshot_dir = app.config.get('DEVICE_SNAPSHOT_DIR') or self.snapshot_dir
+        self.interval = app.config.get('DEVICE_SNAPSHOT_INTERVAL_SECONDS', self.interval)
+        self.max_age_seconds = app.config.get('DEVICE_SNAPSHOT_MAX_AGE_SECONDS', self.max_age_seconds)
+        app.extensions['device_snapshots'] = self
+        if self.interval and self._thread is None:
+            self._thread = threading.Thread(target=self._snapshot_loop, name='device-snapshots', daemon=True)
+            self._thread.start()
+            atexit.register(self.save_all)
+
+    def snapshot_source(self, source):
+        """
+        Rejestruje funkcję source() zwracającą krotki (device_id, device_storage, rem_state, marker);
+        marker zmienia się przy nowych danych urządzenia (niezmienione urządzenia nie są zapisywane)
+        """
+        self._source = source
+        return source
+
+    def _path(self, device_id):
+        name = hashlib.sha1(str(device_id).encode('utf-8')).hexdigest()
+        return os.path.join(self.snapshot_dir, f"{name}.snap")
+
+    def dumps(self, device_id, device_storage, rem_state):
+        """Snapshot urządzenia w formacie pliku (np. do przekazania innemu węzłowi)"""
+        header = {
+            'device_id': device_id,
+            'saved_at': time.time(),
+            'rem_state': {field: rem_state.get(field) for field in REM_STATE_FIELDS} if rem_state else None,
+            'transitions': list(rem_state.get('transitions', [])) if rem_state else [],
+            'buffers': {}
+        }
+        payloads = []
+        for name, buffer in device_storage.items():
+            if not hasattr(buffer, 'window'):
+                continue
+            columns = []
+            # Kopia okien pod blokadą bufora - równoległy zapis próbek nie przesunie okna w trakcie
+            with buffer.lock:
+                count = len(buffer)
+                for column in buffer.column_names:
+                    window = buffer.window(column, count)
+                    columns.append([column, window.format])
+                    payloads.append(window.tobytes())
+            header['buffers'][name] = {'count': count, 'columns': columns}
+
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        return b''.join([SNAPSHOT_MAGIC, HEADER_LENGTH.pack(len(header_bytes)), header_bytes, *payloads])
+
+    def save(self, device_id, device_storage, rem_state):
+        """Zapisuje snapshot urządzenia atomowo (plik tymczasowy + os.replace)"""
+        self._write(device_id, self.dumps(device_id, device_storage, rem_state))
+        with self._lock:
+            self._counters['saved'] += 1
+
+    def store(self, device_id, data):
+        """
+        Zapisuje snapshot otrzymany z innego węzła (przejęcie urządzenia) - odtworzy go warm start
+
+        Raises:
+            ValueError: Gdy dane nie są snapshotem tego urządzenia
+        """
+        try:
+            header, _ = _read_header(data)
+        except (ValueError, struct.error) as e:
+            raise ValueError(f"Invalid snapshot data: {e}")
+        if header.get('device_id') != device_id:
+            raise ValueError("Snapshot belongs to a different device")
+        self._write(device_id, data)
+
+    def _write(self, device_id, data):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = self._path(device_id)
+        # Unikalny plik tymczasowy - zapis w tle i przejęcie urządzenia mogą pisać równocześnie
+        fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def load(self, device_id):
+        """
+        Wczytuje świeży snapshot urządzenia
+
+        Returns:
+            dict: {'rem_state', 'transitions', 'buffers': {nazwa: {kolumna: array}}} lub None
+        """
+        path = self._path(device_id)
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                header, offset = _read_header(data)
+                if header.get('device_id') != device_id:
+                    return None
+                if time.time() - header['saved_at'] > self.max_age_seconds:
+                    with self._lock:
+                        self._counters['stale'] += 1
+                    return None
+
+                buffers = {}
+                for name, info in header['buffers'].items():
+                    buffers[name] = {}
+                    for column, typecode in info['columns']:
+                        values = array(typecode)
+                        end = offset + info['count'] * values.itemsize
+                        values.frombytes(data[offset:end])
+                        buffers[name][column] = values
+                        offset = end
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            print(f"Error reading device snapshot {path}: {e}")
+            with self._lock:
+                self._counters['errors'] += 1
+            return None
+
+        with self._lock:
+            self._counters['restored'] += 1
+        return {'rem_state': header['rem_state'], 'transitions': header['transitions'], 'buffers': buffers}
+
+    def save_all(self):
+        """Zapisuje snapshoty urządzeń, których dane zmieniły się od poprzedniego zapisu"""
+        if self._source is None:
+            return 0
+        saved = 0
+        for device_id, device_storage, rem_state, marker in self._source():
+            if self._saved_markers.get(device_id) == marker:
+                continue
+            try:
+                self.save(device_id, device_storage, rem_state)
+            except Exception as e:
+                print(f"Error saving device snapshot for {device_id}: {e}")
+                with self._lock:
+                    self._counters['errors'] += 1
+                continue
+            self._saved_markers[device_id] = marker
+            saved += 1
+        return saved
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save_all()
+            except Exception as e:
+                print(f"Error in device snapshot loop: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'snapshot_dir': self.snapshot_dir, 'interval': self.interval}
+
+
+def _read_header(data):
+    # Nagłówek JSON snapshotu i przesunięcie początku danych kolumn
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("Invalid snapshot file")
+    offset = len(SNAPSHOT_MAGIC)
+    (header_length,) = HEADER_LENGTH.unpack_from(data, offset)
+    offset += HEADER_LENGTH.size
+    header = json.loads(data[offset:offset + header_length].decode('utf-8'))
+    return header, offset + header_length
+
+
+def restore_buffer(buffer, columns):
+    """Dopisuje do pustego bufora próbki odtworzone ze snapshotu lub z bazy (od najstarszej)"""
+    names = list(columns)
+    for values in zip(*(columns[name] for name in names)):
+        buffer.append(**dict(zip(names, values)))
+    return len(buffer)
+
+
+device_snapshots = DeviceSnapshotStore(
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'cache', 'device_snapshots')
+)
@@ -0,0 +1,341 @@
+import argparse
+import fnmatch
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+
+
+class CommandError(Exception):
+    """Błąd wykonania komendy - odsyłany klientowi jako odpowiedź -ERR"""
+
+
+class _Reply:
+    # Odpowiedź w formacie RESP2
+    @staticmethod
+    def encode(value):
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, bool):
+            return b':%d\r\n' % int(value)
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, SimpleString):
+            return b'+' + value.encode('utf-8') + b'\r\n'
+        if isinstance(value, CommandError):
+            return b'-ERR ' + str(value).encode('utf-8') + b'\r\n'
+        if isinstance(value, (list, tuple)):
+            return b'*%d\r\n' % len(value) + b''.join(_Reply.encode(item) for item in value)
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        return b'$%d\r\n' % len(value) + value + b'\r\n'
+
+
+class SimpleString(str):
+    pass
+
+
+OK = SimpleString('OK')
+
+
+class FakeRedisServer:
+    """
+    Lokalny serwer protokołu Redis (RESP2) w wątku procesu - do testów i developmentu
+    backendu STORAGE_BACKEND=redis bez instalowania Redisa.
+
+    Obsługuje tylko komendy używane przez redis_store: klucze z TTL (GET, SET EX, EXPIRE,
+    DEL), zbiory, hashe (HSET, HGETALL, HINCRBY), strumienie (XADD MAXLEN, XRANGE,
+    XREVRANGE) i pub/sub (PUBLISH, SUBSCRIBE). Dane trzymane są w pamięci, bez trwałości.
+
+    Użycie:
+        server = FakeRedisServer().start()
+        app.config['REDIS_URL'] = server.url
+        ...
+        server.stop()
+
+    albo jako osobny proces: python -m app.fake_redis --port 6379
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self._data = {}  # klucz -> str | set | dict | OrderedDict (strumień)
+        self._expires = {}  # klucz -> czas wygaśnięcia (monotonic)
+        self._subscribers = {}  # kanał -> zbiór połączeń
+        self._lock = threading.RLock()
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.write_lock = threading.Lock()
+                self.channels = set()
+                try:
+                    while True:
+                        command = server._read_command(self.rfile)
+                        if command is None:
+                            break
+                        replies = server._execute(self, command)
+                        with self.write_lock:
+                            for reply in replies:
+                                self.wfile.write(_Reply.encode(reply))
+                            self.wfile.flush()
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    with server._lock:
+                        for channel in self.channels:
+                            server._subscribers.get(channel, set()).discard(self)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-redis', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def flushall(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+
+    # --- Protokół ---
+
+    @staticmethod
+    def _read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Komenda inline (np. z telnet/redis-cli)
+            return line.decode('utf-8').split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(rfile.readline()[1:])
+            args.append(rfile.read(length + 2)[:-2].decode('utf-8'))
+        return args
+
+    def _execute(self, connection, command):
+        name = command[0].upper()
+        args = command[1:]
+        if name in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+            return self._subscription(connection, name, args)
+        handler = getattr(self, f"_cmd_{name.lower()}", None)
+        if handler is None:
+            return [CommandError(f"unknown command '{command[0]}'")]
+        try:
+            with self._lock:
+                return [handler(*args)]
+        except CommandError as e:
+            return [e]
+        except (TypeError, ValueError, IndexError) as e:
+            return [CommandError(f"wrong arguments for '{command[0]}' command: {e}")]
+
+    def _subscription(self, connection, name, channels):
+        replies = []
+        with self._lock:
+            for channel in channels or list(connection.channels):
+                if name == 'SUBSCRIBE':
+                    connection.channels.add(channel)
+                    self._subscribers.setdefault(channel, set()).add(connection)
+                else:
+                    connection.channels.discard(channel)
+                    self._subscribers.get(channel, set()).discard(connection)
+                replies.append([name.lower(), channel, len(connection.channels)])
+        return replies
+
+    # --- Klucze ---
+
+    def _get(self, key, kind=None, create=False):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        value = self._data.get(key)
+        if value is None and create:
+            value = self._data[key] = kind()
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _cmd_ping(self, message=None):
+        return message if message is not None else SimpleString('PONG')
+
+    def _cmd_select(self, db):
+        return OK
+
+    def _cmd_client(self, *args):
+        return OK
+
+    def _cmd_get(self, key):
+        return self._get(key, str)
+
+    def _cmd_set(self, key, value, *options):
+        self._data[key] = value
+        self._expires.pop(key, None)
+        options = [option.upper() for option in options]
+        if 'EX' in options:
+            self._cmd_expire(key, options[options.index('EX') + 1])
+        return OK
+
+    def _cmd_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self._data[key]
+                self._expires.pop(key, None)
+                deleted += 1
+        return deleted
+
+    def _cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def _cmd_expire(self, key, seconds):
+        if self._get(key) is None:
+            return 0
+        self._expires[key] = time.monotonic() + int(seconds)
+        return 1
+
+    def _cmd_ttl(self, key):
+        if self._get(key) is None:
+            return -2
+        expires_at = self._expires.get(key)
+        return -1 if expires_at is None else int(expires_at - time.monotonic() + 0.5)
+
+    def _cmd_keys(self, pattern):
+        return [key for key in list(self._data) if self._get(key) is not None and fnmatch.fnmatchcase(key, pattern)]
+
+    def _cmd_flushall(self, *args):
+        self.flushall()
+        return OK
+
+    # --- Zbiory i hashe ---
+
+    def _cmd_sadd(self, key, *members):
+        values = self._get(key, set, create=True)
+        before = len(values)
+        values.update(members)
+        return len(values) - before
+
+    def _cmd_smembers(self, key):
+        return sorted(self._get(key, set) or ())
+
+    def _cmd_hset(self, key, *pairs):
+        values = self._get(key, dict, create=True)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in values
+            values[field] = value
+        return added
+
+    def _cmd_hgetall(self, key):
+        values = self._get(key, dict) or {}
+        return [item for pair in values.items() for item in pair]
+
+    def _cmd_hincrby(self, key, field, increment):
+        values = self._get(key, dict, create=True)
+        values[field] = str(int(values.get(field, 0)) + int(increment))
+        return int(values[field])
+
+    # --- Strumienie ---
+
+    @staticmethod
+    def _parse_id(entry_id, default_seq):
+        exclusive = entry_id.startswith('(')
+        entry_id = entry_id.lstrip('(')
+        if entry_id == '-':
+            return (0, 0), exclusive
+        if entry_id == '+':
+            return (float('inf'), 0), exclusive
+        ms, _, seq = entry_id.partition('-')
+        return (int(ms), int(seq) if seq else default_seq), exclusive
+
+    def _cmd_xadd(self, key, *args):
+        args = list(args)
+        maxlen = None
+        if args[0].upper() == 'MAXLEN':
+            args.pop(0)
+            if args[0] in ('~', '='):
+                args.pop(0)
+            maxlen = int(args.pop(0))
+        entry_id = args.pop(0)
+        stream = self._get(key, OrderedDict, create=True)
+        last = next(reversed(stream)) if stream else (0, 0)
+        if entry_id == '*':
+            ms = int(time.time() * 1000)
+            new_id = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+        else:
+            new_id, _ = self._parse_id(entry_id, 0)
+            if new_id <= last:
+                raise CommandError("The ID specified in XADD is equal or smaller than the target stream top item")
+        stream[new_id] = list(args)
+        if maxlen is not None:
+            while len(stream) > maxlen:
+                stream.popitem(last=False)
+        return f"{new_id[0]}-{new_id[1]}"
+
+    def _stream_range(self, key, start, end, count, reverse):
+        stream = self._get(key, OrderedDict) or OrderedDict()
+        (start, start_exclusive) = self._parse_id(start, 0)
+        (end, end_exclusive) = self._parse_id(end, float('inf'))
+        entries = []
+        for entry_id in (reversed(stream) if reverse else stream):
+            if entry_id < start or (start_exclusive and entry_id == start):
+                continue
+            if entry_id > end or (end_exclusive and entry_id == end):
+                continue
+            entries.append([f"{entry_id[0]}-{entry_id[1]}", stream[entry_id]])
+            if count is not None and len(entries) >= count:
+                break
+        return entries
+
+    def _cmd_xrange(self, key, start, end, *options):
+        count = int(options[1]) if options and options[0].upper() == 'COUNT' else None
+        return self._stream_range(key, start, end, count, reverse=False)
+
+    def _cmd_xrevrange(self, key, end, start, *options):
+        count = int(options[1]) if options and options[0].upper() == 'COUNT' else None
+        return self._stream_range(key, start, end, count, reverse=True)
+
+    def _cmd_xlen(self, key):
+        return len(self._get(key, OrderedDict) or ())
+
+    # --- Pub/sub ---
+
+    def _cmd_publish(self, channel, message):
+        subscribers = list(self._subscribers.get(channel, ()))
+        payload = _Reply.encode(['message', channel, message])
+        delivered = 0
+        for subscriber in subscribers:
+            try:
+                with subscriber.write_lock:
+                    subscriber.wfile.write(payload)
+                    subscriber.wfile.flush()
+                delivered += 1
+            except OSError:
+                self._subscribers[channel].discard(subscriber)
+        return delivered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Lokalny serwer zgodny z Redis do developmentu")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    arguments = parser.parse_args()
+    fake_server = FakeRedisServer(arguments.host, arguments.port)
+    print(f"Fake Redis nasłuchuje na {fake_server.url}")
+    fake_server.serve_forever()
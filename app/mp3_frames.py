@@ -0,0 +1,205 @@
+import os
+from array import array
+
+# Bitrate (kbps) dla MPEG Layer III wg indeksu z nagłówka ramki
+MPEG1_L3_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+MPEG2_L3_BITRATES = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+MPEG1_SAMPLE_RATES = (44100, 48000, 32000)
+
+# Bity wersji z nagłówka: 3 = MPEG1, 2 = MPEG2, 0 = MPEG2.5 (1 zarezerwowane)
+MPEG_VERSION_DIVISORS = {3: 1, 2: 2, 0: 4}
+
+ID3V1_SIZE = 128
+APE_FOOTER_SIZE = 32
+
+# os.writev przyjmuje ograniczoną liczbę buforów w jednym wywołaniu
+WRITEV_BATCH = 512
+
+
+def _id3v2_size(data, offset):
+    # Rozmiar tagu ID3v2 (nagłówek + ewentualna stopka) albo 0 gdy go nie ma
+    if data[offset:offset + 3] != b'ID3' or len(data) - offset < 10:
+        return 0
+    size = 0
+    for byte in data[offset + 6:offset + 10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[offset + 5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _audio_end(data):
+    # Koniec danych audio - pomijamy ID3v1 i APEv2 doklejone na końcu pliku
+    end = len(data)
+    if end >= ID3V1_SIZE and data[end - ID3V1_SIZE:end - ID3V1_SIZE + 3] == b'TAG':
+        end -= ID3V1_SIZE
+    if end >= APE_FOOTER_SIZE and data[end - APE_FOOTER_SIZE:end - APE_FOOTER_SIZE + 8] == b'APETAGEX':
+        footer = end - APE_FOOTER_SIZE
+        tag_size = int.from_bytes(data[footer + 12:footer + 16], 'little')
+        flags = int.from_bytes(data[footer + 20:footer + 24], 'little')
+        has_header = bool(flags & 0x80000000)
+        end = max(0, end - tag_size - (APE_FOOTER_SIZE if has_header else 0))
+    return end
+
+
+def parse_frame_header(data, offset):
+    """
+    Dekoduje 4-bajtowy nagłówek ramki MPEG Layer III
+
+    Returns:
+        dict: {'length', 'sample_rate', 'samples'} albo None gdy to nie jest poprawna ramka
+    """
+    if offset + 4 > len(data):
+        return None
+    b0, b1, b2 = data[offset], data[offset + 1], data[offset + 2]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version not in MPEG_VERSION_DIVISORS or layer != 1:
+        return None
+    if bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    divisor = MPEG_VERSION_DIVISORS[version]
+    sample_rate = MPEG1_SAMPLE_RATES[sample_rate_index] // divisor
+    padding = (b2 >> 1) & 0x01
+    if version == 3:
+        bitrate = MPEG1_L3_BITRATES[bitrate_index] * 1000
+        length = 144 * bitrate // sample_rate + padding
+        samples = 1152
+    else:
+        bitrate = MPEG2_L3_BITRATES[bitrate_index] * 1000
+        length = 72 * bitrate // sample_rate + padding
+        samples = 576
+    return {'length': length, 'sample_rate': sample_rate, 'samples': samples}
+
+
+def _is_vbr_info_frame(data, offset, length):
+    # Ramka Xing/Info/VBRI opisuje długość jednego pliku - po sklejeniu byłaby nieprawdziwa
+    frame = bytes(data[offset:offset + min(length, 64)])
+    return b'Xing' in frame or b'Info' in frame or b'VBRI' in frame
+
+
+def scan_mp3_frames(data):
+    """
+    Jednokrotnie wyznacza granice ramek audio w pliku MP3 (bez tagów ID3/APE i ramki Xing/Info)
+
+    Args:
+        data (bytes): Zawartość pliku MP3
+
+    Returns:
+        dict: {
+            'offsets': array('Q') początków ramek + końca ostatniej ramki,
+            'frame_count', 'sample_rate', 'samples_per_frame', 'frame_seconds'
+        }
+
+    Raises:
+        ValueError: Gdy w danych nie ma ramek MPEG Layer III
+    """
+    data = memoryview(data)
+    offset = 0
+    while True:
+        tag_size = _id3v2_size(data, offset)
+        if not tag_size:
+            break
+        offset += tag_size
+    end = _audio_end(data)
+
+    # Synchronizacja z pierwszą ramką (mogą ją poprzedzać śmieci lub zerowe wypełnienie)
+    while offset < end and parse_frame_header(data, offset) is None:
+        offset += 1
+
+    offsets = array('Q')
+    first = None
+    while offset < end:
+        header = parse_frame_header(data, offset)
+        if header is None or offset + header['length'] > end:
+            break
+        if first is None:
+            first = header
+            if _is_vbr_info_frame(data, offset, header['length']):
+                offset += header['length']
+                continue
+        offsets.append(offset)
+        offset += header['length']
+
+    if not offsets:
+        raise ValueError("No MPEG Layer III frames found")
+    offsets.append(offset)
+
+    return {
+        'offsets': offsets,
+        'frame_count': len(offsets) - 1,
+        'sample_rate': first['sample_rate'],
+        'samples_per_frame': first['samples'],
+        'frame_seconds': first['samples'] / first['sample_rate']
+    }
+
+
+def mp3_duration_ms(data):
+    """Długość pliku MP3 w ms wyliczona z liczby ramek (None gdy nie rozpoznano ramek)"""
+    try:
+        info = scan_mp3_frames(data)
+    except ValueError:
+        return None
+    return int(round(info['frame_count'] * info['frame_seconds'] * 1000))
+
+
+def plan_looped_frames(data, target_seconds):
+    """
+    Wyznacza bufory potrzebne do zapętlenia pliku MP3 do target_seconds z dokładnością do ramki
+
+    Returns:
+        list: Widoki memoryview (pełne pętle wskazują na ten sam bufor, bez kopiowania)
+    """
+    view = memoryview(data)
+    try:
+        info = scan_mp3_frames(view)
+    except ValueError:
+        # Nie rozpoznano ramek - powtarzamy surowe bajty (jak wcześniej), ale bez kopiowania
+        print("MP3 frames not recognized - repeating raw bytes")
+        loop_seconds = 30
+        repetitions = max(1, int(target_seconds // loop_seconds))
+        return [view] * repetitions
+
+    offsets = info['offsets']
+    frames_needed = max(1, int(round(target_seconds / info['frame_seconds'])))
+    full_loops, remainder = divmod(frames_needed, info['frame_count'])
+
+    payload = view[offsets[0]:offsets[-1]]
+    parts = [payload] * full_loops
+    if remainder:
+        parts.append(view[offsets[0]:offsets[remainder]])
+    return parts
+
+
+def write_buffers(fd, buffers):
+    """Zapisuje bufory do deskryptora pliku - os.writev w paczkach gdy dostępny"""
+    writev = getattr(os, 'writev', None)
+    pending = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while pending:
+        if writev is None:
+            written = os.write(fd, pending[0])
+        else:
+            written = writev(fd, pending[:WRITEV_BATCH])
+        # Częściowy zapis - przesuwamy się o zapisane bajty
+        while written and pending:
+            if written >= len(pending[0]):
+                written -= len(pending[0])
+                pending.pop(0)
+            else:
+                pending[0] = pending[0][written:]
+                written = 0
+
+
+def join_buffers(buffers):
+    """Skleja bufory do jednego prealokowanego bufora (jedno kopiowanie każdego bajtu)"""
+    total = sum(len(buffer) for buffer in buffers)
+    output = bytearray(total)
+    position = 0
+    for buffer in buffers:
+        output[position:position + len(buffer)] = buffer
+        position += len(buffer)
+    return output
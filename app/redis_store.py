@@ -0,0 +1,351 @@
+import json
+import threading
+import time
+import uuid
+
+try:
+    import redis
+except ImportError:  # Opcjonalna zależność - wymagana tylko przy STORAGE_BACKEND=redis/shared_memory
+    redis = None
+
+# Pola stanu REM zapisywane w hashu urządzenia (wersja liczona osobno przez HINCRBY)
+REM_STATE_FIELDS = (
+    'rem_detected', 'current_rem_phase', 'total_rem_phases', 'sleep_flag', 'atonia_flag', 'last_update'
+)
+# Pola sesji mobile lokalne dla węzła (nie są zapisywane w Redis)
+LOCAL_SESSION_FIELDS = ('revision',)
+
+
+def _stream_id(entry_id):
+    # Identyfikator wpisu strumienia 'ms-seq' jako krotka (porównywanie kolejności)
+    ms, _, seq = entry_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
+class RedisStore:
+    """
+    Współdzielony stan węzłów API w Redis (STORAGE_BACKEND=redis).
+
+    Przy STORAGE_BACKEND=shared_memory magazyn dzieli między workery hosta stan REM i sesje
+    mobile, a strumienie próbek są wyłączone (bufory sensorów leżą już w pamięci współdzielonej).
+
+    Węzły za load balancerem nie muszą trzymać urządzenia ani sesji - każdy może obsłużyć
+    dowolne żądanie:
+        - okna próbek sensorów to strumienie ograniczone do pojemności bufora (XADD MAXLEN ~);
+          lokalne bufory węzła są dociągane od ostatnio przeczytanego wpisu (XRANGE),
+        - stan REM urządzenia to hash z wersją (HINCRBY) - zmiana publikowana jest na kanale
+          pub/sub, a inne węzły budzą swoich klientów long-poll/SSE,
+        - sesje mobile to dokumenty JSON z TTL oraz zbiór sesji połączonych z urządzeniem,
+        - handle audio i rekordy zadań audio to dokumenty JSON z TTL (pliki audio leżą
+          na wspólnym wolumenie, np. audio_files w docker-compose).
+
+    Każda operacja to jeden pipeline (jedna podróż do serwera), także dla paczki próbek.
+    Lokalne bufory i słowniki w shared_storage pozostają cache'em - ścieżka gorąca nie
+    czeka na Redis dłużej niż jeden round-trip.
+
+    Konfiguracja (app.config):
+        STORAGE_BACKEND: 'redis' włącza magazyn, 'shared_memory' - magazyn bez strumieni próbek
+        REDIS_URL: Adres serwera Redis
+        REDIS_KEY_PREFIX: Prefiks kluczy i kanału (oddziela instancje aplikacji)
+        REDIS_SAMPLE_TTL_SECONDS: Czas życia strumieni próbek nieaktywnego urządzenia
+        REDIS_SESSION_TTL_SECONDS: Czas życia sesji mobile i stanu REM bez aktywności
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.share_samples = False
+        self.client = None
+        self.prefix = 'battle_unicorn'
+        self.sample_ttl = 1800
+        self.session_ttl = 24 * 3600
+        self.node_id = uuid.uuid4().hex[:12]
+        self._last_ids = {}  # klucz strumienia -> ostatni przeczytany wpis
+        self._own_ids = {}  # klucz strumienia -> wpisy dodane przez ten węzeł, jeszcze nieprzeczytane
+        self._device_locks = {}
+        self._lock = threading.Lock()
+        self._session_touched = {}  # mobile_id -> czas ostatniego przedłużenia TTL
+        self._rem_listeners = []
+        self._subscriber = None
+        self._counters = {'samples_published': 0, 'samples_synced': 0, 'rem_events_received': 0, 'errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend_name = app.config.get('STORAGE_BACKEND')
+        self.enabled = backend_name in ('redis', 'shared_memory')
+        self.share_samples = backend_name == 'redis'
+        self.prefix = app.config.get('REDIS_KEY_PREFIX', self.prefix)
+        self.sample_ttl = app.config.get('REDIS_SAMPLE_TTL_SECONDS', self.sample_ttl)
+        self.session_ttl = app.config.get('REDIS_SESSION_TTL_SECONDS', self.session_ttl)
+        if self.enabled:
+            if redis is None:
+                raise RuntimeError(f"STORAGE_BACKEND={backend_name} requires the 'redis' package (pip install redis)")
+            # RESP2 - działa z każdą wersją serwera (także z lokalnym app.fake_redis)
+            self.client = redis.Redis.from_url(app.config.get('REDIS_URL'), decode_responses=True, protocol=2)
+            self._start_subscriber()
+        app.extensions['redis_store'] = self
+
+    def key(self, *parts):
+        return ':'.join((self.prefix,) + tuple(str(part) for part in parts))
+
+    def _run(self, action, func, *args, **kwargs):
+        # Redis niedostępny - węzeł obsługuje żądanie na danych lokalnych (zwraca None)
+        try:
+            return func(*args, **kwargs)
+        except redis.RedisError as e:
+            self._counters['errors'] += 1
+            print(f"Redis error ({action}): {e}")
+            return None
+
+    def _device_lock(self, device_id):
+        lock = self._device_locks.get(device_id)
+        if lock is None:
+            with self._lock:
+                lock = self._device_locks.setdefault(device_id, threading.Lock())
+        return lock
+
+    # --- Próbki sensorów (strumienie) ---
+
+    def publish_samples(self, kind, device_id, buffer, samples):
+        """
+        Dopisuje do strumienia urządzenia próbki dopisane do lokalnego bufora (jeden pipeline)
+
+        Args:
+            kind (str): Rodzaj próbek ('hr', 'mpu', 'emg')
+            device_id (str): Urządzenie
+            buffer: Bufor SensorRingBuffer, do którego właśnie dodano próbki
+            samples: SampleBatch zwrócony przez add_samples bufora
+        """
+        if not self.share_samples or not samples:
+            return
+        names = buffer.column_names
+        key = self.key('samples', kind, device_id)
+        with self._device_lock(device_id):
+            pipe = self.client.pipeline(transaction=False)
+            for values in samples.rows(names):
+                pipe.xadd(key, dict(zip(names, map(repr, values))), maxlen=buffer.capacity, approximate=True)
+            pipe.expire(key, self.sample_ttl)
+            results = self._run('publish samples', pipe.execute)
+            if results is None:
+                return
+            entry_ids = results[:-1]
+            # Własne wpisy pomijamy przy dociąganiu - są już w lokalnym buforze
+            self._own_ids.setdefault(key, set()).update(entry_ids)
+        self._counters['samples_published'] += len(entry_ids)
+
+    def sync_device(self, device_id, device_storage):
+        """
+        Dopisuje do lokalnych buforów urządzenia próbki zapisane przez inne węzły
+        (wszystkie bufory w jednym pipeline; przy pierwszym odczycie - całe okno)
+
+        Returns:
+            int: Liczba dociągniętych próbek
+        """
+        if not self.share_samples:
+            return 0
+        buffers = [buffer for buffer in device_storage.values() if hasattr(buffer, 'window')]
+        keys = [self.key('samples', buffer.KIND, device_id) for buffer in buffers]
+        added = 0
+        with self._device_lock(device_id):
+            pipe = self.client.pipeline(transaction=False)
+            for key, buffer in zip(keys, buffers):
+                last_id = self._last_ids.get(key)
+                if last_id is None:
+                    pipe.xrevrange(key, count=buffer.capacity)
+                else:
+                    pipe.xrange(key, min=f"({last_id}")
+            results = self._run('sync samples', pipe.execute)
+            if results is None:
+                return 0
+
+            for key, buffer, entries in zip(keys, buffers, results):
+                if not entries:
+                    continue
+                if key not in self._last_ids:
+                    entries.reverse()
+                own_ids = self._own_ids.get(key, set())
+                with buffer.lock:
+                    for entry_id, fields in entries:
+                        if entry_id in own_ids:
+                            own_ids.discard(entry_id)
+                            continue
+                        buffer.append(**{name: float(value) for name, value in fields.items()})
+                        added += 1
+                    buffer.evict_expired()
+                last_id = self._last_ids[key] = entries[-1][0]
+                if own_ids:
+                    # Własne wpisy obcięte przez MAXLEN przed odczytem nie wrócą
+                    last = _stream_id(last_id)
+                    own_ids.difference_update([entry_id for entry_id in own_ids if _stream_id(entry_id) <= last])
+        self._counters['samples_synced'] += added
+        return added
+
+    # --- Stan REM (hash + pub/sub) ---
+
+    def save_rem_state(self, device_id, rem_state, bump_version=False):
+        """
+        Zapisuje stan REM urządzenia i powiadamia inne węzły (jeden pipeline)
+
+        Returns:
+            int: Wersja stanu w Redis (wspólny kursor long-poll węzłów) lub None gdy jej nie podbito
+        """
+        if not self.enabled:
+            return None
+        key = self.key('rem', device_id)
+        mapping = {field: json.dumps(rem_state.get(field)) for field in REM_STATE_FIELDS}
+        mapping['transitions'] = json.dumps(list(rem_state.get('transitions', [])))
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hset(key, mapping=mapping)
+        if bump_version:
+            pipe.hincrby(key, 'version', 1)
+        pipe.expire(key, self.session_ttl)
+        pipe.publish(self.key('rem_events'), json.dumps({'device_id': device_id, 'node': self.node_id}))
+        results = self._run('save REM state', pipe.execute)
+        return results[1] if results and bump_version else None
+
+    def load_rem_state(self, device_id):
+        """
+        Returns:
+            dict: Pola stanu REM, 'transitions' i 'version' albo None gdy urządzenia nie ma w Redis
+        """
+        if not self.enabled:
+            return None
+        data = self._run('load REM state', self.client.hgetall, self.key('rem', device_id))
+        if not data:
+            return None
+        state = {field: json.loads(data[field]) for field in REM_STATE_FIELDS if field in data}
+        state['transitions'] = json.loads(data.get('transitions', '[]'))
+        state['version'] = int(data.get('version', 0))
+        return state
+
+    def rem_state_listener(self, listener):
+        """Rejestruje funkcję listener(device_id) wywoływaną po zmianie stanu REM na innym węźle"""
+        self._rem_listeners.append(listener)
+        return listener
+
+    def _start_subscriber(self):
+        if self._subscriber is None:
+            self._subscriber = threading.Thread(target=self._subscriber_loop, name='redis-rem-events', daemon=True)
+            self._subscriber.start()
+
+    def _subscriber_loop(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.key('rem_events'))
+                for message in pubsub.listen():
+                    event = json.loads(message['data'])
+                    if event.get('node') == self.node_id:
+                        continue
+                    self._counters['rem_events_received'] += 1
+                    for listener in self._rem_listeners:
+                        try:
+                            listener(event['device_id'])
+                        except Exception as e:
+                            print(f"Error in REM state listener for {event['device_id']}: {e}")
+            except Exception as e:
+                self._counters['errors'] += 1
+                print(f"Redis subscriber error: {e} - reconnecting")
+                time.sleep(1)
+
+    # --- Sesje mobile (JSON z TTL) ---
+
+    def save_mobile_session(self, mobile_id, mobile_session):
+        """Zapisuje sesję mobile z TTL i dopisuje ją do zbioru sesji połączonego urządzenia"""
+        if not self.enabled:
+            return
+        mobile_session['sync_id'] = uuid.uuid4().hex
+        # Kopie zagnieżdżonych słowników - prepared_audio uzupełniają równolegle zadania w tle
+        data = {
+            key: dict(value) if isinstance(value, dict) else value
+            for key, value in list(mobile_session.items()) if key not in LOCAL_SESSION_FIELDS
+        }
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self.key('mobile', mobile_id), json.dumps(data, default=str), ex=self.session_ttl)
+        device_id = mobile_session.get('device_id')
+        if device_id:
+            devices_key = self.key('device_sessions', device_id)
+            pipe.sadd(devices_key, mobile_id)
+            pipe.expire(devices_key, self.session_ttl)
+        if self._run('save mobile session', pipe.execute) is None:
+            return
+        self._session_touched[mobile_id] = time.monotonic()
+
+    def load_mobile_sessions(self, mobile_ids):
+        """
+        Returns:
+            dict: mobile_id -> dane sesji (tylko istniejące; jeden pipeline dla wszystkich sesji)
+        """
+        if not self.enabled or not mobile_ids:
+            return {}
+        mobile_ids = list(mobile_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for mobile_id in mobile_ids:
+            pipe.get(self.key('mobile', mobile_id))
+        results = self._run('load mobile sessions', pipe.execute) or []
+        return {mobile_id: json.loads(data) for mobile_id, data in zip(mobile_ids, results) if data}
+
+    def load_device_sessions(self, device_id):
+        """Sesje mobile połączone z urządzeniem (SMEMBERS + GET w dwóch pipeline'ach)"""
+        if not self.enabled:
+            return {}
+        mobile_ids = self._run('load device sessions', self.client.smembers, self.key('device_sessions', device_id))
+        return self.load_mobile_sessions(mobile_ids)
+
+    def touch_mobile_session(self, mobile_id):
+        """Przedłuża TTL sesji mobile (polling) - najwyżej raz na 1/10 TTL per sesja"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self._session_touched.get(mobile_id, 0) < self.session_ttl / 10:
+            return
+        self._session_touched[mobile_id] = now
+        self._run('touch mobile session', self.client.expire, self.key('mobile', mobile_id), self.session_ttl)
+
+    # --- Handle audio i rekordy zadań (JSON z TTL) ---
+
+    def save_audio_handle(self, entry):
+        """Zapisuje handle audio do jego wygaśnięcia (pobieranie i playlista działają na każdym węźle)"""
+        if not self.enabled:
+            return
+        ttl = max(1, int(entry['expires_at'] - time.time()))
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self.key('audio_handle', entry['handle_id']), json.dumps(entry, default=str), ex=ttl)
+        if entry.get('source_key') is not None:
+            pipe.set(self.key('audio_handle_source', entry['source_key']), entry['handle_id'], ex=ttl)
+        self._run('save audio handle', pipe.execute)
+
+    def load_audio_handle(self, handle_id=None, source_key=None):
+        """
+        Returns:
+            dict: Wpis handle zapisany przez dowolny węzeł (po handle_id albo kluczu źródła) lub None
+        """
+        if not self.enabled:
+            return None
+        if handle_id is None:
+            handle_id = self._run('find audio handle', self.client.get, self.key('audio_handle_source', source_key))
+            if not handle_id:
+                return None
+        data = self._run('load audio handle', self.client.get, self.key('audio_handle', handle_id))
+        return json.loads(data) if data else None
+
+    def save_audio_job(self, job):
+        """Zapisuje rekord zadania audio (status i wynik widoczne na każdym węźle przez session_ttl)"""
+        if not self.enabled:
+            return
+        self._run(
+            'save audio job', self.client.set,
+            self.key('audio_job', job['job_id']), json.dumps(job, default=str), ex=self.session_ttl
+        )
+
+    def load_audio_job(self, job_id):
+        if not self.enabled:
+            return None
+        data = self._run('load audio job', self.client.get, self.key('audio_job', job_id))
+        return json.loads(data) if data else None
+
+    def stats(self):
+        return {**self._counters, 'enabled': self.enabled, 'share_samples': self.share_samples, 'node_id': self.node_id}
+
+
+redis_store = RedisStore()
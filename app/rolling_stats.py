@@ -0,0 +1,91 @@
+from collections import deque
+
+
+class RollingWindowStats:
+    """
+    Statystyki kroczące (średnia, min, max, liczba próbek) dla okna ostatnich `size` próbek.
+
+    Obiekt nie przechowuje samych próbek - wywołujący (bufor cykliczny) podaje wartość, która
+    wypada z okna. Średnia liczona jest z sumy bieżącej, min/max z kolejek monotonicznych,
+    więc zarówno aktualizacja jak i odczyt kosztują zamortyzowane O(1).
+
+    Args:
+        size (int): Długość okna w próbkach
+    """
+
+    def __init__(self, size):
+        if size <= 0:
+            raise ValueError("size must be positive")
+        self.size = size
+        self.count = 0
+        self._sum = 0.0
+        self._index = 0  # numer kolejnej próbki
+        self._min = deque()  # (index, value) rosnąco po wartości
+        self._max = deque()  # (index, value) malejąco po wartości
+        self._pushes_since_resync = 0
+
+    def push(self, value, leaving=None):
+        """
+        Dodaje próbkę do okna
+
+        Args:
+            value (float): Nowa wartość
+            leaving (float): Wartość wypadająca z okna (None gdy okno nie jest jeszcze pełne)
+        """
+        value = float(value)
+        index = self._index
+        self._index += 1
+
+        self._sum += value
+        if leaving is not None and self.count == self.size:
+            self._sum -= leaving
+        else:
+            self.count += 1
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((index, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((index, value))
+
+        oldest_index = index - self.size + 1
+        if self._min[0][0] < oldest_index:
+            self._min.popleft()
+        if self._max[0][0] < oldest_index:
+            self._max.popleft()
+
+        self._pushes_since_resync += 1
+
+    def needs_resync(self):
+        """Czy sumę należy przeliczyć od nowa (ogranicza dryf błędów zmiennoprzecinkowych)"""
+        return self._pushes_since_resync >= self.size
+
+    def resync(self, values):
+        """Przelicza sumę dokładnie z aktualnych wartości okna"""
+        self._sum = float(sum(values))
+        self._pushes_since_resync = 0
+
+    def reset(self):
+        self.count = 0
+        self._sum = 0.0
+        self._index = 0
+        self._min.clear()
+        self._max.clear()
+        self._pushes_since_resync = 0
+
+    @property
+    def is_full(self):
+        return self.count >= self.size
+
+    @property
+    def mean(self):
+        return self._sum / self.count if self.count else 0.0
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._min else 0.0
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._max else 0.0
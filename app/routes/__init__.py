@@ -1,5 +1,6 @@
 from .main import main_bp
 from .embedded import embedded_bp
 from .mobile import mobile_bp
+from .cluster import cluster_bp
 
-__all__ = ['main_bp', 'mobile_bp', 'embedded_bp']
+__all__ = ['main_bp', 'mobile_bp', 'embedded_bp', 'cluster_bp']
@@ -0,0 +1,97 @@
+from flask import Blueprint, jsonify, request
+from ..shard_map import shard_router, FORWARDED_HEADER
+from ..device_snapshots import device_snapshots
+import httpx
+
+from .embedded import shared_storage, get_device_lock, release_device
+
+cluster_bp = Blueprint('cluster', __name__)
+
+@cluster_bp.before_request
+def require_cluster_secret():
+    """Endpointy klastra (lista węzłów, przejęcie urządzeń) tylko dla węzłów znających CLUSTER_SECRET"""
+    if not shard_router.authorized():
+        return jsonify({"error": "Invalid cluster secret"}), 403
+    return None
+
+@cluster_bp.route('/cluster/nodes', methods=['GET'])
+def cluster_nodes():
+    """Mapa shardów tego węzła: lista węzłów, tryb routingu i liczniki"""
+    return jsonify({
+        **shard_router.stats(),
+        'local_devices': sorted(shared_storage['devices'])
+    })
+
+@cluster_bp.route('/cluster/nodes', methods=['PUT'])
+def set_cluster_nodes():
+    """
+    Zmienia listę węzłów (dołączenie/odejście węzła) i przenosi shardy.
+    Żądanie od klienta jest rozsyłane do pozostałych węzłów starej i nowej listy.
+
+    Body: {"nodes": ["http://api-1:5000", "http://api-2:5000", ...]}
+    """
+    data = request.get_json(silent=True) or {}
+    nodes = data.get('nodes')
+    if not isinstance(nodes, list) or not all(isinstance(node, str) for node in nodes):
+        return jsonify({"error": "Pole 'nodes' musi być listą adresów węzłów"}), 400
+
+    broadcast = {}
+    if not request.headers.get(FORWARDED_HEADER):
+        # Najpierw pozostałe węzły - każdy oddaje urządzenia, które przestały do niego należeć
+        peers = (set(shard_router.ring.nodes) | {node.strip().rstrip('/') for node in nodes}) - {shard_router.node_url}
+        for peer in sorted(peers):
+            try:
+                response = shard_router.forward(peer, 'PUT', '/cluster/nodes', request.get_data(), 'application/json')
+                broadcast[peer] = response.status_code
+            except httpx.HTTPError as e:
+                print(f"Nie udało się przekazać listy węzłów do {peer}: {e}")
+                broadcast[peer] = None
+
+    result = shard_router.set_nodes(nodes)
+    return jsonify({**shard_router.stats(), **result, 'broadcast': broadcast})
+
+@cluster_bp.route('/cluster/handoff/<device_id>', methods=['POST'])
+def receive_device_handoff(device_id):
+    """
+    Przejęcie urządzenia od poprzedniego właściciela: snapshot okien sensorów i stanu REM
+    (format device_snapshots) zapisywany lokalnie - odtworzy go warm start przy pierwszym żądaniu
+    """
+    with get_device_lock(device_id):
+        release_device(device_id)
+        try:
+            device_snapshots.store(device_id, request.get_data())
+        except (ValueError, OSError) as e:
+            return jsonify({"error": f"Niepoprawny snapshot urządzenia: {e}"}), 400
+    return jsonify({"status": "accepted", "device_id": device_id})
+
+@shard_router.rebalance_handler
+def hand_off_devices():
+    """
+    Oddaje nowym właścicielom urządzenia, które po zmianie listy węzłów nie należą do tego węzła.
+    Gdy właściciel nie przyjmie snapshotu, stan zostaje lokalnie (żądania trafią tu jako fallback).
+    """
+    handed_off = []
+    failed = []
+    for device_id in list(shared_storage['devices']):
+        if shard_router.is_local(device_id):
+            continue
+        owner = shard_router.owner(device_id)
+        with get_device_lock(device_id):
+            device_storage = shared_storage['devices'].get(device_id)
+            if device_storage is None:
+                continue
+            data = device_snapshots.dumps(device_id, device_storage, shared_storage['rem_states'].get(device_id))
+            try:
+                response = shard_router.forward(
+                    owner, 'POST', f"/cluster/handoff/{device_id}", data, 'application/octet-stream'
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                print(f"Przekazanie urządzenia {device_id} do {owner} nie powiodło się: {e}")
+                failed.append(device_id)
+                continue
+            release_device(device_id)
+        handed_off.append(device_id)
+    if handed_off:
+        print(f"Przekazano {len(handed_off)} urządzeń nowym właścicielom")
+    return {'handed_off': handed_off, 'handoff_failed': failed}
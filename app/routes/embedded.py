@@ -1,26 +1,48 @@
-from flask import Blueprint, jsonify, request, session
+from flask import Blueprint, jsonify, request, session, current_app, has_app_context
 from ..rem_detection import rem_detection, get_hr_stats
 from ..sound_gen import generate_sound
+from ..audio_jobs import audio_jobs, JobQueueFull, PRIORITY_REM
+from ..audio_handles import audio_handles
+from ..sample_writer import sample_writer
+from ..device_snapshots import device_snapshots, restore_buffer
+from ..storage_backends import storage_backends
+from ..redis_store import redis_store
+from ..shard_map import shard_router
+from ..sensor_buffers import HrRingBuffer, MpuRingBuffer, EmgRingBuffer, HR_WINDOW_SAMPLES
+from collections import deque
+from itertools import count
 from datetime import datetime
+import threading
+import time
+
+# Maksymalna liczba przejść REM zapamiętywanych per urządzenie
+REM_TRANSITION_LOG_SIZE = 100
 
 # Shared In-Memory Storage dla komunikacji między embedded i mobile
 # W produkcji należy użyć bazy danych lub Redis
+# Bufory sensorów alokuje storage_backends (STORAGE_BACKEND=shared_memory - wspólne dla workerów na hoście);
+# przy STORAGE_BACKEND=redis i shared_memory poniższe słowniki są lokalnym cache'em stanu współdzielonego
+# przez redis_store (przy shared_memory przez Redis nie idą próbki - bufory są już wspólne)
 shared_storage = {
     # Dane sensorowe per device_id
-    'devices': {},  # device_id -> {'hr_history': [], 'mpu_history': [], 'emg_history': [], 'last_update': ''}
+    'devices': {},  # device_id -> {'hr_history': HrRingBuffer, 'mpu_history': MpuRingBuffer, 'emg_history': EmgRingBuffer, 'last_update': ''}
+    
+    # Stan REM per device_id (maszyna stanów, numeracja faz, log przejść, statystyki)
+    'rem_states': {},  # device_id -> {'rem_detected': bool, 'current_rem_phase': int, 'total_rem_phases': int, 'transitions': deque, ...}
     
-    # Aktualny stan REM (globalny lub per device)
+    # Ostatni zaktualizowany stan REM (kompatybilność wsteczna dla klientów bez device_id)
     'current_rem_state': {
         'rem_detected': False,
         'current_rem_phase': 0,
         'sleep_flag': False,
         'atonia_flag': False,
         'last_device_id': None,
-        'last_update': None
+        'last_update': None,
+        'revision': 0
     },
     
     # Mobile sessions połączone z device_id
-    'mobile_sessions': {},  # mobile_id -> {'device_id': '', 'dream_scenarios': [], 'last_polling': ''}
+    'mobile_sessions': {},  # mobile_id -> {'device_id': '', 'dream_scenarios': [], 'prepared_audio': {}, 'last_polling': ''}
     
     # Statystyki globalne
     'global_stats': {
@@ -32,28 +54,333 @@ shared_storage = {
 
 embedded_bp = Blueprint('embedded', __name__)
 
+# Blokady per urządzenie - chronią read-modify-write stanu REM przy równoległych żądaniach
+_device_locks = {}
+_device_conditions = {}
+_revision_counter = count(1)
+_device_locks_guard = threading.Lock()
+
+def get_config_value(name, default=None):
+    """Pobiera wartość z konfiguracji aplikacji (działa też poza kontekstem aplikacji)"""
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return default
+
 def get_device_storage(device_id):
     """Pobiera storage dla danego device_id, tworzy jeśli nie istnieje"""
+    if device_id in shared_storage['devices'] and not storage_backends.holds(device_id):
+        # Slot urządzenia w pamięci współdzielonej zwolnił inny worker (release_device)
+        shared_storage['devices'].pop(device_id)
     if device_id not in shared_storage['devices']:
+        retention_seconds = get_config_value('SENSOR_RETENTION_SECONDS', 900)
         shared_storage['devices'][device_id] = {
-            'hr_history': [],
-            'mpu_history': [],
-            'emg_history': [],
+            # Bufor cykliczny HR/SpO2 o stałej pojemności (co najmniej okno 15 minut)
+            'hr_history': HrRingBuffer(
+                get_config_value('HR_BUFFER_CAPACITY', HR_WINDOW_SAMPLES),
+                backend=storage_backends, device_id=device_id
+            ),
+            # Kolumnowe bufory MPU/EMG z oknem retencji - pamięć per urządzenie nie rośnie
+            'mpu_history': MpuRingBuffer(
+                get_config_value('MPU_BUFFER_CAPACITY', 1800), retention_seconds,
+                backend=storage_backends, device_id=device_id
+            ),
+            'emg_history': EmgRingBuffer(
+                get_config_value('EMG_BUFFER_CAPACITY', 1800), retention_seconds,
+                backend=storage_backends, device_id=device_id
+            ),
             'last_update': None
         }
+        # Okno zapisane w Redis przez inne węzły ma pierwszeństwo przed snapshotem i bazą
+        redis_store.sync_device(device_id, shared_storage['devices'][device_id])
+        warm_start_device_storage(device_id, shared_storage['devices'][device_id])
         shared_storage['global_stats']['active_devices'].add(device_id)
+    else:
+        # Próbki, które od ostatniego żądania trafiły do innych węzłów (jeden pipeline)
+        redis_store.sync_device(device_id, shared_storage['devices'][device_id])
     return shared_storage['devices'][device_id]
 
+def release_device(device_id):
+    """Usuwa lokalny stan urządzenia, które przejął inny węzeł (zmiana mapy shardów)"""
+    device_storage = shared_storage['devices'].pop(device_id, None)
+    if device_storage:
+        # Bufory w pamięci współdzielonej przeżyłyby usunięcie - przy powrocie urządzenia
+        # warm start wziąłby je za aktualne zamiast przekazanego snapshotu
+        with device_storage['hr_history'].lock:
+            for name in ('hr_history', 'mpu_history', 'emg_history'):
+                device_storage[name].clear()
+    # Slot indeksu pamięci współdzielonej wraca do puli (także gdy bufory zaalokował inny worker)
+    storage_backends.release(device_id)
+    shared_storage['rem_states'].pop(device_id, None)
+    shared_storage['global_stats']['active_devices'].discard(device_id)
+
+def warm_start_device_storage(device_id, device_storage):
+    """
+    Odtwarza okna sensorów urządzenia po restarcie: ze snapshotu na dysku, a gdy go nie ma -
+    okno HR z próbek zapisanych w bazie. Dzięki temu rem_detection nie czeka 15 minut na dane.
+
+    Bufory w pamięci współdzielonej mogą już zawierać dane innego procesu - wtedy nic nie
+    odtwarzamy, a dane starsze niż DEVICE_SNAPSHOT_MAX_AGE_SECONDS są czyszczone.
+    """
+    hr_history = device_storage['hr_history']
+    # Blokada urządzenia w backendzie - dwa procesy nie odtwarzają tych samych buforów naraz
+    with hr_history.lock:
+        if len(hr_history):
+            if time.time() - hr_history.latest('timestamp') <= device_snapshots.max_age_seconds:
+                return
+            for name in ('hr_history', 'mpu_history', 'emg_history'):
+                device_storage[name].clear()
+
+        snapshot = device_snapshots.load(device_id)
+        if snapshot:
+            for name, columns in snapshot['buffers'].items():
+                if name in device_storage:
+                    restore_buffer(device_storage[name], columns)
+            source = 'snapshot'
+        else:
+            restore_buffer(hr_history, sample_writer.load_recent(
+                'hr', device_id, hr_history.capacity, device_snapshots.max_age_seconds
+            ))
+            source = 'database'
+    if len(hr_history):
+        print(f"Warm start urządzenia {device_id} ({source}): {len(hr_history)} próbek HR")
+
+def restore_rem_state(device_id, rem_state):
+    """
+    Przywraca stan REM urządzenia z Redis (stan innych węzłów) albo ze snapshotu
+    (np. trwająca faza REM nie zaczyna się od nowa)
+    """
+    remote_state = redis_store.load_rem_state(device_id)
+    if remote_state:
+        rem_state['transitions'].extend(remote_state.pop('transitions'))
+        rem_state.update(remote_state)
+        return
+    snapshot = device_snapshots.load(device_id)
+    if not snapshot or not snapshot['rem_state']:
+        return
+    rem_state.update(snapshot['rem_state'])
+    rem_state['transitions'].extend(snapshot['transitions'])
+
+@device_snapshots.snapshot_source
+def iter_device_snapshots():
+    """Dane urządzeń do okresowego snapshotu (znacznik = liczniki zapisów buforów i rewizja stanu REM)"""
+    for device_id, device_storage in list(shared_storage['devices'].items()):
+        rem_state = shared_storage['rem_states'].get(device_id)
+        marker = (
+            device_storage['hr_history'].total_appended,
+            device_storage['mpu_history'].total_appended,
+            device_storage['emg_history'].total_appended,
+            rem_state['revision'] if rem_state else None
+        )
+        yield device_id, device_storage, rem_state, marker
+
+def get_device_lock(device_id):
+    """Zwraca blokadę dla danego urządzenia, tworzy jeśli nie istnieje"""
+    lock = _device_locks.get(device_id)
+    if lock is None:
+        with _device_locks_guard:
+            lock = _device_locks.setdefault(device_id, threading.Lock())
+    return lock
+
+def next_revision():
+    """Zwraca kolejny numer rewizji stanu (globalnie rosnący, bezpieczny wątkowo w CPython)"""
+    return next(_revision_counter)
+
+def touch_mobile_session(mobile_session):
+    """Oznacza zmianę sesji mobile - nowa rewizja unieważnia ETag odpowiedzi pollingu"""
+    mobile_session['revision'] = next_revision()
+    persist_mobile_session(mobile_session)
+    return mobile_session
+
+def persist_mobile_session(mobile_session):
+    """Zapisuje sesję mobile w Redis (widoczna dla innych węzłów; bez Redis nic nie robi)"""
+    if mobile_session and mobile_session.get('mobile_id'):
+        redis_store.save_mobile_session(mobile_session['mobile_id'], mobile_session)
+
+def merge_mobile_session(mobile_id, data):
+    """
+    Aktualizuje lokalną kopię sesji mobile danymi z Redis (zmienionymi przez inny węzeł)
+
+    Returns:
+        dict: Lokalna sesja mobile
+    """
+    mobile_session = shared_storage['mobile_sessions'].get(mobile_id)
+    if mobile_session is None:
+        mobile_session = shared_storage['mobile_sessions'][mobile_id] = {'prepared_audio': {}}
+        shared_storage['global_stats']['active_mobile_sessions'].add(mobile_id)
+    elif mobile_session.get('sync_id') == data.get('sync_id'):
+        return mobile_session
+    # Klucze JSON są napisami - prepared_audio indeksowane jest numerem scenariusza
+    prepared_audio = {int(index): prepared for index, prepared in data.pop('prepared_audio', {}).items()}
+    if mobile_session.get('scenarios_loaded_at') == data.get('scenarios_loaded_at'):
+        # To samo ładowanie scenariuszy - uzupełniamy słownik w miejscu (piszą do niego zadania w tle)
+        mobile_session['prepared_audio'].update(prepared_audio)
+    else:
+        mobile_session['prepared_audio'] = prepared_audio
+    mobile_session.update(data)
+    mobile_session['revision'] = next_revision()
+    return mobile_session
+
+def sync_device_mobile_sessions(device_id):
+    """Dociąga z Redis sesje mobile połączone z urządzeniem (obsługiwane przez inne węzły)"""
+    for mobile_id, data in redis_store.load_device_sessions(device_id).items():
+        merge_mobile_session(mobile_id, data)
+
+def get_device_condition(device_id):
+    """
+    Zwraca zmienną warunkową urządzenia (na tej samej blokadzie co get_device_lock),
+    na której klienci long-poll/SSE czekają na zmianę wersji stanu REM
+    """
+    condition = _device_conditions.get(device_id)
+    if condition is None:
+        lock = get_device_lock(device_id)
+        with _device_locks_guard:
+            condition = _device_conditions.setdefault(device_id, threading.Condition(lock))
+    return condition
+
+def get_rem_state(device_id):
+    """Pobiera stan REM dla danego device_id, tworzy jeśli nie istnieje"""
+    if device_id not in shared_storage['rem_states']:
+        shared_storage['rem_states'][device_id] = {
+            'rem_detected': False,
+            'current_rem_phase': 0,
+            'total_rem_phases': 0,
+            'sleep_flag': False,
+            'atonia_flag': False,
+            'last_update': None,
+            'transitions': deque(maxlen=REM_TRANSITION_LOG_SIZE),
+            'version': 0,  # Rośnie przy każdym przejściu REM i zmianie zadania audio (kursor long-poll)
+            'revision': next_revision()  # Zmienia się przy każdej widocznej zmianie stanu (ETag)
+        }
+        restore_rem_state(device_id, shared_storage['rem_states'][device_id])
+    return shared_storage['rem_states'][device_id]
+
+def advance_rem_state(device_id, rem_detected, sleep_flag, atonia_flag):
+    """
+    Przeprowadza przejście maszyny stanów REM dla urządzenia (atomowo względem tego urządzenia)
+    
+    Returns:
+        tuple: (poprzedni rem_detected, numer bieżącej fazy REM, czy rozpoczęła się nowa faza)
+    """
+    condition = get_device_condition(device_id)
+    with condition:
+        rem_state = get_rem_state(device_id)
+        previous_rem_flag = rem_state['rem_detected']
+        previous_revision = rem_state['revision']
+        new_phase_started = False
+        
+        # Logika numeru bieżącej fazy REM
+        if not previous_rem_flag and rem_detected:
+            # Początek nowej fazy REM - kolejny numer fazy tego urządzenia
+            rem_state['total_rem_phases'] += 1
+            current_rem_phase = rem_state['total_rem_phases']
+            shared_storage['global_stats']['total_rem_phases'] += 1
+            new_phase_started = True
+        elif previous_rem_flag and not rem_detected:
+            # Koniec fazy REM - resetujemy na 0 (nie w REM)
+            current_rem_phase = 0
+        else:
+            # Bez zmiany stanu - zachowujemy obecny numer fazy
+            current_rem_phase = rem_state['current_rem_phase']
+        
+        if previous_rem_flag != rem_detected:
+            rem_state['transitions'].append({
+                'timestamp': datetime.now().isoformat(),
+                'rem_detected': rem_detected,
+                'rem_phase': current_rem_phase if rem_detected else rem_state['current_rem_phase']
+            })
+        
+        update_rem_state(device_id, rem_detected, sleep_flag, atonia_flag, current_rem_phase)
+        
+        if previous_rem_flag != rem_detected:
+            rem_state['version'] += 1
+            rem_state['revision'] = next_revision()
+        if rem_state['revision'] != previous_revision:
+            share_rem_state(device_id, rem_state, bump_version=previous_rem_flag != rem_detected)
+        if previous_rem_flag != rem_detected:
+            # Budzimy klientów czekających na zmianę stanu tego urządzenia
+            condition.notify_all()
+    
+    return previous_rem_flag, current_rem_phase, new_phase_started
+
+def notify_rem_state_change(device_id):
+    """Podbija wersję stanu urządzenia i budzi czekających klientów (poza advance_rem_state)"""
+    condition = get_device_condition(device_id)
+    with condition:
+        rem_state = get_rem_state(device_id)
+        rem_state['version'] += 1
+        rem_state['revision'] = next_revision()
+        share_rem_state(device_id, rem_state, bump_version=True)
+        condition.notify_all()
+
+def share_rem_state(device_id, rem_state, bump_version):
+    """
+    Zapisuje stan REM w Redis i powiadamia inne węzły (wywoływane pod blokadą urządzenia);
+    wersja z Redis jest wspólnym kursorem long-poll wszystkich węzłów
+    """
+    version = redis_store.save_rem_state(device_id, rem_state, bump_version)
+    if version is not None:
+        rem_state['version'] = version
+
+@redis_store.rem_state_listener
+def apply_remote_rem_state(device_id):
+    """Stan REM zmieniony na innym węźle - odświeża lokalną kopię i budzi klientów long-poll/SSE"""
+    if device_id not in shared_storage['rem_states']:
+        return
+    remote_state = redis_store.load_rem_state(device_id)
+    if not remote_state:
+        return
+    condition = get_device_condition(device_id)
+    with condition:
+        rem_state = shared_storage['rem_states'][device_id]
+        rem_state['transitions'].clear()
+        rem_state['transitions'].extend(remote_state.pop('transitions'))
+        rem_state.update(remote_state)
+        rem_state['revision'] = next_revision()
+        condition.notify_all()
+
+def wait_for_rem_state_change(device_id, since_version, timeout):
+    """
+    Czeka aż wersja stanu urządzenia będzie różna od since_version lub minie timeout
+    
+    Returns:
+        int: Bieżąca wersja stanu urządzenia
+    """
+    condition = get_device_condition(device_id)
+    with condition:
+        rem_state = get_rem_state(device_id)
+        condition.wait_for(lambda: rem_state['version'] != since_version, timeout=timeout)
+        return rem_state['version']
+
 def update_rem_state(device_id, rem_detected, sleep_flag, atonia_flag, current_rem_phase):
-    """Aktualizuje globalny stan REM"""
-    shared_storage['current_rem_state'].update({
+    """Aktualizuje stan REM urządzenia oraz ostatni globalny stan REM"""
+    now = datetime.now().isoformat()
+    values = {
         'rem_detected': rem_detected,
         'current_rem_phase': current_rem_phase,
         'sleep_flag': sleep_flag,
-        'atonia_flag': atonia_flag,
-        'last_device_id': device_id,
-        'last_update': datetime.now().isoformat()
-    })
+        'atonia_flag': atonia_flag
+    }
+    rem_state = get_rem_state(device_id)
+    # Nowa rewizja tylko gdy zmieniło się coś widocznego dla klientów (sam czas aktualizacji nie)
+    if any(rem_state.get(key) != value for key, value in values.items()):
+        rem_state['revision'] = next_revision()
+    rem_state.update(values, last_update=now)
+    
+    current_rem_state = shared_storage['current_rem_state']
+    if current_rem_state['last_device_id'] != device_id or any(
+        current_rem_state.get(key) != value for key, value in values.items()
+    ):
+        current_rem_state['revision'] = next_revision()
+    current_rem_state.update(values, last_device_id=device_id, last_update=now)
+
+@embedded_bp.before_request
+def route_to_shard_owner():
+    """Żądania urządzenia obsługuje węzeł właściciela z mapy shardów (gdy sharding jest włączony)"""
+    if not shard_router.enabled or request.method != 'POST':
+        return None
+    data = request.get_json(silent=True)
+    device_id = data.get('device_id') if isinstance(data, dict) else None
+    return shard_router.route(device_id)
 
 @embedded_bp.route('/embedded/hello')
 def embedded_hello():
@@ -89,8 +416,10 @@ def embedded_sensor_data():
                 hr_values = [entry['heart_rate'] for entry in plethysmometer_data]
                 print(f"HR w tym pakiecie: min={min(hr_values)}, max={max(hr_values)}, avg={sum(hr_values)/len(hr_values):.1f}")
                 
-                # Zapisujemy dane HR do device storage
-                device_storage['hr_history'].extend(plethysmometer_data)
+                # Zapisujemy dane HR do device storage (i do kolejki zapisu w bazie - bez czekania)
+                appended = device_storage['hr_history'].add_samples(plethysmometer_data)
+                sample_writer.enqueue('hr', device_id, appended)
+                redis_store.publish_samples('hr', device_id, device_storage['hr_history'], appended)
                 print(f"DEBUG: Zapisano {len(plethysmometer_data)} próbek HR do storage")
                 print(f"DEBUG: Łączna liczba próbek HR w storage: {len(device_storage['hr_history'])}")
                 
@@ -103,7 +432,9 @@ def embedded_sensor_data():
         print(f"Otrzymano {len(mpu_samples)} probek MPU")
         
         # Zapisujemy dane MPU do storage
-        device_storage['mpu_history'].extend(mpu_samples)
+        appended = device_storage['mpu_history'].add_samples(mpu_samples)
+        sample_writer.enqueue('mpu', device_id, appended)
+        redis_store.publish_samples('mpu', device_id, device_storage['mpu_history'], appended)
         
         # 3. PRZETWARZAMY DANE EMG (NAPIĘCIE MIĘŚNI)
         emg_data = sensor_data.get('emg', {})
@@ -111,7 +442,9 @@ def embedded_sensor_data():
         print(f"Otrzymano {len(emg_samples)} probek EMG")
         
         # Zapisujemy dane EMG do storage
-        device_storage['emg_history'].extend(emg_samples)
+        appended = device_storage['emg_history'].add_samples(emg_samples)
+        sample_writer.enqueue('emg', device_id, appended)
+        redis_store.publish_samples('emg', device_id, device_storage['emg_history'], appended)
         
         # 4. AKTUALIZUJEMY METADANE STORAGE I SESJI
         device_storage['last_update'] = datetime.now().isoformat()
@@ -184,17 +517,17 @@ def embedded_flags():
         if not hr_history:
             print("BRAK DANYCH HR - nie można przeprowadzić analizy REM")
             rem_detected = False
-        elif len(hr_history) < 900:  # Mniej niż 15 minut danych
-            print(f"ZA MAŁO DANYCH HR - potrzeba 900 próbek, mamy {len(hr_history)}")
+        elif len(hr_history) < HR_WINDOW_SAMPLES:  # Mniej niż 15 minut danych
+            print(f"ZA MAŁO DANYCH HR - potrzeba {HR_WINDOW_SAMPLES} próbek, mamy {len(hr_history)}")
             print("TRYB TESTOWY: Sprawdzam REM z dostępnymi danymi")
             
             # Tryb testowy - sprawdzamy podstawowe warunki REM
             if sleep_flag and atonia_flag and len(hr_history) >= 60:  # Co najmniej 2 minuty danych
                 # Prosty algorytm testowy - sprawdzamy wzrost HR
-                recent_hr = [entry['heart_rate'] for entry in hr_history[-30:]]  # Ostatnie 30 próbek
+                recent_hr = hr_history.heart_rates(30)  # Ostatnie 30 próbek
                 avg_recent = sum(recent_hr) / len(recent_hr)
                 
-                earlier_hr = [entry['heart_rate'] for entry in hr_history[-60:-30]]  # Wcześniejsze 30 próbek
+                earlier_hr = hr_history.heart_rates(60)[:-30]  # Wcześniejsze 30 próbek
                 avg_earlier = sum(earlier_hr) / len(earlier_hr) if earlier_hr else avg_recent
                 
                 hr_increase = avg_recent - avg_earlier
@@ -214,32 +547,24 @@ def embedded_flags():
             rem_detected = rem_detection(
                 plethysmometer_data=hr_history,
                 sleep_flag=sleep_flag,
-                atonia_flag=atonia_flag
+                atonia_flag=atonia_flag,
+                device_id=device_id
             )
         
-        # Pobieramy poprzedni stan REM z shared storage
-        previous_rem_flag = shared_storage['current_rem_state']['rem_detected']
+        audio_job = None
         
-        # Logika numeru bieżącej fazy REM
-        if not previous_rem_flag and rem_detected:
-            # Początek nowej fazy REM - zwiększamy numer fazy
-            current_rem_phase = shared_storage['current_rem_state']['current_rem_phase'] + 1
-            shared_storage['global_stats']['total_rem_phases'] = current_rem_phase
+        # Przejście maszyny stanów REM tego urządzenia (numer fazy, log przejść)
+        previous_rem_flag, current_rem_phase, new_phase_started = advance_rem_state(
+            device_id, rem_detected, sleep_flag, atonia_flag
+        )
+        
+        if new_phase_started:
             print(f"NOWA FAZA REM WYKRYTA! Numer bieżącej fazy: {current_rem_phase}")
             
-            # Automatyczne uruchomienie scenariusza dla tej fazy REM
-            try_generate_sound_for_rem_phase(current_rem_phase)
-            
+            # Automatyczne zlecenie scenariusza dla tej fazy REM (w tle, bez blokowania urządzenia)
+            audio_job = try_generate_sound_for_rem_phase(current_rem_phase, device_id)
         elif previous_rem_flag and not rem_detected:
-            # Koniec fazy REM - resetujemy na 0 (nie w REM)
-            current_rem_phase = 0
             print("KONIEC FAZY REM - powrót do normalnego snu")
-        else:
-            # Bez zmiany stanu - zachowujemy obecny numer fazy
-            current_rem_phase = shared_storage['current_rem_state']['current_rem_phase']
-        
-        # Aktualizujemy shared storage z nowym stanem REM
-        update_rem_state(device_id, rem_detected, sleep_flag, atonia_flag, current_rem_phase)
         
         # Zachowujemy kompatybilność z sesją dla pojedynczych żądań
         session['rem_flag'] = rem_detected
@@ -249,7 +574,7 @@ def embedded_flags():
         session['last_flags_update'] = datetime.now().isoformat()
         
         # Pobieramy statystyki do odpowiedzi
-        hr_stats = get_hr_stats()
+        hr_stats = get_hr_stats(device_id)
         
         print(f"WYNIK: REM = {rem_detected}")
         print(f"Statystyki HR: {hr_stats.get('total_samples', 0)} probek, srednia: {hr_stats.get('avg_hr_all', 0):.1f} BPM")
@@ -264,7 +589,9 @@ def embedded_flags():
                 "rem_detected": rem_detected,
                 "current_rem_phase": current_rem_phase,
                 "previous_rem_state": previous_rem_flag,
-                "state_changed": previous_rem_flag != rem_detected
+                "state_changed": previous_rem_flag != rem_detected,
+                "audio_job_id": audio_job['job_id'] if audio_job else None,
+                "audio_handle_id": audio_job.get('handle_id') if audio_job else None
             },
             "input_flags": {
                 "sleep": sleep_flag,
@@ -313,8 +640,10 @@ def embedded_plethysmometer():
                 print(f"HR w tym pakiecie: min={min(hr_values)}, max={max(hr_values)}, avg={sum(hr_values)/len(hr_values):.1f}")
                 print(f"SpO2 w tym pakiecie: min={min(spo2_values):.1f}%, max={max(spo2_values):.1f}%, avg={sum(spo2_values)/len(spo2_values):.1f}%")
                 
-                # Zapisujemy dane HR do device storage
-                device_storage['hr_history'].extend(plethysmometer_data)
+                # Zapisujemy dane HR do device storage (i do kolejki zapisu w bazie - bez czekania)
+                appended = device_storage['hr_history'].add_samples(plethysmometer_data)
+                sample_writer.enqueue('hr', device_id, appended)
+                redis_store.publish_samples('hr', device_id, device_storage['hr_history'], appended)
                 print(f"DEBUG: Zapisano {len(plethysmometer_data)} próbek HR do storage")
                 print(f"DEBUG: Łączna liczba próbek HR w storage: {len(device_storage['hr_history'])}")
                 
@@ -369,7 +698,9 @@ def embedded_mpu():
         
         if mpu_samples:
             # Zapisujemy dane MPU do storage
-            device_storage['mpu_history'].extend(mpu_samples)
+            appended = device_storage['mpu_history'].add_samples(mpu_samples)
+            sample_writer.enqueue('mpu', device_id, appended)
+            redis_store.publish_samples('mpu', device_id, device_storage['mpu_history'], appended)
             print(f"DEBUG: Zapisano {len(mpu_samples)} próbek MPU do storage")
             print(f"DEBUG: Łączna liczba próbek MPU w storage: {len(device_storage['mpu_history'])}")
         
@@ -421,12 +752,14 @@ def embedded_emg():
         
         if emg_samples:
             # Zapisujemy dane EMG do storage
-            device_storage['emg_history'].extend(emg_samples)
+            appended = device_storage['emg_history'].add_samples(emg_samples)
+            sample_writer.enqueue('emg', device_id, appended)
+            redis_store.publish_samples('emg', device_id, device_storage['emg_history'], appended)
             print(f"DEBUG: Zapisano {len(emg_samples)} próbek EMG do storage")
             print(f"DEBUG: Łączna liczba próbek EMG w storage: {len(device_storage['emg_history'])}")
             
             # Wyświetlamy statystyki muscle_tone
-            muscle_tones = [sample['envelope'] for sample in emg_samples]
+            muscle_tones = device_storage['emg_history'].window('envelope', len(emg_samples))
             print(f"Muscle tone w tym pakiecie: min={min(muscle_tones):.1f}, max={max(muscle_tones):.1f}, avg={sum(muscle_tones)/len(muscle_tones):.1f}")
         
         # Aktualizujemy metadane storage
@@ -452,47 +785,173 @@ def embedded_emg():
         print(f"DEBUG traceback: {traceback.format_exc()}")
         return jsonify({"error": "Błąd przetwarzania danych EMG", "details": str(e)}), 500
 
-def try_generate_sound_for_rem_phase(rem_phase_number):
+def get_dream_scenarios_for_device(device_id):
     """
-    Próbuje wygenerować dźwięk dla danej fazy REM na podstawie załadowanych scenariuszy
+    Pobiera scenariusze snów z sesji mobile połączonej z urządzeniem
+    
+    Returns:
+        tuple: (mobile_id, lista scenariuszy) - mobile_id None jeśli nie znaleziono
+    """
+    sync_device_mobile_sessions(device_id)
+    fallback = (None, [])
+    for mobile_id, mobile_data in shared_storage['mobile_sessions'].items():
+        if not mobile_data.get('dream_scenarios'):
+            continue
+        if mobile_data.get('device_id') == device_id:
+            return mobile_id, mobile_data['dream_scenarios']
+        # Sesja niepołączona z żadnym urządzeniem - używamy tylko gdy brak dokładnego dopasowania
+        if not mobile_data.get('device_id') and fallback[0] is None:
+            fallback = (mobile_id, mobile_data['dream_scenarios'])
+    return fallback
+
+def summarize_audio_job(job):
+    """Zwraca skrócony opis zadania audio do odpowiedzi API (bez ścieżek plików)"""
+    metadata = job.get('metadata', {})
+    result = job.get('result') or {}
+    return {
+        'job_id': job['job_id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'rem_phase': metadata.get('rem_phase'),
+        'scenario_index': metadata.get('scenario_index'),
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'tts_text': result.get('tts_text'),
+        'audio_available': bool(result.get('audio_files')),
+        'handle_id': None,
+        'error': job.get('error')
+    }
+
+def summarize_prepared_audio(prepared, rem_phase_number, scenario_index):
+    """Opis gotowego (wcześniej wyrenderowanego) audio w formacie opisu zadania audio"""
+    now = datetime.now().isoformat()
+    return {
+        'job_id': None,
+        'kind': 'prepared',
+        'status': 'done',
+        'rem_phase': rem_phase_number,
+        'scenario_index': scenario_index,
+        'created_at': prepared['prepared_at'],
+        'finished_at': now,
+        'tts_text': prepared.get('tts_text'),
+        'audio_available': True,
+        'handle_id': prepared['handle_id'],
+        'error': None
+    }
+
+def get_prepared_audio(mobile_id, scenario_index):
+    """
+    Zwraca gotowe audio scenariusza z sesji mobile (przygotowane w /mobile/load_scenarios)
+    
+    Returns:
+        dict: {'handle_id', 'tts_text', 'prepared_at'} lub None gdy brak albo handle wygasł
+    """
+    # Scenariusze mogły zostać przygotowane na innym węźle - odświeżamy sesję z Redis
+    for session_id, data in redis_store.load_mobile_sessions([mobile_id]).items():
+        merge_mobile_session(session_id, data)
+    mobile_data = shared_storage['mobile_sessions'].get(mobile_id)
+    if not mobile_data:
+        return None
+    prepared = mobile_data.get('prepared_audio', {}).get(scenario_index)
+    if not prepared or audio_handles.get(prepared['handle_id']) is None:
+        return None
+    return prepared
+
+@audio_jobs.add_completion_hook
+def publish_audio_job(job):
+    """Publikuje stan zadania audio do sesji mobile połączonych z urządzeniem zadania"""
+    metadata = job.get('metadata', {})
+    publish_audio_summary(summarize_audio_job(job), metadata.get('device_id'), metadata.get('mobile_id'))
+
+def publish_audio_summary(summary, device_id=None, mobile_id=None):
+    """Zapisuje opis audio jako latest_audio_job sesji mobile i budzi klientów long-poll/SSE"""
+    if device_id:
+        sync_device_mobile_sessions(device_id)
+    if mobile_id:
+        for session_id, data in redis_store.load_mobile_sessions([mobile_id]).items():
+            merge_mobile_session(session_id, data)
+    changed_devices = set()
+    for session_id, mobile_data in list(shared_storage['mobile_sessions'].items()):
+        if session_id == mobile_id or (device_id and mobile_data.get('device_id') == device_id):
+            previous = mobile_data.get('latest_audio_job')
+            # Hook zakończenia mógł już opublikować wynik tego zadania - nie cofamy statusu
+            if (summary['job_id'] and previous and previous['job_id'] == summary['job_id']
+                    and previous['status'] in ('done', 'error')):
+                continue
+            mobile_data['latest_audio_job'] = summary
+            touch_mobile_session(mobile_data)
+            changed_devices.add(mobile_data.get('device_id') or device_id)
+    
+    # Klienci long-poll/SSE dowiadują się o gotowym audio bez czekania na kolejny polling
+    for changed_device_id in changed_devices:
+        if changed_device_id:
+            notify_rem_state_change(changed_device_id)
+
+def try_generate_sound_for_rem_phase(rem_phase_number, device_id=None):
+    """
+    Zleca w tle wygenerowanie dźwięku dla danej fazy REM na podstawie załadowanych scenariuszy
+    (jeśli audio scenariusza zostało przygotowane wcześniej, publikuje je bez generowania)
     
     Args:
         rem_phase_number (int): Numer fazy REM (1, 2, 3, ...)
+        device_id: Urządzenie, na którym wykryto fazę REM (scenariusze z połączonej sesji mobile)
+    
+    Returns:
+        dict: Rekord zleconego zadania audio, opis gotowego audio lub None jeśli nie zlecono
     """
-    # Pobieramy scenariusze z shared storage (sprawdzamy wszystkie mobile sessions)
-    dream_scenarios = []
-    for mobile_id, mobile_data in shared_storage['mobile_sessions'].items():
-        if mobile_data.get('dream_scenarios'):
-            dream_scenarios = mobile_data['dream_scenarios']
-            print(f"Używam scenariuszy z sesji mobile: {mobile_id}")
-            break
+    # Pobieramy scenariusze z sesji mobile połączonej z tym urządzeniem
+    mobile_id, dream_scenarios = get_dream_scenarios_for_device(device_id)
+    if dream_scenarios:
+        print(f"Używam scenariuszy z sesji mobile: {mobile_id}")
     
     # Fallback do session jeśli nie ma w shared storage
     if not dream_scenarios:
         dream_scenarios = session.get('dream_scenarios', [])
-    
+
     if not dream_scenarios:
         print(f"Brak scenariuszy dla fazy REM #{rem_phase_number}")
-        return
+        return None
     
     # Obliczamy indeks scenariusza (cyklicznie jeśli mamy więcej faz niż scenariuszy)
     scenario_index = (rem_phase_number - 1) % len(dream_scenarios)
     scenario = dream_scenarios[scenario_index]
     
+    # Audio wyrenderowane przy ładowaniu scenariuszy - publikujemy od razu, bez generowania
+    prepared = get_prepared_audio(mobile_id, scenario_index)
+    if prepared:
+        summary = summarize_prepared_audio(prepared, rem_phase_number, scenario_index)
+        publish_audio_summary(summary, device_id, mobile_id)
+        print(f"Faza REM #{rem_phase_number}: gotowe audio scenariusza #{scenario_index} (handle {prepared['handle_id']})")
+        return summary
+    
     # Sprawdzamy czy scenariusz ma wymagane dane
     key_words = scenario.get('key_words', '').strip()
     place = scenario.get('place', '').strip()
     
     if not key_words and not place:
         print(f"Scenariusz #{scenario_index} nie ma żadnych danych (key_words i place są puste)")
-        return
+        return None
         
-    print(f"Uruchamianie generate_sound dla fazy REM #{rem_phase_number}")
+    print(f"Zlecanie generate_sound dla fazy REM #{rem_phase_number}")
     print(f"  Scenariusz #{scenario_index}: key_words='{key_words}', place='{place}'")
     
     try:
-        # Wywołujemy funkcję generowania dźwięku
-        generate_sound(key_words, place)
-        print(f"  Sukces: generate_sound wykonane dla fazy REM #{rem_phase_number}")
+        # Generowanie trwa dziesiątki sekund (DeepSeek + ElevenLabs + render) - wykonujemy je w tle
+        job = audio_jobs.submit(
+            generate_sound, key_words, place,
+            kind='rem_phase', priority=PRIORITY_REM, user=mobile_id or device_id,
+            metadata={
+                'device_id': device_id,
+                'mobile_id': mobile_id,
+                'rem_phase': rem_phase_number,
+                'scenario_index': scenario_index
+            }
+        )
+        publish_audio_job(job)
+        print(f"  Zlecono zadanie audio {job['job_id']} dla fazy REM #{rem_phase_number}")
+        return job
+    except JobQueueFull as e:
+        print(f"  ERROR: {str(e)}")
     except Exception as e:
-        print(f"  ERROR: Błąd podczas generate_sound: {str(e)}")
+        print(f"  ERROR: Błąd podczas zlecania generate_sound: {str(e)}")
+    return None
@@ -1,12 +1,20 @@
-from flask import Blueprint, jsonify, session, request, send_file
+from flask import Blueprint, jsonify, session, request, send_file, current_app, Response, stream_with_context
 from ..rem_detection import get_hr_stats
-from ..sound_gen import generate_sound
+from ..sound_gen import generate_sound, audio_store, EXTENDED_AUDIO_DURATION_SECONDS, PLAYLIST_SEGMENTS
+from ..audio_jobs import audio_jobs, JobQueueFull, PRIORITY_BULK, PRIORITY_INTERACTIVE
+from ..audio_handles import audio_handles
+from ..redis_store import redis_store
 from datetime import datetime
 import json
+import math
 import os
+import time
 
 # Import shared storage z embedded.py
-from .embedded import shared_storage
+from .embedded import (
+    shared_storage, get_rem_state, summarize_audio_job, publish_audio_job, wait_for_rem_state_change,
+    next_revision, touch_mobile_session, persist_mobile_session, merge_mobile_session
+)
 
 mobile_bp = Blueprint('mobile', __name__)
 
@@ -21,21 +29,40 @@ mobile_bp = Blueprint('mobile', __name__)
 
 def get_mobile_session(mobile_id):
     """Pobiera mobile session storage, tworzy jeśli nie istnieje"""
+    # Przy STORAGE_BACKEND=redis sesję mógł zmienić inny węzeł - lokalna kopia jest odświeżana
+    remote_session = redis_store.load_mobile_sessions([mobile_id]).get(mobile_id)
+    if remote_session:
+        return merge_mobile_session(mobile_id, remote_session)
     if mobile_id not in shared_storage['mobile_sessions']:
         shared_storage['mobile_sessions'][mobile_id] = {
+            'mobile_id': mobile_id,
             'device_id': None,
             'dream_scenarios': [],
+            'prepared_audio': {},
             'last_polling': None,
-            'created_at': datetime.now().isoformat()
+            'created_at': datetime.now().isoformat(),
+            'revision': next_revision()
         }
         shared_storage['global_stats']['active_mobile_sessions'].add(mobile_id)
+        persist_mobile_session(shared_storage['mobile_sessions'][mobile_id])
     return shared_storage['mobile_sessions'][mobile_id]
 
+def resolve_device_for_mobile(mobile_session):
+    """
+    Ustala urządzenie, którego stan REM widzi aplikacja mobilna
+    
+    Preferuje urządzenie połączone przez /mobile/connect_device; dla niepołączonych sesji
+    (kompatybilność wsteczna) zwraca ostatnio raportujące urządzenie.
+    """
+    return mobile_session.get('device_id') or shared_storage['current_rem_state']['last_device_id']
+
 def link_mobile_to_device(mobile_id, device_id=None):
     """Łączy sesję mobile z urządzeniem embedded"""
     mobile_session = get_mobile_session(mobile_id)
     if device_id:
-        mobile_session['device_id'] = device_id
+        if mobile_session['device_id'] != device_id:
+            mobile_session['device_id'] = device_id
+            touch_mobile_session(mobile_session)
         print(f"Połączono mobile {mobile_id} z urządzeniem {device_id}")
     return mobile_session
 
@@ -75,58 +102,292 @@ def connect_device():
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error connecting device: {str(e)}"}), 500
 
-@mobile_bp.route('/mobile/polling')
-def mobile_polling():
-    """
-    Endpoint dla aplikacji mobilnej - zwraca dane w formacie zgodnym z mobile_polling.json
-    Obsługuje parametr ?detailed=true dla pełnych danych (kompatybilność wsteczna)
-    """
-    # Pobieramy mobile_id z parametru lub session
-    mobile_id = request.args.get('mobile_id') or session.get('mobile_id', 'MOB_001')
-    
-    # Pobieramy dane z shared storage
-    rem_state = shared_storage['current_rem_state']
-    mobile_session = get_mobile_session(mobile_id)
-    
-    # Aktualizujemy czas ostatniego pollingu
-    mobile_session['last_polling'] = datetime.now().isoformat()
-    
-    # Sprawdzamy czy klient chce szczegółowe dane
-    detailed = request.args.get('detailed', 'false').lower() == 'true'
+def build_polling_response(mobile_id, mobile_session, device_id, detailed):
+    """Buduje odpowiedź pollingu dla sesji mobile (wspólne dla /mobile/polling i /mobile/events)"""
+    rem_state = get_rem_state(device_id) if device_id else shared_storage['current_rem_state']
+    version = rem_state.get('version', 0)
     
     if detailed:
         # Kompatybilność wsteczna - pełny format danych
-        hr_stats = get_hr_stats()
+        hr_stats = get_hr_stats(device_id)
         
         response_data = {
             "status": "success",
             "timestamp": datetime.now().isoformat(),
+            "version": version,
             "session_data": {
                 "rem_detected": rem_state['rem_detected'],
                 "sleep_detected": rem_state['sleep_flag'],
                 "atonia_detected": rem_state['atonia_flag'],
-                "device_id": rem_state['last_device_id']
+                "device_id": device_id
             },
             "hr_statistics": hr_stats,
             "rem_phases": {
                 "current_phase": rem_state['current_rem_phase'],
-                "total_phases": shared_storage['global_stats']['total_rem_phases']
+                "total_phases": rem_state.get('total_rem_phases', 0),
+                "recent_transitions": list(rem_state.get('transitions', []))[-10:]
             },
             "mobile_session": {
                 "mobile_id": mobile_id,
                 "connected_device": mobile_session.get('device_id'),
                 "scenarios_loaded": len(mobile_session.get('dream_scenarios', []))
-            }
+            },
+            "audio_job": mobile_session.get('latest_audio_job')
         }
     else:
         # Nowy prosty format - zgodny z mobile_polling.json
         response_data = {
             "mobile_id": mobile_id,
             "rem": "true" if rem_state['rem_detected'] else "false",
-            "current_rem_phase": str(rem_state['current_rem_phase'])
+            "current_rem_phase": str(rem_state['current_rem_phase']),
+            "version": version
         }
+        
+        # Informacja o zadaniu audio zleconym dla ostatniej fazy REM (hook zakończenia zadania)
+        latest_audio_job = mobile_session.get('latest_audio_job')
+        if latest_audio_job:
+            response_data["audio_job_id"] = latest_audio_job['job_id']
+            response_data["audio_status"] = latest_audio_job['status']
+            if latest_audio_job.get('handle_id'):
+                response_data["audio_handle_id"] = latest_audio_job['handle_id']
     
-    return jsonify(response_data)
+    return response_data
+
+def polling_etag(mobile_session, device_id, detailed):
+    """
+    Wylicza ETag odpowiedzi pollingu z rewizji stanu - bez budowania odpowiedzi i bez danych sensorów
+
+    Tryb szczegółowy zawiera statystyki HR, więc jego ETag uwzględnia też licznik próbek HR.
+    Rewizje są lokalne dla procesu, więc ETag zawiera identyfikator węzła - ETag innego węzła
+    (za load balancerem) albo sprzed restartu nigdy nie daje fałszywego 304.
+    """
+    rem_state = get_rem_state(device_id) if device_id else shared_storage['current_rem_state']
+    parts = [
+        redis_store.node_id, 'detailed' if detailed else 'simple',
+        rem_state.get('revision', 0), mobile_session.get('revision', 0)
+    ]
+    if detailed:
+        device_storage = shared_storage['devices'].get(device_id)
+        parts.append(device_storage['hr_history'].total_appended if device_storage else 0)
+    return "-".join(str(part) for part in parts)
+
+def not_modified(etag):
+    """Pusta odpowiedź 304 z ETagiem"""
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@mobile_bp.route('/mobile/polling')
+def mobile_polling():
+    """
+    Endpoint dla aplikacji mobilnej - zwraca dane w formacie zgodnym z mobile_polling.json
+    Obsługuje parametr ?detailed=true dla pełnych danych (kompatybilność wsteczna)
+    
+    Long-polling: ?since=<version>&wait=<sekundy> - odpowiedź wstrzymywana jest do zmiany
+    wersji stanu REM połączonego urządzenia (przejście REM, status zadania audio) lub timeoutu.
+    
+    Odpowiedzi mają ETag z rewizji stanu; If-None-Match z aktualnym ETagiem daje 304.
+    """
+    # Pobieramy mobile_id z parametru lub session
+    mobile_id = request.args.get('mobile_id') or session.get('mobile_id', 'MOB_001')
+    
+    # Pobieramy dane z shared storage - stan REM urządzenia połączonego z tą sesją mobile
+    mobile_session = get_mobile_session(mobile_id)
+    device_id = resolve_device_for_mobile(mobile_session)
+    
+    # Long-polling z kursorem wersji - czekamy tylko gdy klient zna już bieżącą wersję
+    since = request.args.get('since', type=int)
+    wait = request.args.get('wait', type=float)
+    if since is not None and wait and device_id:
+        timeout = min(wait, current_app.config.get('LONG_POLL_MAX_SECONDS', 25))
+        wait_for_rem_state_change(device_id, since, timeout)
+        # W trakcie czekania sesję mógł zmienić inny węzeł (np. gotowe audio)
+        mobile_session = get_mobile_session(mobile_id)
+    
+    # Aktualizujemy czas ostatniego pollingu
+    mobile_session['last_polling'] = datetime.now().isoformat()
+    redis_store.touch_mobile_session(mobile_id)
+    
+    # Sprawdzamy czy klient chce szczegółowe dane
+    detailed = request.args.get('detailed', 'false').lower() == 'true'
+    
+    # Stan bez zmian od poprzedniej odpowiedzi - 304 bez serializacji i bez statystyk HR
+    etag = polling_etag(mobile_session, device_id, detailed)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    
+    response = jsonify(build_polling_response(mobile_id, mobile_session, device_id, detailed))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@mobile_bp.route('/mobile/events')
+def mobile_events():
+    """
+    Kanał Server-Sent Events ze stanem REM połączonego urządzenia
+    
+    Wysyła zdarzenie 'rem_state' (format jak /mobile/polling, id = wersja stanu) od razu po
+    połączeniu i przy każdej zmianie wersji; w międzyczasie komentarze keep-alive.
+    Wznowienie od wersji z nagłówka Last-Event-ID (lub ?since=).
+    """
+    mobile_id = request.args.get('mobile_id') or session.get('mobile_id', 'MOB_001')
+    detailed = request.args.get('detailed', 'false').lower() == 'true'
+    keepalive = current_app.config.get('SSE_KEEPALIVE_SECONDS', 15)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(last_event_id) if last_event_id is not None else None
+    except ValueError:
+        since = None
+    
+    def event_stream():
+        version = since
+        while True:
+            mobile_session = get_mobile_session(mobile_id)
+            device_id = resolve_device_for_mobile(mobile_session)
+            if device_id and version is not None:
+                current_version = wait_for_rem_state_change(device_id, version, keepalive)
+                if current_version == version:
+                    yield ": keepalive\n\n"
+                    continue
+            elif version is not None:
+                # Brak urządzenia do obserwowania - sprawdzamy ponownie po interwale keep-alive
+                time.sleep(keepalive)
+                yield ": keepalive\n\n"
+                continue
+            
+            mobile_session['last_polling'] = datetime.now().isoformat()
+            response_data = build_polling_response(mobile_id, mobile_session, device_id, detailed)
+            version = response_data['version']
+            yield f"id: {version}\nevent: rem_state\ndata: {json.dumps(response_data)}\n\n"
+    
+    response = Response(stream_with_context(event_stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def generate_scenario_audio(scenario_index, key_words, place, mobile_id=None, prepared_audio=None):
+    """
+    Generuje audio dla pojedynczego scenariusza i zwraca opis wyniku do odpowiedzi API
+    (błędy są zwracane jako wynik ze statusem 'error', a nie rzucane)
+    
+    Gotowe pliki są rejestrowane jako handle i zapisywane w prepared_audio pod indeksem
+    scenariusza - początek fazy REM publikuje je wtedy bez ponownego generowania.
+    """
+    try:
+        print(f"Przetwarzanie scenariusza #{scenario_index}: key_words='{key_words}', place='{place}'")
+        audio_result = generate_sound(key_words, place)
+        
+        # Dodajemy informacje o wygenerowanym audio do odpowiedzi
+        scenario_audio = {
+            "scenario_index": scenario_index,
+            "key_words": key_words,
+            "place": place,
+            "generation_result": {
+                "status": audio_result.get("status"),
+                "tts_text": audio_result.get("tts_text"),
+                "sound_description": audio_result.get("sound_description"),
+                "message": audio_result.get("message")
+            }
+        }
+        
+        # Jeśli są pliki audio, dodajemy informację o ich dostępności
+        if audio_result.get("audio_files"):
+            scenario_audio["generation_result"]["audio_available"] = True
+            scenario_audio["generation_result"]["audio_files_info"] = {
+                "tts_file_available": "tts_file" in audio_result["audio_files"],
+                "sound_file_available": "sound_file" in audio_result["audio_files"]
+            }
+            handle_id = audio_handles.register(
+                audio_result["audio_files"],
+                metadata={
+                    'mobile_id': mobile_id, 'scenario_index': scenario_index,
+                    'key_words': key_words, 'place': place, 'playlist': audio_result.get('playlist')
+                }
+            )
+            scenario_audio["generation_result"]["audio_download_info"] = build_audio_download_info(
+                handle_id, audio_result["audio_files"]
+            )
+            if prepared_audio is not None:
+                prepared_audio[scenario_index] = {
+                    'handle_id': handle_id,
+                    'tts_text': audio_result.get("tts_text"),
+                    'prepared_at': datetime.now().isoformat()
+                }
+                # Gotowe audio widoczne dla węzła, który wykryje początek fazy REM (Redis)
+                persist_mobile_session(shared_storage['mobile_sessions'].get(mobile_id))
+        else:
+            scenario_audio["generation_result"]["audio_available"] = False
+        
+        print(f"  Sukces: generate_sound wykonane dla scenariusza #{scenario_index}")
+        return scenario_audio
+        
+    except Exception as e:
+        print(f"  ERROR: Błąd podczas generate_sound dla scenariusza #{scenario_index}: {str(e)}")
+        # Dodajemy informację o błędzie
+        return scenario_error_result(scenario_index, key_words, place, str(e))
+
+def scenario_error_result(scenario_index, key_words, place, error, preempted=False):
+    """Opis nieudanego generowania scenariusza do odpowiedzi API"""
+    result = {
+        "scenario_index": scenario_index,
+        "key_words": key_words,
+        "place": place,
+        "generation_result": {
+            "status": "error",
+            "error": error,
+            "audio_available": False
+        }
+    }
+    if preempted:
+        # Audio scenariusza zostanie wygenerowane przy fazie REM (albo po ponownym załadowaniu)
+        result["generation_result"]["preempted"] = True
+    return result
+
+def preempted_scenario_indexes(scenario_results):
+    """Numery scenariuszy, których wstępne generowanie zostało wyparte przez pilniejsze zadania"""
+    return sorted(
+        scenario_audio["scenario_index"] for scenario_audio in scenario_results
+        if scenario_audio["generation_result"].get("preempted")
+    )
+
+def generate_scenarios_audio(scenarios, mobile_id=None, prepared_audio=None):
+    """
+    Zleca generowanie audio dla wielu scenariuszy jako zadania o niskim priorytecie (bulk)
+    
+    Zadania wykonuje kolejka audio_jobs - generowanie dla fazy REM i żądania interaktywne
+    mają pierwszeństwo, a paczki scenariuszy różnych użytkowników przeplatają się.
+    
+    Args:
+        scenarios: Lista krotek (scenario_index, key_words, place)
+        mobile_id (str): Sesja mobile, dla której przygotowywane jest audio
+        prepared_audio (dict): Słownik sesji na gotowe audio (scenario_index -> handle)
+    
+    Yields:
+        dict: Wynik scenariusza, w kolejności ukończenia
+    """
+    submitted = {}  # job_id -> (scenario_index, key_words, place)
+    for scenario_index, key_words, place in scenarios:
+        try:
+            job = audio_jobs.submit(
+                generate_scenario_audio, scenario_index, key_words, place,
+                mobile_id=mobile_id, prepared_audio=prepared_audio,
+                kind='scenario_preload', priority=PRIORITY_BULK, user=mobile_id,
+                metadata={'scenario_index': scenario_index, 'key_words': key_words, 'place': place}
+            )
+            submitted[job['job_id']] = (scenario_index, key_words, place)
+        except JobQueueFull as e:
+            yield scenario_error_result(scenario_index, key_words, place, str(e))
+    
+    for job in audio_jobs.as_completed(list(submitted)):
+        if job.get('result'):
+            yield job['result']
+        else:
+            # Zadanie wyparte przez pilniejsze, zakończone wyjątkiem albo usunięte z historii
+            yield scenario_error_result(
+                *submitted[job['job_id']], job.get('error'), preempted=job.get('preempted', False)
+            )
+
 
 @mobile_bp.route('/mobile/load_scenarios', methods=['POST'])
 def load_dream_scenarios():
@@ -140,6 +401,9 @@ def load_dream_scenarios():
             ...
         ]
     }
+    Scenariusze generowane są w tle jako zadania o niskim priorytecie. Z parametrem
+    ?stream=true wyniki zwracane są jako NDJSON w kolejności ukończenia.
+    Wygenerowane audio zapisywane jest w sesji jako gotowe dla kolejnych faz REM.
     """
     try:
         # Pobieramy dane JSON z request body
@@ -171,75 +435,69 @@ def load_dream_scenarios():
         mobile_session = link_mobile_to_device(mobile_id, device_id)
         mobile_session['dream_scenarios'] = scenarios_data['dream_keywords']
         mobile_session['current_scenario_index'] = 0
+        mobile_session['scenarios_loaded_at'] = datetime.now().isoformat()
+        # Nowy słownik - generowanie z poprzedniego ładowania nie nadpisze gotowego audio nowych scenariuszy
+        prepared_audio = mobile_session['prepared_audio'] = {}
+        touch_mobile_session(mobile_session)
         
         # Zachowujemy kompatybilność z sesją
         session['dream_scenarios'] = scenarios_data['dream_keywords']
         session['current_scenario_index'] = 0
         session['mobile_id'] = mobile_id
         
-        # Wywołujemy generate_sound dla każdego scenariusza który ma dane
-        processed_scenarios = 0
-        generated_audio_data = []
-        
+        # Wywołujemy generate_sound równolegle dla każdego scenariusza który ma dane
+        scenarios_to_process = []
         for i, scenario in enumerate(scenarios_data['dream_keywords']):
             key_words = scenario.get('key_words', '').strip()
             place = scenario.get('place', '').strip()
             
             # Sprawdzamy czy scenariusz ma jakiekolwiek dane
             if key_words or place:
-                try:
-                    print(f"Przetwarzanie scenariusza #{i}: key_words='{key_words}', place='{place}'")
-                    audio_result = generate_sound(key_words, place)
-                    
-                    # Dodajemy informacje o wygenerowanym audio do odpowiedzi
-                    scenario_audio = {
-                        "scenario_index": i,
-                        "key_words": key_words,
-                        "place": place,
-                        "generation_result": {
-                            "status": audio_result.get("status"),
-                            "tts_text": audio_result.get("tts_text"),
-                            "sound_description": audio_result.get("sound_description"),
-                            "message": audio_result.get("message")
-                        }
-                    }
-                    
-                    # Jeśli są pliki audio, dodajemy informację o ich dostępności
-                    if audio_result.get("audio_files"):
-                        scenario_audio["generation_result"]["audio_available"] = True
-                        scenario_audio["generation_result"]["audio_files_info"] = {
-                            "tts_file_available": "tts_file" in audio_result["audio_files"],
-                            "sound_file_available": "sound_file" in audio_result["audio_files"]
-                        }
-                    else:
-                        scenario_audio["generation_result"]["audio_available"] = False
-                    
-                    generated_audio_data.append(scenario_audio)
-                    processed_scenarios += 1
-                    print(f"  Sukces: generate_sound wykonane dla scenariusza #{i}")
-                    
-                except Exception as e:
-                    print(f"  ERROR: Błąd podczas generate_sound dla scenariusza #{i}: {str(e)}")
-                    # Dodajemy informację o błędzie
-                    error_scenario = {
-                        "scenario_index": i,
-                        "key_words": key_words,
-                        "place": place,
-                        "generation_result": {
-                            "status": "error",
-                            "error": str(e),
-                            "audio_available": False
-                        }
-                    }
-                    generated_audio_data.append(error_scenario)
+                scenarios_to_process.append((i, key_words, place))
             else:
                 print(f"Pominięto scenariusz #{i} - brak danych (key_words i place są puste)")
         
+        scenarios_count = len(scenarios_data['dream_keywords'])
+        
+        if request.args.get('stream', 'false').lower() == 'true':
+            # Strumieniujemy wyniki (NDJSON) w kolejności ukończenia scenariuszy
+            def stream_results():
+                processed_scenarios = 0
+                finished_scenarios = []
+                scenario_results = generate_scenarios_audio(scenarios_to_process, mobile_id, prepared_audio)
+                for scenario_audio in scenario_results:
+                    if "error" not in scenario_audio["generation_result"]:
+                        processed_scenarios += 1
+                    finished_scenarios.append(scenario_audio)
+                    yield json.dumps(scenario_audio, ensure_ascii=False) + "\n"
+                yield json.dumps({
+                    "status": "success",
+                    "message": "Dream scenarios loaded successfully",
+                    "scenarios_count": scenarios_count,
+                    "processed_scenarios": processed_scenarios,
+                    "preempted_scenarios": preempted_scenario_indexes(finished_scenarios),
+                    "mobile_id": scenarios_data.get('mobile_id')
+                }, ensure_ascii=False) + "\n"
+            
+            return Response(stream_with_context(stream_results()), mimetype='application/x-ndjson')
+        
+        generated_audio_data = sorted(
+            generate_scenarios_audio(scenarios_to_process, mobile_id, prepared_audio),
+            key=lambda scenario_audio: scenario_audio["scenario_index"]
+        )
+        processed_scenarios = sum(
+            1 for scenario_audio in generated_audio_data
+            if "error" not in scenario_audio["generation_result"]
+        )
+        
         return jsonify({
             "status": "success",
             "message": "Dream scenarios loaded successfully",
-            "scenarios_count": len(scenarios_data['dream_keywords']),
+            "scenarios_count": scenarios_count,
             "processed_scenarios": processed_scenarios,
+            # Scenariusze bez wstępnie przygotowanego audio (wyparte przez generowanie REM
+            # i żądania interaktywne) - audio powstanie przy fazie REM
+            "preempted_scenarios": preempted_scenario_indexes(generated_audio_data),
             "mobile_id": scenarios_data.get('mobile_id'),
             "generated_audio": generated_audio_data
         })
@@ -256,6 +514,34 @@ def load_dream_scenarios():
         }), 500
 
 
+@audio_handles.add_register_hook
+def retain_handle_audio(entry):
+    """Pliki dostępne przez handle nie są usuwane z magazynu audio dopóki handle nie wygaśnie"""
+    audio_store.retain(f"handle:{entry['handle_id']}", entry['audio_files'].values())
+
+@audio_handles.add_expire_hook
+def release_handle_audio(entry):
+    audio_store.release(f"handle:{entry['handle_id']}")
+
+audio_store.add_sweep_hook(audio_handles.prune)
+
+def build_audio_download_info(handle_id, audio_files):
+    """Opis plików do pobrania z adresami zbudowanymi z identyfikatora handle"""
+    return {
+        "handle_id": handle_id,
+        "session_key": handle_id,  # Kompatybilność wsteczna - dawny klucz sesji
+        "tts_available": "tts_file" in audio_files,
+        "sound_available": "sound_file" in audio_files,
+        "extended_available": "extended_file" in audio_files,
+        "playlist_available": all(f"{segment}_file" in audio_files for segment in PLAYLIST_SEGMENTS),
+        "download_urls": {
+            "tts": f"/mobile/download_audio/{handle_id}/tts",
+            "sound": f"/mobile/download_audio/{handle_id}/sound",
+            "extended": f"/mobile/download_audio/{handle_id}/extended",
+            "playlist": f"/mobile/playlist/{handle_id}.m3u8"
+        }
+    }
+
 @mobile_bp.route('/mobile/generate_audio', methods=['POST'])
 def generate_audio_on_demand():
     """
@@ -265,6 +551,8 @@ def generate_audio_on_demand():
         "key_words": "flying airplane clouds sky",
         "place": "high above mountains"
     }
+    Z parametrem ?async=true zadanie jest zlecane w tle (202 + job_id do sprawdzania statusu),
+    bez niego żądanie czeka na wynik zadania
     """
     try:
         data = request.get_json()
@@ -284,9 +572,39 @@ def generate_audio_on_demand():
                 "message": "At least one of 'key_words' or 'place' must be provided"
             }), 400
         
-        # Generujemy audio
+        if request.args.get('async', 'false').lower() == 'true':
+            # Zlecamy generowanie w tle - klient sprawdza status przez /mobile/jobs/<job_id>
+            try:
+                job = audio_jobs.submit(
+                    generate_sound, key_words, place,
+                    kind='on_demand', priority=PRIORITY_INTERACTIVE, user=data.get('mobile_id'),
+                    metadata={'mobile_id': data.get('mobile_id'), 'key_words': key_words, 'place': place}
+                )
+            except JobQueueFull as e:
+                return jsonify({"status": "error", "message": str(e)}), 503
+            publish_audio_job(job)
+            return jsonify({
+                "status": "queued",
+                "job_id": job['job_id'],
+                "status_url": f"/mobile/jobs/{job['job_id']}",
+                "result_url": f"/mobile/jobs/{job['job_id']}/result"
+            }), 202
+        
+        # Generujemy audio przez kolejkę zadań (priorytet interaktywny - przed wstępnym generowaniem,
+        # za generowaniem dla fazy REM) i czekamy na wynik
         print(f"Generowanie audio na żądanie: key_words='{key_words}', place='{place}'")
-        audio_result = generate_sound(key_words, place)
+        try:
+            job = audio_jobs.submit(
+                generate_sound, key_words, place,
+                kind='on_demand', priority=PRIORITY_INTERACTIVE, user=data.get('mobile_id'),
+                metadata={'key_words': key_words, 'place': place}
+            )
+        except JobQueueFull as e:
+            return jsonify({"status": "error", "message": str(e)}), 503
+        job = audio_jobs.wait(job['job_id'])
+        if job is None:
+            return jsonify({"status": "error", "message": "Audio job did not finish"}), 500
+        audio_result = job.get('result') or {"status": "error", "error": job.get('error')}
         
         # Przygotowujemy odpowiedź
         response = {
@@ -303,21 +621,15 @@ def generate_audio_on_demand():
             response["audio_available"] = True
             audio_files = audio_result["audio_files"]
             
-            # Zapisujemy ścieżki do plików w sesji dla późniejszego pobrania
-            session_key = f"audio_files_{datetime.now().timestamp()}"
-            session[session_key] = audio_files
-            
-            response["audio_download_info"] = {
-                "session_key": session_key,
-                "tts_available": "tts_file" in audio_files,
-                "sound_available": "sound_file" in audio_files,
-                "extended_available": "extended_file" in audio_files,
-                "download_urls": {
-                    "tts": f"/mobile/download_audio/{session_key}/tts",
-                    "sound": f"/mobile/download_audio/{session_key}/sound",
-                    "extended": f"/mobile/download_audio/{session_key}/extended"
+            # Rejestrujemy pliki po stronie serwera - klient dostaje tylko krótki identyfikator
+            handle_id = audio_handles.register(
+                audio_files,
+                metadata={
+                    'mobile_id': data.get('mobile_id'), 'key_words': key_words, 'place': place,
+                    'playlist': audio_result.get('playlist')
                 }
-            }
+            )
+            response["audio_download_info"] = build_audio_download_info(handle_id, audio_files)
         else:
             response["audio_available"] = False
             
@@ -334,35 +646,88 @@ def generate_audio_on_demand():
         }), 500
 
 
-@mobile_bp.route('/mobile/download_audio/<session_key>/<audio_type>')
-def download_audio(session_key, audio_type):
+@mobile_bp.route('/mobile/jobs/<job_id>')
+def audio_job_status(job_id):
+    """
+    Endpoint zwracający status zadania generowania audio (queued, running, done, error)
+    """
+    job = audio_jobs.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    
+    return jsonify({
+        "status": "success",
+        "job": summarize_audio_job(job),
+        "queue": audio_jobs.stats()
+    })
+
+
+@mobile_bp.route('/mobile/jobs/<job_id>/result')
+def audio_job_result(job_id):
+    """
+    Endpoint zwracający wynik zakończonego zadania generowania audio
+    (202 jeśli zadanie jeszcze trwa)
+    """
+    job = audio_jobs.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    
+    if job['status'] in ('queued', 'running'):
+        return jsonify({"status": job['status'], "job_id": job_id}), 202
+    
+    audio_result = job.get('result') or {}
+    audio_files = audio_result.get("audio_files") or {}
+    response = {
+        "status": audio_result.get("status", job['status']),
+        "job_id": job_id,
+        "tts_text": audio_result.get("tts_text"),
+        "sound_description": audio_result.get("sound_description"),
+        "message": audio_result.get("message"),
+        "audio_available": bool(audio_files),
+        "tts_available": "tts_file" in audio_files,
+        "sound_available": "sound_file" in audio_files,
+        "extended_available": "extended_file" in audio_files
+    }
+    if audio_files:
+        # Ten sam handle przy kolejnych odczytach wyniku zadania
+        handle_id = audio_handles.register(
+            audio_files, source_key=job_id,
+            metadata={**job.get('metadata', {}), 'playlist': audio_result.get('playlist')}
+        )
+        response["audio_download_info"] = build_audio_download_info(handle_id, audio_files)
+    if job.get('error'):
+        response["error"] = job['error']
+        return jsonify(response), 500
+    
+    return jsonify(response)
+
+
+@mobile_bp.route('/mobile/download_audio/<handle_id>/<audio_type>')
+def download_audio(handle_id, audio_type):
     """
     Endpoint do pobierania wygenerowanych plików audio
     
     Args:
-        session_key: Klucz sesji zawierający ścieżki do plików
-        audio_type: 'tts' lub 'sound'
+        handle_id: Identyfikator z rejestru plików audio (audio_download_info.handle_id)
+        audio_type: 'tts', 'sound', 'extended' lub segment playlisty ('intro', 'loop', 'outro')
     """
     try:
-        # Sprawdzamy czy mamy pliki w sesji
-        audio_files = session.get(session_key)
-        if not audio_files:
+        # Wyszukujemy pliki w rejestrze po stronie serwera
+        handle = audio_handles.get(handle_id)
+        if not handle:
             return jsonify({
                 "status": "error",
-                "message": "Audio files not found in session"
+                "message": "Audio files not found or expired"
             }), 404
+        audio_files = handle['audio_files']
             
-        # Określamy który plik pobierać
-        if audio_type == 'tts':
-            file_key = 'tts_file'
-        elif audio_type == 'sound':
-            file_key = 'sound_file'
-        elif audio_type == 'extended':
-            file_key = 'extended_file'
+        # Określamy który plik pobierać (intro/loop/outro to segmenty playlisty)
+        if audio_type in ('tts', 'sound', 'extended') + PLAYLIST_SEGMENTS:
+            file_key = f"{audio_type}_file"
         else:
             return jsonify({
                 "status": "error",
-                "message": "Invalid audio type. Use 'tts', 'sound', or 'extended'"
+                "message": "Invalid audio type. Use 'tts', 'sound', 'extended', 'intro', 'loop' or 'outro'"
             }), 400
             
         file_path = audio_files.get(file_key)
@@ -379,9 +744,26 @@ def download_audio(session_key, audio_type):
                 "message": "Audio file not found on disk"
             }), 404
             
-        # Zwracamy plik
-        filename = f"dream_audio_{audio_type}_{session_key}.mp3"
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        # Zwracamy plik - conditional=True obsługuje Range (206), If-None-Match i If-Modified-Since;
+        # przy USE_X_SENDFILE transfer wykonuje serwer frontowy, a pod gunicornem wsgi.file_wrapper
+        # używa sendfile
+        filename = f"dream_audio_{audio_type}_{handle_id}.mp3"
+        content_hash = audio_store.content_hash_for_path(file_path)
+        response = send_file(
+            file_path,
+            mimetype='audio/mpeg',
+            as_attachment=True,
+            download_name=filename,
+            conditional=True,
+            etag=content_hash or True,
+            max_age=current_app.config.get('AUDIO_DOWNLOAD_MAX_AGE', 365 * 24 * 3600) if content_hash else None
+        )
+        response.accept_ranges = 'bytes'
+        if content_hash:
+            # Blob adresowany zawartością nigdy się nie zmienia - silny ETag z hasha i długi cache
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        return response
         
     except Exception as e:
         return jsonify({
@@ -390,4 +772,54 @@ def download_audio(session_key, audio_type):
         }), 500
 
 
+def build_playlist(handle_id, playlist, total_seconds):
+    """
+    Buduje playlistę m3u8: intro, pętla powtórzona tyle razy ile trzeba do total_seconds, outro
 
+    Args:
+        handle_id (str): Identyfikator handle (adresy segmentów)
+        playlist (dict): Długości segmentów {'intro_ms', 'loop_ms', 'outro_ms'}
+        total_seconds (float): Docelowa długość odtwarzania
+    """
+    durations = {segment: (playlist.get(f"{segment}_ms") or 0) / 1000 for segment in PLAYLIST_SEGMENTS}
+    loop_count = 0
+    if durations['loop'] > 0:
+        loop_count = max(0, round((total_seconds - durations['intro'] - durations['outro']) / durations['loop']))
+    
+    entries = ['intro'] + ['loop'] * loop_count + ['outro']
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{max(1, math.ceil(max(durations.values())))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD"
+    ]
+    for segment in entries:
+        lines.append(f"#EXTINF:{durations[segment]:.3f},")
+        lines.append(f"/mobile/download_audio/{handle_id}/{segment}")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+@mobile_bp.route('/mobile/playlist/<handle_id>.m3u8')
+def audio_playlist(handle_id):
+    """
+    Endpoint zwracający playlistę m3u8 (intro + powtarzana pętla + outro) dla wygenerowanego audio
+    
+    Parametr ?minutes= określa długość odtwarzania (domyślnie 15 minut) - dłuższa sesja
+    nie wymaga dodatkowego renderowania, tylko większej liczby odwołań do segmentu pętli.
+    """
+    handle = audio_handles.get(handle_id)
+    if not handle:
+        return jsonify({"status": "error", "message": "Audio files not found or expired"}), 404
+    
+    playlist = handle['metadata'].get('playlist')
+    if not playlist or not all(f"{segment}_file" in handle['audio_files'] for segment in PLAYLIST_SEGMENTS):
+        return jsonify({"status": "error", "message": "Playlist not available for this audio"}), 404
+    
+    minutes = request.args.get('minutes', type=float) or EXTENDED_AUDIO_DURATION_SECONDS / 60
+    minutes = min(max(minutes, 1), current_app.config.get('PLAYLIST_MAX_MINUTES', 12 * 60))
+    
+    response = Response(build_playlist(handle_id, playlist, minutes * 60), mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
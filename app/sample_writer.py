@@ -0,0 +1,290 @@
+import atexit
+import io
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from .models import db
+from .sensor_buffers import HrRingBuffer, MpuRingBuffer, EmgRingBuffer
+
+# Rodzaj próbek -> (tabela, kolumny bufora); kolumna 'timestamp' zapisywana jest jako recorded_at
+SAMPLE_TABLES = {
+    'hr': ('hr_samples', HrRingBuffer.COLUMNS),
+    'mpu': ('mpu_samples', MpuRingBuffer.COLUMNS),
+    'emg': ('emg_samples', EmgRingBuffer.COLUMNS),
+}
+
+SQL_TYPES = {'f': 'REAL', 'd': 'DOUBLE PRECISION'}
+
+# Maksymalny odstęp ponowień zapisu przy niedostępnej bazie
+MAX_RETRY_BACKOFF_SECONDS = 30
+# Po błędzie odczytu nie odpytujemy bazy przez ten czas
+DB_RETRY_AFTER_SECONDS = 60
+
+
+def _sql_columns(columns):
+    return ['recorded_at' if name == 'timestamp' else name for name, _ in columns]
+
+
+def create_table_sql(table, columns):
+    """DDL tabeli próbek partycjonowanej zakresami czasu (partycje dzienne tworzone przy zapisie)"""
+    definitions = ['device_id TEXT NOT NULL', 'recorded_at TIMESTAMPTZ NOT NULL']
+    definitions += [f"{name} {SQL_TYPES[typecode]}" for name, typecode in columns if name != 'timestamp']
+    return (
+        f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(definitions)}) PARTITION BY RANGE (recorded_at);\n"
+        f"CREATE INDEX IF NOT EXISTS {table}_device_time ON {table} (device_id, recorded_at);"
+    )
+
+
+def partition_name(table, day):
+    return f"{table}_{day:%Y%m%d}"
+
+
+def create_partition_sql(table, day):
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    end = start + timedelta(days=1)
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(table, day)} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
+
+
+def rows_to_csv(rows):
+    """Zamienia wiersze (device_id, epoch, wartości...) na dane CSV dla COPY FROM STDIN"""
+    buffer = io.StringIO()
+    for row in rows:
+        device_id = str(row[0]).replace('"', '""')
+        recorded_at = datetime.fromtimestamp(row[1], timezone.utc).isoformat()
+        values = ','.join(repr(float(value)) for value in row[2:])
+        buffer.write(f'"{device_id}",{recorded_at},{values}\n')
+    buffer.seek(0)
+    return buffer
+
+
+class SampleWriter:
+    """
+    Zapis próbek sensorów do PostgreSQL w trybie write-behind.
+
+    Endpointy tylko dopisują próbki do ograniczonej kolejki w pamięci (bez zapytania do bazy
+    w żądaniu); wątek w tle co flush_interval sekund (lub po zebraniu batch_rows próbek)
+    zapisuje je paczkami przez COPY do tabel partycjonowanych dziennie. Gdy kolejka jest
+    pełna (np. baza niedostępna), nowe próbki są odrzucane i liczone w statystykach.
+    Przy zamknięciu procesu pozostałe próbki są zapisywane.
+
+    Konfiguracja (app.config):
+        SAMPLE_PERSISTENCE_ENABLED: Włącza zapis próbek do bazy
+        SAMPLE_WRITER_MAX_PENDING_ROWS: Limit próbek oczekujących na zapis
+        SAMPLE_WRITER_BATCH_ROWS: Liczba próbek wyzwalająca zapis przed upływem interwału
+        SAMPLE_WRITER_FLUSH_INTERVAL_SECONDS: Maksymalny czas oczekiwania próbki na zapis
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.max_pending_rows = 100000
+        self.batch_rows = 5000
+        self.flush_interval = 2.0
+        self._app = None
+        self._queue = deque()  # (rodzaj, wiersze)
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stopping = False
+        self._schema_ready = False
+        self._partitions = set()  # (tabela, dzień) już utworzone
+        self._db_unavailable_until = 0.0
+        self._counters = {'enqueued_rows': 0, 'written_rows': 0, 'dropped_rows': 0, 'batches': 0, 'errors': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('SAMPLE_PERSISTENCE_ENABLED', self.enabled)
+        self.max_pending_rows = app.config.get('SAMPLE_WRITER_MAX_PENDING_ROWS', self.max_pending_rows)
+        self.batch_rows = app.config.get('SAMPLE_WRITER_BATCH_ROWS', self.batch_rows)
+        self.flush_interval = app.config.get('SAMPLE_WRITER_FLUSH_INTERVAL_SECONDS', self.flush_interval)
+        self._app = app
+        app.extensions['sample_writer'] = self
+
+    def enqueue(self, kind, device_id, samples):
+        """
+        Kolejkuje do zapisu próbki dopisane do bufora sensora (O(len(samples)), bez dostępu do bazy)
+
+        Args:
+            kind (str): Rodzaj próbek ('hr', 'mpu', 'emg')
+            device_id (str): Urządzenie
+            samples: SampleBatch zwrócony przez add_samples bufora
+
+        Returns:
+            bool: False gdy zapis jest wyłączony albo kolejka pełna (próbki odrzucone)
+        """
+        if not self.enabled or not samples:
+            return False
+        names = [name for name, _ in SAMPLE_TABLES[kind][1]]
+        rows = [(device_id, *values) for values in samples.rows(names)]
+        with self._wakeup:
+            if self._pending_rows + len(rows) > self.max_pending_rows:
+                self._counters['dropped_rows'] += len(rows)
+                return False
+            self._queue.append((kind, rows))
+            self._pending_rows += len(rows)
+            self._counters['enqueued_rows'] += len(rows)
+            self._ensure_thread()
+            if self._pending_rows >= self.batch_rows:
+                self._wakeup.notify()
+        return True
+
+    def _ensure_thread(self):
+        # Wątek zapisu uruchamiany leniwie przy pierwszych próbkach (wywoływane pod blokadą)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop, name='sample-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _take_batch(self):
+        # Zabiera wszystkie oczekujące próbki pogrupowane wg rodzaju (wywoływane pod blokadą)
+        batch = {}
+        while self._queue:
+            kind, rows = self._queue.popleft()
+            batch.setdefault(kind, []).extend(rows)
+        return batch
+
+    def _flush_loop(self):
+        batch = {}
+        backoff = self.flush_interval
+        while True:
+            with self._wakeup:
+                if not batch:
+                    if not self._stopping and self._pending_rows < self.batch_rows:
+                        self._wakeup.wait(self.flush_interval)
+                    batch = self._take_batch()
+                stopping = self._stopping
+            if not batch:
+                if stopping:
+                    return
+                continue
+
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                with self._lock:
+                    self._counters['errors'] += 1
+                print(f"Error writing sensor samples: {e}")
+                if stopping:
+                    # Zamykanie procesu - nie czekamy na bazę w nieskończoność
+                    with self._lock:
+                        self._counters['dropped_rows'] += self._pending_rows
+                        self._queue.clear()
+                        self._pending_rows = 0
+                    return
+                # Paczka zostaje do ponowienia (dalej liczy się do limitu kolejki)
+                with self._wakeup:
+                    self._wakeup.wait(backoff)
+                backoff = min(backoff * 2, MAX_RETRY_BACKOFF_SECONDS)
+                continue
+
+            written = sum(len(rows) for rows in batch.values())
+            with self._lock:
+                self._pending_rows -= written
+                self._counters['written_rows'] += written
+                self._counters['batches'] += 1
+            batch = {}
+            backoff = self.flush_interval
+
+    def _write_batch(self, batch):
+        with self._app.app_context():
+            connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if not self._schema_ready:
+                for table, columns in SAMPLE_TABLES.values():
+                    cursor.execute(create_table_sql(table, columns))
+                self._schema_ready = True
+            for kind, rows in batch.items():
+                table, columns = SAMPLE_TABLES[kind]
+                days = {datetime.fromtimestamp(row[1], timezone.utc).date() for row in rows}
+                for day in days - {d for t, d in self._partitions if t == table}:
+                    cursor.execute(create_partition_sql(table, day))
+                    self._partitions.add((table, day))
+                sql_columns = ', '.join(['device_id'] + _sql_columns(columns))
+                cursor.copy_expert(f"COPY {table} ({sql_columns}) FROM STDIN WITH (FORMAT csv)", rows_to_csv(rows))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            # Partycje z wycofanej transakcji mogły nie powstać
+            self._partitions.clear()
+            self._schema_ready = False
+            raise
+        finally:
+            connection.close()
+
+    def load_recent(self, kind, device_id, limit, max_age_seconds):
+        """
+        Odczytuje z bazy ostatnie próbki urządzenia (odtwarzanie okna po restarcie procesu)
+
+        Returns:
+            dict: {kolumna bufora: lista wartości} od najstarszej próbki (puste przy błędzie)
+        """
+        table, columns = SAMPLE_TABLES[kind]
+        names = [name for name, _ in columns]
+        if not self.enabled or self._app is None or time.monotonic() < self._db_unavailable_until:
+            return {name: [] for name in names}
+        select_columns = ', '.join(
+            'EXTRACT(EPOCH FROM recorded_at)' if name == 'recorded_at' else name for name in _sql_columns(columns)
+        )
+        query = (
+            f"SELECT {select_columns} FROM {table} WHERE device_id = %s AND recorded_at > %s "
+            f"ORDER BY recorded_at DESC LIMIT %s"
+        )
+        since = datetime.fromtimestamp(time.time() - max_age_seconds, timezone.utc)
+        try:
+            with self._app.app_context():
+                connection = db.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(query, (device_id, since, limit))
+                rows = cursor.fetchall()
+                connection.rollback()
+            finally:
+                connection.close()
+        except Exception as e:
+            # Baza niedostępna - kolejne urządzenia nie czekają na nią przez DB_RETRY_AFTER_SECONDS
+            print(f"Error loading recent {kind} samples for {device_id}: {e}")
+            self._db_unavailable_until = time.monotonic() + DB_RETRY_AFTER_SECONDS
+            return {name: [] for name in names}
+        rows.reverse()
+        return {name: [float(row[index]) for row in rows] for index, name in enumerate(names)}
+
+    def flush(self, timeout=None):
+        """Czeka aż oczekujące próbki zostaną zapisane (True) albo upłynie timeout (False)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._wakeup:
+            self._wakeup.notify()
+        while True:
+            with self._lock:
+                if not self._pending_rows:
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def close(self, timeout=10):
+        """Zapisuje pozostałe próbki i zatrzymuje wątek zapisu (rejestrowane w atexit)"""
+        with self._wakeup:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._wakeup.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'enabled': self.enabled,
+                'pending_rows': self._pending_rows,
+                'max_pending_rows': self.max_pending_rows
+            }
+
+
+sample_writer = SampleWriter()
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_text(value):
+    """Normalizuje tekst wejściowy (wielkość liter, białe znaki) do klucza cache"""
+    return " ".join(str(value or "").split()).casefold()
+
+
+def make_cache_key(prompt_template, key_words, place, model, temperature):
+    """
+    Buduje klucz cache dla rozwinięcia scenariusza przez LLM
+
+    Returns:
+        str: Hash SHA-256 (hex) znormalizowanych parametrów zapytania
+    """
+    payload = json.dumps(
+        [prompt_template, normalize_text(key_words), normalize_text(place), model, float(temperature)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ScenarioCache:
+    """
+    Dwupoziomowy cache wyników LLM: LRU w pamięci oraz trwały cache na dysku (pliki JSON).
+
+    Wpisy na dysku wygasają po ttl_seconds, a gdy łączny rozmiar przekroczy max_disk_bytes,
+    usuwane są najdawniej używane pliki. Liczniki trafień/chybień dostępne są przez stats().
+
+    Args:
+        cache_dir (str): Katalog cache na dysku (None = tylko pamięć)
+        max_entries (int): Pojemność LRU w pamięci
+        ttl_seconds (int): Czas życia wpisu
+        max_disk_bytes (int): Limit rozmiaru cache na dysku
+    """
+
+    def __init__(self, cache_dir=None, max_entries=256, ttl_seconds=30 * 24 * 3600, max_disk_bytes=50 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()  # key -> (created_at, value)
+        self._disk_index = None  # key -> [rozmiar, czas ostatniego użycia]
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+    def init_app(self, app):
+        """
+        Konfiguracja (app.config):
+            SCENARIO_CACHE_DIR: Katalog cache na dysku (pusty = katalog domyślny)
+            SCENARIO_CACHE_MAX_ENTRIES: Pojemność LRU w pamięci
+            SCENARIO_CACHE_TTL_SECONDS: Czas życia wpisu
+            SCENARIO_CACHE_MAX_BYTES: Limit rozmiaru cache na dysku
+        """
+        with self._lock:
+            cache_dir = app.config.get('SCENARIO_CACHE_DIR') or self.cache_dir
+            if cache_dir != self.cache_dir:
+                # Indeks dysku zbudowany dla poprzedniego katalogu
+                self.cache_dir = cache_dir
+                self._disk_index = None
+            self.max_entries = app.config.get('SCENARIO_CACHE_MAX_ENTRIES', self.max_entries)
+            self.ttl_seconds = app.config.get('SCENARIO_CACHE_TTL_SECONDS', self.ttl_seconds)
+            self.max_disk_bytes = app.config.get('SCENARIO_CACHE_MAX_BYTES', self.max_disk_bytes)
+        app.extensions['scenario_cache'] = self
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _load_disk_index(self):
+        # Jednorazowe skanowanie katalogu przy pierwszym użyciu - dalej indeks aktualizowany przyrostowo
+        if self._disk_index is not None:
+            return
+        self._disk_index = {}
+        self._disk_bytes = 0
+        if not self.cache_dir or not os.path.isdir(self.cache_dir):
+            return
+        for root, _, files in os.walk(self.cache_dir):
+            for filename in files:
+                if not filename.endswith('.json'):
+                    continue
+                stat = os.stat(os.path.join(root, filename))
+                self._disk_index[filename[:-5]] = [stat.st_size, stat.st_mtime]
+                self._disk_bytes += stat.st_size
+
+    def _expired(self, created_at):
+        return self.ttl_seconds and time.time() - created_at > self.ttl_seconds
+
+    def _remember(self, key, created_at, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _remove_disk_entry(self, key):
+        size, _ = self._disk_index.pop(key, (0, 0))
+        self._disk_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """Zwraca zapisaną wartość lub None (chybienie lub wpis wygasły)"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._memory.move_to_end(key)
+                    self._counters['memory_hits'] += 1
+                    return entry[1]
+                del self._memory[key]
+
+            if self.cache_dir:
+                self._load_disk_index()
+                if key in self._disk_index:
+                    try:
+                        with open(self._path(key), 'r', encoding='utf-8') as f:
+                            record = json.load(f)
+                    except (OSError, ValueError):
+                        record = None
+                    if record and not self._expired(record.get('created_at', 0)):
+                        # Czas użycia zapisujemy też w mtime, aby kolejność LRU przetrwała restart
+                        now = time.time()
+                        self._disk_index[key][1] = now
+                        try:
+                            os.utime(self._path(key), (now, now))
+                        except OSError:
+                            pass
+                        self._remember(key, record['created_at'], record['value'])
+                        self._counters['disk_hits'] += 1
+                        return record['value']
+                    self._remove_disk_entry(key)
+
+            self._counters['misses'] += 1
+            return None
+
+    def set(self, key, value):
+        """Zapisuje wartość w obu poziomach cache"""
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, created_at, value)
+            self._counters['writes'] += 1
+            if not self.cache_dir:
+                return
+            self._load_disk_index()
+            path = self._path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                data = json.dumps({'created_at': created_at, 'value': value}, ensure_ascii=False).encode('utf-8')
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Error writing scenario cache entry: {e}")
+                return
+            previous_size = self._disk_index.get(key, [0, 0])[0]
+            self._disk_index[key] = [len(data), created_at]
+            self._disk_bytes += len(data) - previous_size
+            self._evict_disk()
+
+    def _evict_disk(self):
+        # Usuwamy najdawniej używane wpisy do 90% limitu (wywoływane pod blokadą)
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        target = self.max_disk_bytes * 0.9
+        for key, _ in sorted(self._disk_index.items(), key=lambda item: item[1][1]):
+            if self._disk_bytes <= target:
+                break
+            self._remove_disk_entry(key)
+            self._memory.pop(key, None)
+            self._counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters['memory_hits'] + self._counters['disk_hits'] + self._counters['misses']
+            hits = lookups - self._counters['misses']
+            return {
+                **self._counters,
+                'hit_ratio': hits / lookups if lookups else 0.0,
+                'memory_entries': len(self._memory),
+                'disk_entries': len(self._disk_index) if self._disk_index is not None else None,
+                'disk_bytes': self._disk_bytes
+            }
@@ -0,0 +1,344 @@
+import time
+from array import array
+
+from .rolling_stats import RollingWindowStats
+from .storage_backends import MemoryBackend
+
+# Okno wymagane przez rem_detection() - 15 minut danych przy próbkowaniu 1 Hz
+HR_WINDOW_SAMPLES = 900
+# Okno "bieżącego" HR porównywanego ze średnią 15-minutową - 30 sekund
+HR_RECENT_SAMPLES = 30
+
+# Backend buforów tworzonych bez wskazania backendu (pamięć procesu)
+LOCAL_BACKEND = MemoryBackend()
+
+
+class SampleBatch:
+    """
+    Próbki dopisane jednym wywołaniem add_samples - kopie kolumn zrobione pod blokadą bufora,
+    więc równoległe zapisy innych żądań (lub workerów) nie zmieniają ich zawartości.
+
+    Args:
+        columns (dict): {nazwa_kolumny: array z dopisanymi wartościami (od najstarszej)}
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), ()))
+
+    def rows(self, names=None):
+        """Iterator krotek wartości w kolejności kolumn names (domyślnie wszystkich)"""
+        return zip(*(self.columns[name] for name in (names or self.columns)))
+
+
+class SensorRingBuffer:
+    """
+    Bufor cykliczny o stałej pojemności przechowujący próbki jako ciągłe tablice typowane.
+
+    Każda kolumna jest tablicą `array` o długości 2 * capacity - każda próbka zapisywana jest
+    pod indeksem i oraz i + capacity. Dzięki temu ostatnie n próbek (n <= capacity) zawsze
+    leży w jednym ciągłym fragmencie pamięci i można je zwrócić jako memoryview bez kopiowania.
+
+    Opcjonalnie bufor usuwa próbki starsze niż retention_seconds (wg kolumny 'timestamp'),
+    więc zajęta pamięć jest stała niezależnie od długości sesji.
+
+    Kolumny i stan (head, size, total_appended) alokuje backend - w pamięci procesu albo
+    w pamięci współdzielonej przez workery (storage_backends). Dopisywanie paczek próbek
+    odbywa się pod blokadą backendu (self.lock).
+
+    Args:
+        columns: Sekwencja par (nazwa_kolumny, typecode z modułu array)
+        capacity (int): Maksymalna liczba przechowywanych próbek
+        retention_seconds (float): Okno retencji w sekundach (None = tylko limit pojemności)
+        backend: Backend alokujący pamięć bufora (domyślnie pamięć procesu)
+        device_id (str): Urządzenie, do którego należy bufor (klucz w backendzie)
+    """
+
+    KIND = 'sensor'
+
+    def __init__(self, columns, capacity, retention_seconds=None, backend=None, device_id=None):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.retention_seconds = retention_seconds
+        self._columns, self._state, self.lock = (backend or LOCAL_BACKEND).allocate(
+            device_id, self.KIND, columns, capacity
+        )
+
+    # Stan bufora trzymany w tablicy backendu (wspólny dla procesów przy pamięci współdzielonej)
+    @property
+    def _head(self):
+        # indeks następnego zapisu w zakresie [0, capacity)
+        return self._state[0]
+
+    @_head.setter
+    def _head(self, value):
+        self._state[0] = value
+
+    @property
+    def _size(self):
+        return self._state[1]
+
+    @_size.setter
+    def _size(self, value):
+        self._state[1] = value
+
+    @property
+    def total_appended(self):
+        # licznik wszystkich zapisów (nie maleje przy nadpisywaniu/czyszczeniu)
+        return self._state[2]
+
+    @total_appended.setter
+    def total_appended(self, value):
+        self._state[2] = value
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def column_names(self):
+        return tuple(self._columns)
+
+    def append(self, **values):
+        """Dodaje jedną próbkę w czasie O(1), nadpisując najstarszą gdy bufor jest pełny"""
+        head = self._head
+        mirror = head + self.capacity
+        for name, column in self._columns.items():
+            value = values.get(name, 0)
+            column[head] = value
+            column[mirror] = value
+        self._head = (head + 1) % self.capacity
+        if self._size < self.capacity:
+            self._size += 1
+        self.total_appended += 1
+
+    def evict_expired(self, now=None):
+        """
+        Usuwa najstarsze próbki spoza okna retencji (zamortyzowane O(1) na próbkę)
+
+        Returns:
+            int: Liczba usuniętych próbek
+        """
+        if not self.retention_seconds or not self._size:
+            return 0
+        if now is None:
+            now = time.time()
+        cutoff = now - self.retention_seconds
+        timestamps = self._columns['timestamp']
+        evicted = 0
+        # Najstarsza próbka leży pod indeksem head + capacity - size
+        while self._size and timestamps[self._head + self.capacity - self._size] < cutoff:
+            self._size -= 1
+            evicted += 1
+        return evicted
+
+    def window(self, column, n=None):
+        """
+        Zwraca ostatnie n wartości kolumny (od najstarszej) jako memoryview bez kopiowania
+
+        Args:
+            column (str): Nazwa kolumny
+            n (int): Liczba ostatnich próbek (domyślnie wszystkie przechowywane)
+        """
+        if n is None or n > self._size:
+            n = self._size
+        end = self._head + self.capacity
+        return memoryview(self._columns[column])[end - n:end]
+
+    def _copy_appended(self, count):
+        # Kopia ostatnich count próbek (wywoływane pod self.lock, zaraz po dopisaniu)
+        columns = {}
+        for name in self._columns:
+            view = self.window(name, count)
+            values = array(view.format)
+            values.frombytes(view.cast('B'))
+            columns[name] = values
+        return SampleBatch(columns)
+
+    def latest(self, column):
+        """Zwraca najnowszą wartość kolumny lub None gdy bufor jest pusty"""
+        if not self._size:
+            return None
+        return self._columns[column][self._head - 1 + self.capacity]
+
+    def clear(self):
+        self._head = 0
+        self._size = 0
+
+    def nbytes(self):
+        """Rozmiar zaalokowanych tablic w bajtach"""
+        return sum(column.itemsize * len(column) for column in self._columns.values())
+
+
+class HrRingBuffer(SensorRingBuffer):
+    """
+    Bufor próbek z pulsoksymetru: czas otrzymania (epoch), heart_rate i spo2.
+
+    Przy każdym dodaniu próbki aktualizuje statystyki kroczące HR dla trzech okien:
+    'all' (cały bufor), 'detection' (15 minut) i 'recent' (30 sekund). Statystyki są lokalne
+    dla procesu - gdy próbki dopisał inny proces (pamięć współdzielona), są przeliczane
+    z okna przy odczycie.
+    """
+
+    KIND = 'hr'
+
+    COLUMNS = (
+        ('timestamp', 'd'),
+        ('heart_rate', 'f'),
+        ('spo2', 'f'),
+    )
+
+    def __init__(self, capacity=HR_WINDOW_SAMPLES, backend=None, device_id=None):
+        # Bufor musi zawsze pomieścić pełne okno detekcji REM
+        super().__init__(self.COLUMNS, max(capacity, HR_WINDOW_SAMPLES), backend=backend, device_id=device_id)
+        self._stats = {
+            'all': RollingWindowStats(self.capacity),
+            'detection': RollingWindowStats(HR_WINDOW_SAMPLES),
+            'recent': RollingWindowStats(HR_RECENT_SAMPLES),
+        }
+        self._stats_marker = None  # (total_appended, size) odpowiadające statystykom
+        self._rebuild_stats()
+
+    @property
+    def stats(self):
+        if self._stats_marker != (self.total_appended, self._size):
+            with self.lock:
+                self._rebuild_stats()
+        return self._stats
+
+    def _rebuild_stats(self):
+        # Przelicza statystyki z okna bufora (O(capacity)) - tylko po zapisach innego procesu
+        for window_stats in self._stats.values():
+            window_stats.reset()
+            for heart_rate in self.heart_rates(window_stats.size):
+                window_stats.push(heart_rate)
+        self._stats_marker = (self.total_appended, self._size)
+
+    def append(self, **values):
+        if self._stats_marker != (self.total_appended, self._size):
+            self._rebuild_stats()
+        heart_rate = values.get('heart_rate', 0)
+        heart_rates = self._columns['heart_rate']
+        end = self._head + self.capacity
+        for window_stats in self._stats.values():
+            # Wartość wypadająca z okna to próbka sprzed `size` pozycji
+            leaving = heart_rates[end - window_stats.size] if self._size >= window_stats.size else None
+            window_stats.push(heart_rate, leaving)
+        super().append(**values)
+        for window_stats in self._stats.values():
+            if window_stats.needs_resync():
+                window_stats.resync(self.heart_rates(window_stats.size))
+        self._stats_marker = (self.total_appended, self._size)
+
+    def clear(self):
+        super().clear()
+        for window_stats in self._stats.values():
+            window_stats.reset()
+        self._stats_marker = (self.total_appended, self._size)
+
+    def add_samples(self, plethysmometer_data, received_at=None):
+        """
+        Dodaje próbki w formacie JSON z urządzenia ({"heart_rate": .., "spo2": ..})
+
+        Returns:
+            SampleBatch: Dodane próbki (kopia odczytana pod blokadą bufora)
+        """
+        if received_at is None:
+            received_at = time.time()
+        added = 0
+        with self.lock:
+            for entry in plethysmometer_data:
+                self.append(
+                    timestamp=received_at,
+                    heart_rate=entry['heart_rate'],
+                    spo2=entry.get('spo2') or 0.0
+                )
+                added += 1
+            return self._copy_appended(added)
+
+    def heart_rates(self, n=None):
+        return self.window('heart_rate', n)
+
+
+class MpuRingBuffer(SensorRingBuffer):
+    """Bufor próbek MPU: akcelerometr i żyroskop jako float32 oraz czas otrzymania (epoch)"""
+
+    KIND = 'mpu'
+
+    COLUMNS = (
+        ('timestamp', 'd'),
+        ('accel_x', 'f'),
+        ('accel_y', 'f'),
+        ('accel_z', 'f'),
+        ('rot_x', 'f'),
+        ('rot_y', 'f'),
+        ('rot_z', 'f'),
+        ('temperature', 'f'),
+    )
+
+    def __init__(self, capacity, retention_seconds=None, backend=None, device_id=None):
+        super().__init__(self.COLUMNS, capacity, retention_seconds, backend, device_id)
+
+    def add_samples(self, mpu_samples, received_at=None):
+        """
+        Dodaje próbki MPU w formacie JSON z urządzenia ({"acceleration": {..}, "rotation": {..}})
+
+        Returns:
+            SampleBatch: Dodane próbki (kopia odczytana pod blokadą bufora)
+        """
+        if received_at is None:
+            received_at = time.time()
+        added = 0
+        with self.lock:
+            for sample in mpu_samples:
+                acceleration = sample.get('acceleration') or {}
+                rotation = sample.get('rotation') or {}
+                self.append(
+                    timestamp=received_at,
+                    accel_x=acceleration.get('x', 0.0),
+                    accel_y=acceleration.get('y', 0.0),
+                    accel_z=acceleration.get('z', 0.0),
+                    rot_x=rotation.get('x', 0.0),
+                    rot_y=rotation.get('y', 0.0),
+                    rot_z=rotation.get('z', 0.0),
+                    temperature=sample.get('temperature') or 0.0
+                )
+                added += 1
+            self.evict_expired(received_at)
+            return self._copy_appended(added)
+
+
+class EmgRingBuffer(SensorRingBuffer):
+    """Bufor próbek EMG: obwiednia napięcia mięśni jako float32 oraz czas otrzymania (epoch)"""
+
+    KIND = 'emg'
+
+    COLUMNS = (
+        ('timestamp', 'd'),
+        ('envelope', 'f'),
+    )
+
+    def __init__(self, capacity, retention_seconds=None, backend=None, device_id=None):
+        super().__init__(self.COLUMNS, capacity, retention_seconds, backend, device_id)
+
+    def add_samples(self, emg_samples, received_at=None):
+        """
+        Dodaje próbki EMG w formacie JSON z urządzenia ({"envelope": ..} lub {"muscle_tone": ..})
+
+        Returns:
+            SampleBatch: Dodane próbki (kopia odczytana pod blokadą bufora)
+        """
+        if received_at is None:
+            received_at = time.time()
+        added = 0
+        with self.lock:
+            for sample in emg_samples:
+                envelope = sample.get('envelope')
+                if envelope is None:
+                    envelope = sample.get('muscle_tone', 0.0)
+                self.append(timestamp=received_at, envelope=envelope)
+                added += 1
+            self.evict_expired(received_at)
+            return self._copy_appended(added)
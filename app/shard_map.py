@@ -0,0 +1,225 @@
+import bisect
+import hashlib
+import hmac
+import threading
+
+import httpx
+from flask import Response, jsonify, redirect, request
+
+# Nagłówek żądań przekazanych przez inny węzeł - węzeł docelowy obsługuje je lokalnie
+FORWARDED_HEADER = 'X-Shard-Forwarded'
+# Nagłówek ze wspólnym sekretem węzłów (wymagany przy FORWARDED_HEADER i na /cluster/*)
+SECRET_HEADER = 'X-Cluster-Secret'
+
+# Nagłówki odpowiedzi węzła właściciela przepisywane do klienta
+FORWARDED_RESPONSE_HEADERS = ('Content-Type', 'ETag', 'Cache-Control', 'Retry-After')
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.sha1(str(value).encode('utf-8')).digest()[:8], 'big')
+
+
+def normalize_node(url):
+    return url.strip().rstrip('/')
+
+
+class ConsistentHashRing:
+    """
+    Pierścień spójnego haszowania: każdy węzeł ma virtual_nodes punktów na pierścieniu,
+    a klucz należy do pierwszego punktu za jego haszem. Dołączenie lub odejście węzła
+    przenosi tylko ok. 1/N kluczy.
+
+    Args:
+        nodes: Adresy węzłów (np. 'http://api-1:5000')
+        virtual_nodes (int): Liczba punktów węzła na pierścieniu (wyrównuje rozkład kluczy)
+    """
+
+    def __init__(self, nodes, virtual_nodes=64):
+        self.nodes = sorted({normalize_node(node) for node in nodes if node.strip()})
+        self.virtual_nodes = virtual_nodes
+        points = sorted(
+            (_hash(f"{node}#{replica}"), node) for node in self.nodes for replica in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        """Węzeł właściciela klucza (None przy pustym pierścieniu)"""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class ShardRouter:
+    """
+    Mapa shardów urządzeń: każde device_id ma jeden węzeł właściciela wyznaczony przez
+    spójne haszowanie, więc gorący stan urządzenia (bufory sensorów, stan REM) żyje tylko
+    w pamięci właściciela i read-modify-write w /embedded/flags nie wymaga koordynacji.
+
+    Żądanie urządzenia trafiające do innego węzła jest przekazywane do właściciela (proxy,
+    pula połączeń httpx) albo przekierowywane (307). Gdy właściciel nie odpowiada, żądanie
+    jest obsługiwane lokalnie. Zmiana listy węzłów (set_nodes) przebudowuje pierścień
+    i wywołuje funkcję zarejestrowaną dekoratorem rebalance_handler, która oddaje nowym
+    właścicielom urządzenia, które przestały należeć do tego węzła.
+
+    Lista węzłów jest stanem procesu - przy kilku workerach na węźle zmiana przez
+    /cluster/nodes trafia do jednego z nich, więc docelowo listę ustawia konfiguracja.
+
+    Żądania między węzłami niosą wspólny sekret (SECRET_HEADER) - żądanie z FORWARDED_HEADER
+    bez poprawnego sekretu jest odrzucane (403), tak jak żądania do /cluster/*.
+
+    Konfiguracja (app.config):
+        CLUSTER_NODES: Adresy węzłów oddzielone przecinkami (pusta lista = sharding wyłączony)
+        CLUSTER_NODE_URL: Adres tego węzła (węzeł spoza CLUSTER_NODES przekazuje wszystkie urządzenia)
+        SHARD_VIRTUAL_NODES: Liczba punktów węzła na pierścieniu
+        SHARD_ROUTING: 'forward' (proxy do właściciela) albo 'redirect' (307 na adres właściciela)
+        SHARD_FORWARD_TIMEOUT_SECONDS: Limit czasu żądania przekazanego do właściciela
+        CLUSTER_SECRET: Wspólny sekret węzłów (wymagany gdy CLUSTER_NODES jest ustawione)
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.node_url = None
+        self.routing = 'forward'
+        self.virtual_nodes = 64
+        self.forward_timeout = 10
+        self.secret = ''
+        self.ring = ConsistentHashRing([])
+        self._client = None
+        self._rebalance_handler = None
+        self._lock = threading.Lock()
+        self._counters = {'local': 0, 'forwarded': 0, 'redirected': 0, 'forward_errors': 0, 'rebalances': 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.routing = app.config.get('SHARD_ROUTING', self.routing)
+        if self.routing not in ('forward', 'redirect'):
+            raise ValueError(f"Unknown SHARD_ROUTING: {self.routing}")
+        self.virtual_nodes = app.config.get('SHARD_VIRTUAL_NODES', self.virtual_nodes)
+        self.forward_timeout = app.config.get('SHARD_FORWARD_TIMEOUT_SECONDS', self.forward_timeout)
+        self.node_url = normalize_node(app.config.get('CLUSTER_NODE_URL') or '') or None
+        self.secret = app.config.get('CLUSTER_SECRET') or ''
+        if app.config.get('CLUSTER_NODES') and not self.secret:
+            raise ValueError("CLUSTER_SECRET is required when CLUSTER_NODES is set")
+        self._set_ring((app.config.get('CLUSTER_NODES') or '').split(','))
+        app.before_request(self._reject_unauthorized_forward)
+        app.extensions['shard_router'] = self
+
+    def authorized(self):
+        """Czy bieżące żądanie ma poprawny sekret klastra (porównanie w stałym czasie)"""
+        if not self.secret:
+            return False
+        provided = request.headers.get(SECRET_HEADER, '').encode('utf-8')
+        return hmac.compare_digest(provided, self.secret.encode('utf-8'))
+
+    def _reject_unauthorized_forward(self):
+        # Nagłówek FORWARDED_HEADER omija routing do właściciela - akceptujemy go tylko od węzłów klastra
+        if request.headers.get(FORWARDED_HEADER) and not self.authorized():
+            return jsonify({"error": "Invalid cluster secret"}), 403
+        return None
+
+    def _set_ring(self, nodes):
+        ring = ConsistentHashRing(nodes, self.virtual_nodes)
+        # Węzeł spoza listy (np. odłączany) jest włączony - oddaje i przekazuje wszystkie urządzenia
+        enabled = bool(ring.nodes) and ring.nodes != [self.node_url]
+        if enabled and self.node_url is None:
+            print("Brak CLUSTER_NODE_URL - sharding wyłączony")
+            enabled = False
+        with self._lock:
+            self.ring = ring
+            self.enabled = enabled
+        return ring
+
+    def rebalance_handler(self, handler):
+        """Rejestruje funkcję handler() wywoływaną po zmianie listy węzłów"""
+        self._rebalance_handler = handler
+        return handler
+
+    def set_nodes(self, nodes):
+        """
+        Ustawia nową listę węzłów (dołączenie/odejście węzła) i przenosi shardy
+
+        Returns:
+            dict: Wynik funkcji rebalance_handler (np. liczba oddanych urządzeń)
+        """
+        self._set_ring(nodes)
+        with self._lock:
+            self._counters['rebalances'] += 1
+        if self._rebalance_handler is None:
+            return {}
+        return self._rebalance_handler() or {}
+
+    def owner(self, device_id):
+        """Węzeł właściciela urządzenia (None gdy sharding jest wyłączony)"""
+        if not self.enabled or device_id is None:
+            return None
+        return self.ring.owner(device_id)
+
+    def is_local(self, device_id):
+        owner = self.owner(device_id)
+        return owner is None or owner == self.node_url
+
+    def _http_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = httpx.Client(timeout=httpx.Timeout(float(self.forward_timeout), connect=2.0))
+        return self._client
+
+    def route(self, device_id):
+        """
+        Kieruje bieżące żądanie urządzenia do węzła właściciela (wywoływane w before_request)
+
+        Returns:
+            Response: Odpowiedź właściciela albo przekierowanie; None gdy żądanie należy
+                obsłużyć lokalnie (ten węzeł jest właścicielem, żądanie już przekazane,
+                właściciel nieosiągalny)
+        """
+        owner = self.owner(device_id)
+        if owner is None or owner == self.node_url or request.headers.get(FORWARDED_HEADER):
+            self._count('local')
+            return None
+        path = request.full_path.rstrip('?')
+        if self.routing == 'redirect':
+            self._count('redirected')
+            return redirect(f"{owner}{path}", code=307)
+        try:
+            response = self.forward(owner, request.method, path, request.get_data(), request.headers.get('Content-Type'))
+        except httpx.HTTPError as e:
+            print(f"Węzeł {owner} (właściciel {device_id}) nie odpowiada: {e} - obsługa lokalna")
+            self._count('forward_errors')
+            return None
+        self._count('forwarded')
+        headers = {name: response.headers[name] for name in FORWARDED_RESPONSE_HEADERS if name in response.headers}
+        return Response(response.content, status=response.status_code, headers=headers)
+
+    def forward(self, node, method, path, body=None, content_type=None):
+        """
+        Wysyła żądanie do innego węzła z nagłówkiem FORWARDED_HEADER (węzeł docelowy go nie przekazuje)
+
+        Raises:
+            httpx.HTTPError: Gdy węzeł nie odpowiada
+        """
+        headers = {FORWARDED_HEADER: self.node_url or '1', SECRET_HEADER: self.secret}
+        if content_type:
+            headers['Content-Type'] = content_type
+        return self._http_client().request(method, f"{node}{path}", content=body, headers=headers)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._counters,
+                'enabled': self.enabled,
+                'node_url': self.node_url,
+                'nodes': list(self.ring.nodes),
+                'routing': self.routing
+            }
+
+
+shard_router = ShardRouter()
@@ -0,0 +1,66 @@
+import threading
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Łączenie identycznych równoległych wywołań (single-flight).
+
+    Pierwsze wywołanie dla danego klucza wykonuje funkcję, a wywołania z tym samym kluczem,
+    które przyjdą w trakcie, czekają na jego wynik zamiast powtarzać pracę. Wyjątek
+    wykonania przekazywany jest wszystkim oczekującym. Po zakończeniu klucz jest zwalniany -
+    wyników nie zapamiętujemy (od tego są cache scenariuszy i magazyn audio).
+    """
+
+    def __init__(self):
+        self._flights = {}  # klucz -> _Flight w trakcie wykonania
+        self._lock = threading.Lock()
+        self._counters = {'executed': 0, 'coalesced': 0}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Wykonuje func(*args, **kwargs) albo dołącza do trwającego wywołania z tym samym kluczem
+
+        Returns:
+            tuple: (wynik, shared) - shared=True gdy wynik pochodzi z cudzego wywołania
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self._counters['coalesced'] += 1
+                leader = False
+            else:
+                flight = self._flights[key] = _Flight()
+                self._counters['executed'] += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = func(*args, **kwargs)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, 'in_flight': len(self._flights)}
@@ -1,10 +1,110 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from openai import OpenAI
-from elevenlabs.client import ElevenLabs
+import copy
 import json
 import io
 
+from .scenario_cache import ScenarioCache, make_cache_key, normalize_text
+from .single_flight import SingleFlight
+from .api_clients import api_clients, CircuitOpenError
+from .audio_store import AudioAssetStore, make_asset_key
+from .audio_render import render_extended_audio, render_playlist_segments
+from .mp3_frames import join_buffers, mp3_duration_ms, plan_looped_frames, write_buffers
+
+# Parametry zapytania DeepSeek - wchodzą do klucza cache rozwinięć scenariuszy
+DEEPSEEK_MODEL = "deepseek-chat"
+DEEPSEEK_TEMPERATURE = 0.7
+DREAM_SCENARIO_PROMPT_TEMPLATE = """
+        Jesteś ekspertem od świadomych snów. Na podstawie podanych słów kluczowych i miejsca, wygeneruj:
+
+        1. TEKST_TTS: Krótki, uspokajający tekst (Do 50 słów) po polsku, który pomoże osobie śniącej uświadomić sobie, że śni. Tekst powinien być łagodny i pomocny w osiągnięciu świadomego snu.
+
+        2. OPIS_DZWIEKU: Krótki opis efektu dźwiękowego po angielsku (max 300 znaków). Konkretne dźwięki ambientowe związane z miejscem i słowami kluczowymi.
+
+        SŁOWA KLUCZOWE: {key_words}
+        MIEJSCE: {place}
+
+        Odpowiedz w formacie JSON:
+        {{
+            "tts_text": "tekst do TTS po polsku",
+            "sound_description": "opis dźwięku po angielsku"
+        }}
+        """
+
+# Cache rozwinięć scenariuszy (LRU w pamięci + trwały cache na dysku; limity z app.config)
+scenario_cache = ScenarioCache(
+    cache_dir=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'cache', 'scenarios')
+)
+
+# Parametry ElevenLabs - wchodzą do kluczy zasobów audio
+TTS_VOICE_ID = "EXAVITQu4vr4xnSDxMaL"  # Bella - wielojęzyczny głos
+TTS_MODEL_ID = "eleven_multilingual_v2"
+SOUND_EFFECT_MODEL_ID = "eleven_text_to_sound_v2"  # Model dla efektów dźwiękowych
+SOUND_EFFECT_DURATION_SECONDS = 30.0
+EXTENDED_AUDIO_DURATION_SECONDS = 15 * 60
+# Zmiana sposobu renderowania rozszerzonego audio wymaga podbicia wersji (unieważnia stare zasoby)
+EXTENDED_RENDERER_VERSION = 3
+
+# Parametry miksowania rozszerzonego audio
+EXTENDED_FADE_IN_MS = 10000  # 10 sekund
+EXTENDED_FADE_OUT_MS = 5000  # 5 sekund
+EXTENDED_BACKGROUND_GAIN_DB = -15  # Ściszenie tła, żeby TTS było wyraźnie słyszalne
+
+PLAYLIST_SEGMENTS = ('intro', 'loop', 'outro')
+
+
+class SoundSettings:
+    """
+    Ustawienia generowania audio z konfiguracji aplikacji oraz pula wątków wywołań ElevenLabs
+    (TTS i sound effect w jednym scenariuszu równolegle).
+
+    Konfiguracja (app.config):
+        ELEVENLABS_MAX_PARALLEL: Rozmiar puli wątków wywołań ElevenLabs
+        EXTENDED_RENDER_CHUNK_MS: Długość kawałka renderowania przekazywanego do enkodera MP3
+        AUDIO_OUTPUT_FORMATS: Generowane formaty odtwarzania: 'extended' (jeden 15-minutowy plik)
+            i/lub 'playlist' (segmenty intro/pętla/outro składane w playlistę m3u8)
+    """
+
+    def __init__(self, app=None):
+        self.elevenlabs_max_parallel = 8
+        self.render_chunk_ms = 5000
+        self.output_formats = ('extended', 'playlist')
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.elevenlabs_max_parallel = app.config.get('ELEVENLABS_MAX_PARALLEL', self.elevenlabs_max_parallel)
+        self.render_chunk_ms = app.config.get('EXTENDED_RENDER_CHUNK_MS', self.render_chunk_ms)
+        self.output_formats = tuple(app.config.get('AUDIO_OUTPUT_FORMATS', self.output_formats))
+        with self._lock:
+            if self._executor is not None and self._executor._max_workers != self.elevenlabs_max_parallel:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+        app.extensions['sound_settings'] = self
+
+    def executor(self):
+        """Pula wątków ElevenLabs (tworzona przy pierwszym użyciu)"""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.elevenlabs_max_parallel, thread_name_prefix='elevenlabs'
+                    )
+        return self._executor
+
+
+sound_settings = SoundSettings()
+
+# Magazyn plików audio adresowany zawartością (duplikaty wskazują na jeden plik)
+audio_store = AudioAssetStore(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'audio_files'))
+
+# Równoległe identyczne wywołania generate_sound (te same key_words i place) współdzielą jedno wykonanie
+sound_flights = SingleFlight()
+
 # Import shared storage for mobile session scenarios
 def get_shared_storage():
     """Import shared storage - lazy import aby uniknąć cyklicznych importów"""
@@ -84,43 +184,37 @@ def process_dream_scenario(key_words, place):
     Returns:
         dict: Zawiera wygenerowany tekst TTS i opis dźwięku
     """
+    # Identyczne zapytania (te same słowa kluczowe i miejsce) obsługujemy z cache bez wywołania LLM
+    cache_key = make_cache_key(DREAM_SCENARIO_PROMPT_TEMPLATE, key_words, place, DEEPSEEK_MODEL, DEEPSEEK_TEMPERATURE)
+    cached_result = scenario_cache.get(cache_key)
+    if cached_result is not None:
+        print(f"DeepSeek cache hit: {cache_key[:12]}")
+        return dict(cached_result)
+
     try:
         # Konfiguracja DeepSeek API
         deepseek_api_key = os.getenv('DEEPSEEK_API_KEY')
         if not deepseek_api_key:
             raise ValueError("DEEPSEEK_API_KEY not found in environment variables")
 
-        client = OpenAI(
-            api_key=deepseek_api_key,
-            base_url="https://api.deepseek.com"
+        # Współdzielony klient z pulą połączeń; limit czasu i ponowienia etapu 'scenario'
+        client = api_clients.deepseek(deepseek_api_key).with_options(
+            timeout=api_clients.stage_timeout('scenario'),
+            max_retries=api_clients.stage_max_retries['scenario']
         )
 
         # Przygotowanie prompta dla DeepSeek
-        prompt = f"""
-        Jesteś ekspertem od świadomych snów. Na podstawie podanych słów kluczowych i miejsca, wygeneruj:
-
-        1. TEKST_TTS: Krótki, uspokajający tekst (Do 50 słów) po polsku, który pomoże osobie śniącej uświadomić sobie, że śni. Tekst powinien być łagodny i pomocny w osiągnięciu świadomego snu.
-
-        2. OPIS_DZWIEKU: Krótki opis efektu dźwiękowego po angielsku (max 300 znaków). Konkretne dźwięki ambientowe związane z miejscem i słowami kluczowymi.
+        prompt = DREAM_SCENARIO_PROMPT_TEMPLATE.format(key_words=key_words, place=place)
 
-        SŁOWA KLUCZOWE: {key_words}
-        MIEJSCE: {place}
-
-        Odpowiedz w formacie JSON:
-        {{
-            "tts_text": "tekst do TTS po polsku",
-            "sound_description": "opis dźwięku po angielsku"
-        }}
-        """
-
-        # Wywołanie DeepSeek API
-        response = client.chat.completions.create(
-            model="deepseek-chat",
+        # Wywołanie DeepSeek API (przy otwartym obwodzie od razu fallback poniżej)
+        response = api_clients.call(
+            'scenario', client.chat.completions.create,
+            model=DEEPSEEK_MODEL,
             messages=[
                 {"role": "user", "content": prompt}
             ],
             max_tokens=500,
-            temperature=0.7
+            temperature=DEEPSEEK_TEMPERATURE
         )
 
         # Parsowanie odpowiedzi
@@ -134,6 +228,9 @@ def process_dream_scenario(key_words, place):
             if json_start != -1 and json_end > json_start:
                 json_content = content[json_start:json_end]
                 result = json.loads(json_content)
+                # Zapamiętujemy tylko poprawne odpowiedzi LLM (nie fallbacki)
+                if result.get("tts_text") and result.get("sound_description"):
+                    scenario_cache.set(cache_key, result)
             else:
                 # Fallback - tworzymy domyślną odpowiedź
                 result = {
@@ -159,10 +256,55 @@ def process_dream_scenario(key_words, place):
         }
 
 
+def synthesize_tts(client, tts_text):
+    """Generuje TTS przez ElevenLabs i zwraca bajty MP3"""
+    print(f"Generating TTS for: {tts_text[:100]}...")
+    tts_audio = client.text_to_speech.convert(
+        text=tts_text,
+        voice_id=TTS_VOICE_ID,
+        model_id=TTS_MODEL_ID,
+        request_options=api_clients.request_options('tts')
+    )
+    return b"".join(chunk for chunk in tts_audio)
+
+
+def synthesize_sound_effect(client, sound_description):
+    """Generuje 30-sekundową pętlę efektu dźwiękowego przez ElevenLabs i zwraca bajty MP3"""
+    print(f"Generating sound effect for: {sound_description[:100]}...")
+    sound_effect = client.text_to_sound_effects.convert(
+        text=sound_description,
+        loop=True,  # Tworzymy pętlę dźwiękową
+        duration_seconds=SOUND_EFFECT_DURATION_SECONDS,  # 30 sekund jak wymagane
+        model_id=SOUND_EFFECT_MODEL_ID,
+        request_options=api_clients.request_options('sound_effect')
+    )
+    return b"".join(chunk for chunk in sound_effect)
+
+
+def extended_asset_key(tts_key, sound_key, renderer):
+    """Klucz 15-minutowego audio; renderer 'pydub' (zmiksowane) albo 'simple' (sama pętla tła)"""
+    return make_asset_key(
+        'extended', tts_key=tts_key, sound_key=sound_key,
+        duration_seconds=EXTENDED_AUDIO_DURATION_SECONDS, renderer_version=EXTENDED_RENDERER_VERSION,
+        renderer=renderer
+    )
+
+
+def playlist_segment_key(segment, tts_key, sound_key, renderer):
+    """Klucz segmentu playlisty; renderer 'pydub' (zmiksowany) albo 'simple' (surowy TTS/pętla)"""
+    return make_asset_key(
+        'segment', segment=segment, tts_key=tts_key, sound_key=sound_key,
+        renderer_version=EXTENDED_RENDERER_VERSION, renderer=renderer
+    )
+
+
 def generate_sound(key_words, place):
     """
     Główna funkcja generująca dźwięk na podstawie scenariusza snu
 
+    Wywołania dla tego samego scenariusza (po normalizacji key_words i place), które nakładają
+    się w czasie, wykonują generowanie raz i dostają ten sam wynik.
+
     Args:
         key_words (str): Słowa kluczowe opisujące sen
         place (str): Miejsce w którym toczy się sen
@@ -170,81 +312,137 @@ def generate_sound(key_words, place):
     Returns:
         dict: Zawiera informacje o wygenerowanych plikach audio
     """
+    flight_key = (normalize_text(key_words), normalize_text(place))
+    result, shared = sound_flights.do(flight_key, _generate_sound, key_words, place)
+    if shared:
+        print(f"generate_sound: wynik współdzielony z trwającym wywołaniem dla {flight_key}")
+    # Każdy wywołujący dostaje własną kopię (wynik bywa uzupełniany przez endpointy)
+    return copy.deepcopy(result)
+
+
+def _generate_sound(key_words, place):
+    # Właściwe generowanie (DeepSeek + ElevenLabs + renderowanie) - wywoływane przez generate_sound
     try:
         # Przetwarzamy scenariusz przez DeepSeek
         scenario_result = process_dream_scenario(key_words, place)
 
-        # Konfiguracja ElevenLabs
-        elevenlabs_api_key = os.getenv('ELEVENLABS_API_KEY')
-        if not elevenlabs_api_key:
-            print("ELEVENLABS_API_KEY not found - skipping audio generation")
-            return {
-                "status": "success",
-                "tts_text": scenario_result["tts_text"],
-                "sound_description": scenario_result["sound_description"],
-                "audio_files": None,
-                "message": "API key missing - text only"
-            }
-
-        client = ElevenLabs(api_key=elevenlabs_api_key)
-
-        # Generowanie TTS - użyjmy prawidłowego API
-        print(f"Generating TTS for: {scenario_result['tts_text'][:100]}...")
-        tts_audio = client.text_to_speech.convert(
-            text=scenario_result["tts_text"],
-            voice_id="EXAVITQu4vr4xnSDxMaL",  # Bella - wielojęzyczny głos
-            model_id="eleven_multilingual_v2"
+        tts_key = make_asset_key(
+            'tts', text=scenario_result["tts_text"], voice_id=TTS_VOICE_ID, model_id=TTS_MODEL_ID
         )
-
-        # Generowanie sound effect - dla efektów dźwiękowych użyjemy sound generation API
-        sound_effect = client.text_to_sound_effects.convert(
-            text=scenario_result["sound_description"],
-            loop=True,  # Tworzymy pętlę dźwiękową
-            duration_seconds=30.0,  # 30 sekund jak wymagane
-            model_id="eleven_text_to_sound_v2"  # Model dla efektów dźwiękowych
+        sound_key = make_asset_key(
+            'sound', text=scenario_result["sound_description"], model_id=SOUND_EFFECT_MODEL_ID,
+            duration_seconds=SOUND_EFFECT_DURATION_SECONDS, loop=True
         )
+        renderer = 'pydub' if PYDUB_AVAILABLE else 'simple'
+        derived_keys = {}
+        output_formats = sound_settings.output_formats
+        if 'extended' in output_formats:
+            derived_keys['extended'] = extended_asset_key(tts_key, sound_key, renderer)
+        if 'playlist' in output_formats:
+            for segment in PLAYLIST_SEGMENTS:
+                derived_keys[segment] = playlist_segment_key(segment, tts_key, sound_key, renderer)
+
+        tts_asset = audio_store.lookup(tts_key)
+        sound_asset = audio_store.lookup(sound_key)
+        derived_assets = {name: audio_store.lookup(key) for name, key in derived_keys.items()}
+
+        if tts_asset and sound_asset and all(derived_assets.values()):
+            # Pełne trafienie - bez wywołań ElevenLabs i bez renderowania
+            print(f"Audio asset cache hit: {tts_key[:12]}/{sound_key[:12]}")
+        else:
+            # Konfiguracja ElevenLabs
+            elevenlabs_api_key = os.getenv('ELEVENLABS_API_KEY')
+            if not elevenlabs_api_key:
+                print("ELEVENLABS_API_KEY not found - skipping audio generation")
+                return {
+                    "status": "success",
+                    "tts_text": scenario_result["tts_text"],
+                    "sound_description": scenario_result["sound_description"],
+                    "audio_files": None,
+                    "message": "API key missing - text only"
+                }
 
-        # Zapisanie plików w katalogu audio_files
-        audio_files = {}
-        timestamp = int(datetime.now().timestamp())
-
-        # Tworzenie nazw plików z timestampem
-        audio_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'audio_files')
-        os.makedirs(audio_dir, exist_ok=True)
-
-        print(f"Audio directory: {audio_dir}")
-
-        # Sprawdzamy czy mamy uprawnienia do zapisu
-        if not os.access(audio_dir, os.W_OK):
-            raise PermissionError(f"No write permission to audio directory: {audio_dir}")
-
-        # Zbieranie bajtów audio do pamięci dla przetworzenia
-        tts_bytes = b"".join(chunk for chunk in tts_audio)
-        sound_effect_bytes = b"".join(chunk for chunk in sound_effect)
-        
-        print("Creating extended 15-minute audio with fade-in and TTS mixing...")
-        extended_audio_bytes = create_extended_audio(tts_bytes, sound_effect_bytes)
-        
-        # TTS file (oryginalny)
-        tts_filename = f"dream_tts_{timestamp}.mp3"
-        tts_filepath = os.path.join(audio_dir, tts_filename)
-        with open(tts_filepath, "wb") as f:
-            f.write(tts_bytes)
-        audio_files["tts_file"] = tts_filepath
-
-        # Sound effect file (30s pętla)
-        sound_filename = f"dream_sound_{timestamp}.mp3"
-        sound_filepath = os.path.join(audio_dir, sound_filename)
-        with open(sound_filepath, "wb") as f:
-            f.write(sound_effect_bytes)
-        audio_files["sound_file"] = sound_filepath
-        
-        # Extended 15-minute file (główny plik do użycia)
-        extended_filename = f"dream_extended_{timestamp}.mp3"
-        extended_filepath = os.path.join(audio_dir, extended_filename)
-        with open(extended_filepath, "wb") as f:
-            f.write(extended_audio_bytes)
-        audio_files["extended_file"] = extended_filepath
+            os.makedirs(audio_store.root_dir, exist_ok=True)
+            print(f"Audio directory: {audio_store.root_dir}")
+
+            # Sprawdzamy czy mamy uprawnienia do zapisu
+            if not os.access(audio_store.root_dir, os.W_OK):
+                raise PermissionError(f"No write permission to audio directory: {audio_store.root_dir}")
+
+            client = api_clients.elevenlabs(elevenlabs_api_key)
+
+            # Generowanie TTS i sound effect równolegle - wywołujemy tylko brakujące zasoby
+            executor = sound_settings.executor()
+            tts_future = None if tts_asset else executor.submit(
+                api_clients.call, 'tts', synthesize_tts, client, scenario_result["tts_text"]
+            )
+            sound_future = None if sound_asset else executor.submit(
+                api_clients.call, 'sound_effect', synthesize_sound_effect, client, scenario_result["sound_description"]
+            )
+
+            try:
+                tts_bytes = tts_future.result() if tts_future else audio_store.read(tts_key)
+                sound_effect_bytes = sound_future.result() if sound_future else audio_store.read(sound_key)
+            except CircuitOpenError as e:
+                # ElevenLabs nie odpowiada - zwracamy od razu sam tekst (jak bez klucza API)
+                print(f"ElevenLabs unavailable: {e}")
+                return {
+                    "status": "success",
+                    "tts_text": scenario_result["tts_text"],
+                    "sound_description": scenario_result["sound_description"],
+                    "audio_files": None,
+                    "message": "Audio provider unavailable - text only"
+                }
+            if tts_future:
+                tts_asset = audio_store.put(tts_key, tts_bytes, kind='tts')
+            if sound_future:
+                sound_asset = audio_store.put(sound_key, sound_effect_bytes, kind='sound')
+
+            if 'extended' in derived_keys and not derived_assets['extended']:
+                print("Creating extended 15-minute audio with fade-in and TTS mixing...")
+                extended_path = audio_store.temp_path()
+                try:
+                    mixed = write_extended_audio(tts_bytes, sound_effect_bytes, extended_path)
+                    # Fallback bez miksowania (np. błąd ffmpeg) zapisujemy pod kluczem renderera
+                    # 'simple' - klucz 'pydub' pozostaje pusty i kolejne wywołanie ponowi miksowanie
+                    extended_key = derived_keys['extended'] if mixed else extended_asset_key(tts_key, sound_key, 'simple')
+                    derived_assets['extended'] = audio_store.put_file(extended_key, extended_path, kind='extended')
+                finally:
+                    if os.path.exists(extended_path):
+                        os.remove(extended_path)
+
+            if any(segment in derived_keys and not derived_assets[segment] for segment in PLAYLIST_SEGMENTS):
+                print("Creating playlist segments (intro, loop, outro)...")
+                segment_paths = {segment: audio_store.temp_path() for segment in PLAYLIST_SEGMENTS}
+                try:
+                    durations, mixed = write_playlist_segments(tts_bytes, sound_effect_bytes, segment_paths)
+                    for segment in PLAYLIST_SEGMENTS:
+                        # Jak przy extended: segmenty bez miksowania nie trafiają pod klucze 'pydub'
+                        segment_key = derived_keys[segment] if mixed else playlist_segment_key(
+                            segment, tts_key, sound_key, 'simple'
+                        )
+                        derived_assets[segment] = audio_store.put_file(
+                            segment_key, segment_paths[segment], kind='segment',
+                            info={'duration_ms': durations[segment]}
+                        )
+                finally:
+                    for path in segment_paths.values():
+                        if os.path.exists(path):
+                            os.remove(path)
+
+        audio_files = {
+            "tts_file": tts_asset['path'],
+            "sound_file": sound_asset['path']
+        }
+        for name, asset in derived_assets.items():
+            audio_files[f"{name}_file"] = asset['path']
+
+        # Długości segmentów potrzebne do zbudowania playlisty
+        playlist = None
+        if 'playlist' in output_formats:
+            playlist = {
+                f"{segment}_ms": derived_assets[segment]['info'].get('duration_ms') for segment in PLAYLIST_SEGMENTS
+            }
 
         print(f"Audio files generated: {audio_files}")
 
@@ -256,6 +454,7 @@ def generate_sound(key_words, place):
             "tts_text": scenario_result["tts_text"],
             "sound_description": scenario_result["sound_description"],
             "audio_files": audio_files,
+            "playlist": playlist,
             "message": "Audio generated successfully"
         }
 
@@ -274,145 +473,171 @@ def create_simple_extended_audio(tts_audio_bytes, sound_effect_bytes):
     """
     Prosty fallback - tworzy 15-minutowe audio bez zaawansowanego miksowania
     Gdy pydub nie jest dostępny, zapisuje pliki osobno i zwraca background
-    
+
     Args:
         tts_audio_bytes: Bajty TTS audio
         sound_effect_bytes: Bajty sound effect (30s)
-        
+
+    Returns:
+        bytearray: Rozszerzone background audio (bez prawidłowego miksowania)
+    """
+    extended_background = join_buffers(_plan_simple_extended_audio(sound_effect_bytes))
+    print(f"Simple fallback created: Extended background ({len(extended_background)} bytes)")
+    return extended_background
+
+
+def write_simple_extended_audio(sound_effect_bytes, output_path):
+    """
+    Zapisuje prosty fallback bezpośrednio do pliku - powtórzenia pętli to widoki
+    na jeden bufor zapisywane przez os.writev, bez sklejania w pamięci
+
     Returns:
-        bytes: Rozszerzone background audio (bez prawidłowego miksowania)
+        int: Liczba zapisanych bajtów
     """
+    buffers = _plan_simple_extended_audio(sound_effect_bytes)
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        write_buffers(fd, buffers)
+    finally:
+        os.close(fd)
+    written = sum(len(buffer) for buffer in buffers)
+    print(f"Simple fallback written: Extended background ({written} bytes)")
+    return written
+
+
+def _plan_simple_extended_audio(sound_effect_bytes):
     print("Creating simple extended audio fallback...")
     print("WARNING: Without pydub, audio mixing is not available!")
     print("This will create a looped background - TTS will be in separate file")
-    
+
     # Bez pydub nie możemy prawidłowo miksować - zwracamy tylko rozszerzony background
-    # TTS będzie w osobnym pliku
-    
-    # Szacujemy ile powtórzeń potrzebujemy dla 15 minut
-    # Zakładamy że 30s sound effect to około 480KB (16kbps * 30s)
-    estimated_30s_duration = 30
-    target_duration = 15 * 60  # 15 minut w sekundach
-    repetitions = target_duration // estimated_30s_duration
-    
-    print(f"Repeating 30s loop {repetitions} times for ~{repetitions * 30/60:.1f} minutes")
-    
-    # Tworzymy rozszerzony background przez powtórzenie
-    extended_background = sound_effect_bytes
-    for i in range(repetitions - 1):  # -1 bo już mamy jeden
-        extended_background += sound_effect_bytes
-        if i % 10 == 0:
-            print(f"Added repetition {i+2}/{repetitions}")
-    
-    print(f"Simple fallback created: Extended background ({len(extended_background)} bytes)")
+    # TTS będzie w osobnym pliku. Pętlę sklejamy na granicach ramek MP3 (bez powtarzanych
+    # tagów ID3 i nagłówka Xing/Info), z długością wyliczoną z faktycznej liczby ramek.
+    buffers = plan_looped_frames(sound_effect_bytes, EXTENDED_AUDIO_DURATION_SECONDS)
+    print(f"Looping sound effect into {len(buffers)} segments for ~{EXTENDED_AUDIO_DURATION_SECONDS / 60:.1f} minutes")
     print("Note: TTS audio will be saved as separate file due to mixing limitations")
-    
-    return extended_background
+    return buffers
 
 
-def create_extended_audio(tts_audio_bytes, sound_effect_bytes):
+def write_extended_audio(tts_audio_bytes, sound_effect_bytes, output_path):
     """
-    Tworzy 15-minutowe audio z 30-sekundowej pętli i TTS z fade-in i miksowaniem
-    
+    Renderuje 15-minutowe audio z 30-sekundowej pętli i TTS z fade-in i miksowaniem do pliku
+
+    Pętla dekodowana jest raz, a wynik powstaje kawałkami przekazywanymi do enkodera MP3,
+    więc w pamięci jest tylko kilka sekund PCM niezależnie od długości nagrania.
+
     Args:
-        tts_audio_bytes: Surowe bajty audio TTS 
+        tts_audio_bytes: Surowe bajty audio TTS
         sound_effect_bytes: Surowe bajty audio sound effect (30s pętla)
-        
+        output_path (str): Ścieżka pliku wynikowego MP3
+
     Returns:
-        bytes: 15-minutowe audio MP3 z fade-in i zmiksowanym TTS
+        bool: True gdy audio zostało zmiksowane, False gdy użyto prostego fallbacku
     """
     try:
         # Sprawdzenie czy pydub jest dostępny
         if not PYDUB_AVAILABLE:
             print("pydub not available - using simple fallback...")
-            return create_simple_extended_audio(tts_audio_bytes, sound_effect_bytes)
-            
-        print("Creating extended audio with pydub...")
-        
-        # Konwersja bajtów do AudioSegment
-        print("Converting audio bytes to AudioSegment...")
-        try:
+        else:
+            print("Creating extended audio with streaming renderer...")
+
+            # Konwersja bajtów do AudioSegment
             tts_segment = AudioSegment.from_mp3(io.BytesIO(tts_audio_bytes))
             sound_loop = AudioSegment.from_mp3(io.BytesIO(sound_effect_bytes))
             print(f"Successfully loaded: TTS ({len(tts_segment)}ms), Loop ({len(sound_loop)}ms)")
-        except Exception as conversion_error:
-            print(f"Error converting audio to AudioSegment: {conversion_error}")
-            print("Falling back to simple audio extension...")
-            return create_simple_extended_audio(tts_audio_bytes, sound_effect_bytes)
-        
-        # Sprawdzenie długości pętli
-        loop_duration_ms = len(sound_loop)
-        print(f"Sound loop duration: {loop_duration_ms}ms (~{loop_duration_ms/1000:.1f}s)")
-        
-        # Obliczenie ile razy powtórzyć pętlę dla 15 minut
-        target_duration_ms = 15 * 60 * 1000  # 15 minut w ms
-        repetitions = target_duration_ms // loop_duration_ms
-        remaining_ms = target_duration_ms % loop_duration_ms
-        
-        print(f"Creating {repetitions} full loops + {remaining_ms}ms partial loop")
-        
-        # Tworzenie 15-minutowego tła przez powtarzanie pętli
-        extended_background = AudioSegment.empty()
-        
-        # Dodanie pełnych pętli
-        for i in range(repetitions):
-            extended_background += sound_loop
-            if i % 10 == 0:  # Progress info co 10 pętli
-                print(f"Added {i+1}/{repetitions} loops...")
-            
-        # Dodanie częściowej pętli jeśli potrzebna
-        if remaining_ms > 0:
-            extended_background += sound_loop[:remaining_ms]
-            
-        print(f"Extended background duration: {len(extended_background)}ms ({len(extended_background)/60000:.1f} min)")
-        
-        # 10-sekundowy fade-in na początku
-        print("Adding 10s fade-in...")
-        fade_in_duration_ms = 10000  # 10 sekund
-        extended_background = extended_background.fade_in(fade_in_duration_ms)
-        
-        # 5-sekundowy fade-out na końcu dla gładkiego zakończenia
-        print("Adding 5s fade-out...")
-        fade_out_duration_ms = 5000  # 5 sekund  
-        extended_background = extended_background.fade_out(fade_out_duration_ms)
-        
-        # Miksowanie TTS po fade-in (od 10. sekundy)
-        print("Mixing TTS after fade-in...")
-        tts_start_ms = fade_in_duration_ms  # Start od 10s
-        
-        # Normalizacja głośności TTS i background przed miksowaniem
-        print("Normalizing audio levels...")
-        # Zmniejszamy głośność background żeby TTS było wyraźnie słyszalne
-        extended_background = extended_background - 15  # -15dB dla background
-        
-        # Jeśli TTS jest dłuższe niż pozostały czas, skracamy go
-        available_time_ms = len(extended_background) - tts_start_ms
-        if len(tts_segment) > available_time_ms:
-            print(f"TTS too long ({len(tts_segment)}ms), trimming to {available_time_ms}ms")
-            tts_segment = tts_segment[:available_time_ms]
-            
-
-        # Miksowanie bez clippingu - overlay z odpowiednimi poziomami
-        print(f"Overlaying TTS at position {tts_start_ms}ms")
-        final_audio = extended_background.overlay(tts_segment, position=tts_start_ms)
-        
-        print(f"Final audio duration: {len(final_audio)}ms (~{len(final_audio)/60000:.1f} minutes)")
-        
-        # Eksport do bajtów
-        print("Exporting final audio to MP3...")
-        output_buffer = io.BytesIO()
-        final_audio.export(output_buffer, format="mp3", bitrate="128k")
-        
-        result_bytes = output_buffer.getvalue()
-        print(f"Final file size: {len(result_bytes)} bytes")
-        
-        return result_bytes
-        
+
+            rendered_ms = render_extended_audio(
+                tts_segment,
+                sound_loop,
+                output_path,
+                duration_ms=EXTENDED_AUDIO_DURATION_SECONDS * 1000,
+                bitrate="128k",
+                fade_in_ms=EXTENDED_FADE_IN_MS,
+                fade_out_ms=EXTENDED_FADE_OUT_MS,
+                background_gain_db=EXTENDED_BACKGROUND_GAIN_DB,
+                tts_start_ms=EXTENDED_FADE_IN_MS,
+                chunk_ms=sound_settings.render_chunk_ms
+            )
+            print(f"Final audio duration: {rendered_ms}ms (~{rendered_ms/60000:.1f} minutes), "
+                  f"file size: {os.path.getsize(output_path)} bytes")
+            return True
+
     except Exception as e:
-        print(f"Błąd w create_extended_audio: {str(e)}")
+        print(f"Błąd w write_extended_audio: {str(e)}")
         print("Falling back to simple audio extension...")
-        # Fallback - używamy funkcji simple fallback
-        return create_simple_extended_audio(tts_audio_bytes, sound_effect_bytes)
+
+    # Fallback - używamy funkcji simple fallback
+    write_simple_extended_audio(sound_effect_bytes, output_path)
+    return False
+
+
+def write_playlist_segments(tts_audio_bytes, sound_effect_bytes, output_paths):
+    """
+    Renderuje segmenty trybu playlisty (intro z fade-in i TTS, pętla, outro z fade-out)
+
+    Args:
+        tts_audio_bytes: Surowe bajty audio TTS
+        sound_effect_bytes: Surowe bajty audio sound effect (30s pętla)
+        output_paths (dict): {'intro': ścieżka, 'loop': ścieżka, 'outro': ścieżka}
+
+    Returns:
+        tuple: ({segment: długość w ms}, True gdy segmenty zmiksowano / False przy fallbacku)
+    """
+    try:
+        if PYDUB_AVAILABLE:
+            tts_segment = AudioSegment.from_mp3(io.BytesIO(tts_audio_bytes))
+            sound_loop = AudioSegment.from_mp3(io.BytesIO(sound_effect_bytes))
+            durations = render_playlist_segments(
+                tts_segment,
+                sound_loop,
+                output_paths,
+                fade_in_ms=EXTENDED_FADE_IN_MS,
+                fade_out_ms=EXTENDED_FADE_OUT_MS,
+                background_gain_db=EXTENDED_BACKGROUND_GAIN_DB,
+                tts_start_ms=EXTENDED_FADE_IN_MS,
+                bitrate="128k",
+                chunk_ms=sound_settings.render_chunk_ms
+            )
+            return durations, True
+        print("pydub not available - playlist segments without mixing...")
+    except Exception as e:
+        print(f"Błąd w write_playlist_segments: {str(e)}")
+        print("Falling back to unmixed playlist segments...")
+
+    # Fallback bez miksowania: intro to sam TTS, pętla i outro to oryginalny sound effect
+    loop_ms = mp3_duration_ms(sound_effect_bytes) or int(SOUND_EFFECT_DURATION_SECONDS * 1000)
+    sources = {
+        'intro': (tts_audio_bytes, mp3_duration_ms(tts_audio_bytes) or 0),
+        'loop': (sound_effect_bytes, loop_ms),
+        'outro': (sound_effect_bytes, loop_ms)
+    }
+    durations = {}
+    for segment, (data, duration_ms) in sources.items():
+        with open(output_paths[segment], "wb") as f:
+            f.write(data)
+        durations[segment] = duration_ms
+    return durations, False
+
+
+def create_extended_audio(tts_audio_bytes, sound_effect_bytes):
+    """
+    Tworzy 15-minutowe audio z 30-sekundowej pętli i TTS z fade-in i miksowaniem
+
+    Args:
+        tts_audio_bytes: Surowe bajty audio TTS
+        sound_effect_bytes: Surowe bajty audio sound effect (30s pętla)
+
+    Returns:
+        bytes: 15-minutowe audio MP3 z fade-in i zmiksowanym TTS
+    """
+    output_path = audio_store.temp_path()
+    try:
+        write_extended_audio(tts_audio_bytes, sound_effect_bytes, output_path)
+        with open(output_path, "rb") as f:
+            return f.read()
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
 
 def test_audio_generation():
     """
@@ -445,10 +670,15 @@ def test_audio_generation():
         print(f"   Writable: {os.access(audio_dir, os.W_OK)}")
         files = [f for f in os.listdir(audio_dir) if f.endswith('.mp3')]
         print(f"   MP3 files: {len(files)}")
+        print(f"   Audio store: {audio_store.stats()}")
     
-    # Test 4: Test prostego generowania
+    # Test 4: Statystyki cache rozwinięć scenariuszy
+    print(f"4. Scenario cache: {scenario_cache.stats()}")
+    print(f"   Single-flight generate_sound: {sound_flights.stats()}")
+
+    # Test 5: Test prostego generowania
     if deepseek_key and elevenlabs_key:
-        print("4. Testing simple generation...")
+        print("5. Testing simple generation...")
         try:
             result = generate_sound("test ocean waves", "peaceful beach")
             print(f"   Generation result: {result.get('status', 'unknown')}")
@@ -462,40 +692,24 @@ def test_audio_generation():
         except Exception as e:
             print(f"   Generation test failed: {e}")
     else:
-        print("4. Skipping generation test - missing API keys")
+        print("5. Skipping generation test - missing API keys")
 
 def cleanup_old_audio_files(max_age_hours=24):
     """
-    Czyści stare pliki audio starsze niż max_age_hours
+    Czyści pliki audio nieużywane dłużej niż max_age_hours
+
+    Kandydaci wybierani są z manifestu magazynu (indeks po czasie ostatniego dostępu) bez
+    skanowania katalogu; pliki używane przez aktywne handle są pomijane. Regularne sprzątanie
+    wg limitu miejsca wykonuje wątek audio_store (AUDIO_STORE_SWEEP_INTERVAL_SECONDS).
 
     Args:
         max_age_hours (int): Maksymalny wiek plików w godzinach
     """
     try:
-        audio_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'audio_files')
-        if not os.path.exists(audio_dir):
-            return
-
-        now = datetime.now().timestamp()
-        max_age_seconds = max_age_hours * 3600
-
-        cleaned_count = 0
-        for filename in os.listdir(audio_dir):
-            if filename.endswith('.mp3') and filename.startswith('dream_'):
-                filepath = os.path.join(audio_dir, filename)
-                file_age = now - os.path.getctime(filepath)
-
-                if file_age > max_age_seconds:
-                    try:
-                        os.remove(filepath)
-                        cleaned_count += 1
-                        print(f"Removed old audio file: {filename}")
-                    except Exception as e:
-                        print(f"Error removing file {filename}: {e}")
-
-        if cleaned_count > 0:
-            print(f"Cleaned up {cleaned_count} old audio files")
-
+        result = audio_store.evict(older_than=datetime.now().timestamp() - max_age_hours * 3600)
+        if result['evicted'] > 0:
+            print(f"Cleaned up {result['evicted']} old audio files")
+        return result
     except Exception as e:
         print(f"Error during audio cleanup: {e}")
 
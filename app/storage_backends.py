@@ -0,0 +1,348 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+from array import array
+from contextlib import nullcontext
+from multiprocessing import resource_tracker, shared_memory
+
+# Stan bufora cyklicznego: head, size, total_appended, capacity (int64)
+STATE_FIELDS = 4
+STATE_BYTES = STATE_FIELDS * 8
+
+# Wpis indeksu urządzeń: flaga zajętości + sha1(device_id)
+INDEX_SLOT_BYTES = 1 + 20
+
+
+class MemoryBackend:
+    """
+    Bufory sensorów w pamięci procesu (domyślny backend).
+
+    Każdy proces (worker gunicorna) ma własne dane - wystarcza przy jednym procesie.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._devices = set()
+
+    def allocate(self, device_id, buffer_name, columns, capacity):
+        """
+        Alokuje pamięć bufora cyklicznego
+
+        Returns:
+            tuple: ({kolumna: tablica 2 * capacity}, stan [head, size, total, capacity], blokada)
+        """
+        if device_id is not None:
+            self._devices.add(device_id)
+        storage = {
+            name: array(typecode, bytes(array(typecode).itemsize * 2 * capacity))
+            for name, typecode in columns
+        }
+        state = array('q', [0, 0, 0, capacity])
+        return storage, state, nullcontext()
+
+    def holds(self, device_id):
+        return True
+
+    def release(self, device_id):
+        self._devices.discard(device_id)
+
+    def stats(self):
+        return {'backend': self.name, 'devices': len(self._devices)}
+
+
+class _SharedLock:
+    """
+    Blokada wspólna dla procesów: blokada rekordu (fcntl.lockf) na jednym bajcie pliku
+    blokad plus blokada wątków (blokady rekordów POSIX obowiązują per proces, nie per wątek)
+    """
+
+    def __init__(self, fd, offset):
+        self._fd = fd
+        self._offset = offset
+        self._thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, self._offset)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self._offset)
+        finally:
+            self._thread_lock.release()
+
+
+class SharedMemoryBackend:
+    """
+    Bufory sensorów w segmentach multiprocessing.shared_memory wspólnych dla procesów na hoście.
+
+    Przy kilku workerach gunicorna próbki wysłane przez urządzenie do jednego procesu są od
+    razu widoczne w pozostałych (np. w tym, który obsługuje /embedded/flags). Mały indeks
+    (osobny segment) przypisuje urządzeniu numer slotu; każdy bufor urządzenia to jeden
+    segment: stan (head, size, total_appended, capacity) i kolumny o długości 2 * capacity,
+    widziane bezpośrednio przez memoryview - bez kopiowania i serializacji.
+
+    Zapisy do buforów urządzenia chroni blokada rekordu w pliku blokad (jeden bajt na slot).
+    Segmenty nie są usuwane przy wyjściu procesu (przeżywają restart workera); usuwa je
+    unlink_all(). Gdy indeks jest pełny, nowe urządzenia dostają bufory w pamięci procesu.
+    Slot zwalnia release() (urządzenie przejęte przez inny węzeł) - pozostałe procesy
+    sprawdzają w indeksie, czy zapamiętany slot nadal należy do urządzenia (holds()).
+
+    Args:
+        namespace (str): Prefiks nazw segmentów (oddziela instancje aplikacji na hoście)
+        max_devices (int): Liczba slotów indeksu urządzeń
+        lock_dir (str): Katalog pliku blokad (domyślnie katalog tymczasowy systemu)
+    """
+
+    name = 'shared_memory'
+
+    def __init__(self, namespace, max_devices=256, lock_dir=None):
+        self.namespace = namespace
+        self.max_devices = max_devices
+        self._lock_path = os.path.join(lock_dir or tempfile.gettempdir(), f"{namespace}.lock")
+        self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        # Ostatni bajt pliku blokad (za slotami) chroni indeks
+        self._index_lock = _SharedLock(self._lock_fd, max_devices)
+        self._device_locks = {}  # slot -> _SharedLock
+        self._segments = {}  # nazwa segmentu -> SharedMemory (utrzymywane, by pamięć nie znikła)
+        self._slots = {}  # device_id -> slot
+        self._fallback = MemoryBackend()
+        with self._index_lock:
+            self._index = self._open_segment(f"{namespace}_index", max_devices * INDEX_SLOT_BYTES)
+
+    def _open_segment(self, name, size, create=True):
+        # Tworzy segment albo dołącza do istniejącego i zwraca memoryview jego pamięci
+        # (wywoływane pod blokadą indeksu; create=False - FileNotFoundError gdy segmentu nie ma)
+        if create:
+            try:
+                segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                segment = shared_memory.SharedMemory(name=name)
+        else:
+            segment = shared_memory.SharedMemory(name=name)
+        # W Pythonie < 3.13 resource_tracker usuwa segment przy wyjściu procesu, który go
+        # utworzył lub do niego dołączył - segmenty żyją dłużej niż pojedynczy worker
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        if segment.size < size:
+            segment.close()
+            raise ValueError(f"Shared memory segment {name} is smaller than expected ({size} bytes)")
+        # Mapowanie przejmują widoki buforów: SharedMemory.close() (także z __del__) nie może
+        # zamknąć mmap z eksportowanymi widokami, więc odłączamy je od obiektu segmentu
+        view = memoryview(segment._mmap)
+        segment._buf.release()
+        segment._buf = None
+        segment._mmap = None
+        segment.close()
+        self._segments[name] = segment
+        return view
+
+    def _slot_matches(self, slot, digest):
+        offset = slot * INDEX_SLOT_BYTES
+        return bool(self._index[offset]) and self._index[offset + 1:offset + INDEX_SLOT_BYTES] == digest
+
+    def _device_slot(self, device_id):
+        # Szuka slotu urządzenia w indeksie albo zajmuje wolny (None gdy indeks jest pełny)
+        digest = hashlib.sha1(str(device_id).encode('utf-8')).digest()
+        slot = self._slots.get(device_id)
+        if slot is not None and self._slot_matches(slot, digest):
+            return slot
+        slot = None
+        index = self._index
+        with self._index_lock:
+            free_slot = None
+            for candidate in range(self.max_devices):
+                offset = candidate * INDEX_SLOT_BYTES
+                if not index[offset]:
+                    if free_slot is None:
+                        free_slot = candidate
+                elif index[offset + 1:offset + INDEX_SLOT_BYTES] == digest:
+                    slot = candidate
+                    break
+            if slot is None and free_slot is not None:
+                offset = free_slot * INDEX_SLOT_BYTES
+                index[offset + 1:offset + INDEX_SLOT_BYTES] = digest
+                index[offset] = 1
+                slot = free_slot
+        if slot is not None:
+            self._slots[device_id] = slot
+        return slot
+
+    def allocate(self, device_id, buffer_name, columns, capacity):
+        """
+        Alokuje bufor cykliczny w segmencie pamięci współdzielonej (albo dołącza do istniejącego)
+
+        Returns:
+            tuple: ({kolumna: memoryview 2 * capacity}, stan [head, size, total, capacity], blokada)
+        """
+        slot = self._device_slot(device_id)
+        if slot is None:
+            print(f"Indeks pamięci współdzielonej pełny ({self.max_devices}) - bufory {device_id} lokalne dla procesu")
+            return self._fallback.allocate(device_id, buffer_name, columns, capacity)
+
+        # Kolumny wyrównane do 8 bajtów - odczyt przez memoryview.cast bez niewyrównanych dostępów
+        layout = []
+        offset = STATE_BYTES
+        for name, typecode in columns:
+            layout.append((name, typecode, offset))
+            offset += -(-array(typecode).itemsize * 2 * capacity // 8) * 8
+
+        with self._index_lock:
+            try:
+                memory = self._open_segment(f"{self.namespace}_{slot}_{buffer_name}", offset)
+            except ValueError as e:
+                # Segment z poprzedniego wdrożenia z mniejszą pojemnością (do usunięcia przez unlink_all)
+                print(f"{e} - bufory {device_id} lokalne dla procesu")
+                return self._fallback.allocate(device_id, buffer_name, columns, capacity)
+            state = memory[:STATE_BYTES].cast('q')
+            if state[3] != capacity:
+                if state[3]:
+                    print(f"Zmieniona pojemność bufora {buffer_name} urządzenia {device_id} - bufor wyczyszczony")
+                # Nowy segment (wypełniony zerami) albo inna pojemność - bufor od zera
+                state[0] = state[1] = 0
+                state[3] = capacity
+        storage = {
+            name: memory[start:start + array(typecode).itemsize * 2 * capacity].cast(typecode)
+            for name, typecode, start in layout
+        }
+
+        lock = self._device_locks.get(slot)
+        if lock is None:
+            lock = self._device_locks.setdefault(slot, _SharedLock(self._lock_fd, slot))
+        return storage, state, lock
+
+    def holds(self, device_id):
+        """
+        Czy bufory urządzenia zaalokowane w tym procesie są nadal aktualne - False gdy inny
+        proces zwolnił slot urządzenia (bufory trzeba zaalokować ponownie)
+        """
+        slot = self._slots.get(device_id)
+        if slot is None:
+            return True
+        if self._slot_matches(slot, hashlib.sha1(str(device_id).encode('utf-8')).digest()):
+            return True
+        self._slots.pop(device_id, None)
+        return False
+
+    def release(self, device_id, buffer_names=('hr', 'mpu', 'emg')):
+        """
+        Zwalnia slot urządzenia w indeksie (wspólnym dla procesów) i czyści jego bufory,
+        więc slot może dostać nowe urządzenie
+
+        Args:
+            buffer_names: Nazwy buforów urządzenia (SensorRingBuffer.KIND)
+        """
+        self._fallback.release(device_id)
+        self._slots.pop(device_id, None)
+        digest = hashlib.sha1(str(device_id).encode('utf-8')).digest()
+        with self._index_lock:
+            slot = next((slot for slot in range(self.max_devices) if self._slot_matches(slot, digest)), None)
+            if slot is None:
+                return False
+            for buffer_name in buffer_names:
+                try:
+                    memory = self._open_segment(f"{self.namespace}_{slot}_{buffer_name}", STATE_BYTES, create=False)
+                except FileNotFoundError:
+                    continue
+                state = memory[:STATE_BYTES].cast('q')
+                state[0] = state[1] = 0
+            self._index[slot * INDEX_SLOT_BYTES] = 0
+        return True
+
+    def device_count(self):
+        """Liczba urządzeń w indeksie (wspólna dla wszystkich procesów)"""
+        index = self._index
+        return sum(1 for slot in range(self.max_devices) if index[slot * INDEX_SLOT_BYTES])
+
+    def unlink_all(self, buffer_names=('hr', 'mpu', 'emg')):
+        """
+        Usuwa segmenty przestrzeni nazw - indeks i bufory zajętych slotów, także utworzone
+        przez inne procesy (np. przy wdrożeniu ze zmianą układu danych)
+
+        Args:
+            buffer_names: Nazwy buforów urządzenia (SensorRingBuffer.KIND)
+        """
+        with self._index_lock:
+            names = [
+                f"{self.namespace}_{slot}_{buffer_name}"
+                for slot in range(self.max_devices) if self._index[slot * INDEX_SLOT_BYTES]
+                for buffer_name in buffer_names
+            ]
+            names.append(f"{self.namespace}_index")
+            for name in names:
+                try:
+                    segment = self._segments.get(name) or shared_memory.SharedMemory(name=name)
+                except FileNotFoundError:
+                    continue
+                # unlink() wyrejestrowuje segment z resource_tracker - rejestrujemy go z powrotem
+                resource_tracker.register(segment._name, 'shared_memory')
+                try:
+                    segment.unlink()
+                except FileNotFoundError:
+                    pass
+                segment.close()
+            self._segments.clear()
+            self._slots.clear()
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'namespace': self.namespace,
+            'devices': self.device_count(),
+            'max_devices': self.max_devices,
+            'local_devices': len(self._slots),
+            'fallback_devices': self._fallback.stats()['devices']
+        }
+
+
+class StorageBackends:
+    """
+    Wybór backendu buforów sensorów na podstawie konfiguracji.
+
+    Konfiguracja (app.config):
+        STORAGE_BACKEND: 'memory' (dane per proces), 'shared_memory' (wspólne dla workerów na hoście)
+            albo 'redis' (bufory per proces synchronizowane przez redis_store)
+        SHARED_MEMORY_NAMESPACE: Prefiks nazw segmentów pamięci współdzielonej
+        SHARED_MEMORY_MAX_DEVICES: Liczba slotów indeksu urządzeń
+    """
+
+    def __init__(self, app=None):
+        self.backend = MemoryBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend_name = app.config.get('STORAGE_BACKEND', 'memory')
+        if backend_name == 'shared_memory':
+            self.backend = SharedMemoryBackend(
+                app.config.get('SHARED_MEMORY_NAMESPACE', 'battle_unicorn'),
+                app.config.get('SHARED_MEMORY_MAX_DEVICES', 256)
+            )
+        elif backend_name not in ('memory', 'redis'):
+            # Przy 'redis' bufory są lokalne, a próbki innych węzłów dociąga redis_store
+            raise ValueError(f"Unknown STORAGE_BACKEND: {backend_name}")
+        app.extensions['storage_backends'] = self
+
+    def allocate(self, device_id, buffer_name, columns, capacity):
+        return self.backend.allocate(device_id, buffer_name, columns, capacity)
+
+    def holds(self, device_id):
+        """False gdy bufory urządzenia w tym procesie są nieaktualne (slot zwolnił inny proces)"""
+        return self.backend.holds(device_id)
+
+    def release(self, device_id):
+        """Zwalnia pamięć urządzenia w backendzie (urządzenie przejęte przez inny węzeł)"""
+        self.backend.release(device_id)
+
+    def stats(self):
+        return self.backend.stats()
+
+
+storage_backends = StorageBackends()
@@ -0,0 +1,110 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.fake_redis import FakeRedisServer  # noqa: E402
+
+# Węzeł API w osobnym procesie (create_app + serwer werkzeug) - singletony modułów są per proces,
+# tak jak na osobnych węzłach za load balancerem. TEST_FAKE_AUDIO_FILE podmienia generowanie
+# audio (bez kluczy DeepSeek/ElevenLabs) na wynik wskazujący gotowy plik.
+NODE_SCRIPT = '''
+import os, sys
+sys.path.insert(0, os.getcwd())
+from app import create_app
+from werkzeug.serving import make_server
+
+fake_audio_file = os.environ.get('TEST_FAKE_AUDIO_FILE')
+if fake_audio_file:
+    from app.routes import mobile
+
+    def fake_generate_sound(key_words, place):
+        return {
+            'status': 'success', 'tts_text': f"{key_words} {place}", 'sound_description': key_words,
+            'audio_files': {'tts_file': fake_audio_file}
+        }
+
+    mobile.generate_sound = fake_generate_sound
+
+app = create_app()
+make_server('127.0.0.1', int(sys.argv[1]), app, threaded=True).serve_forever()
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Node:
+    """Uruchomiony węzeł API z klientem HTTP"""
+
+    def __init__(self, process, url):
+        self.process = process
+        self.url = url
+        self.client = httpx.Client(base_url=url, timeout=30)
+
+    def get(self, path, **kwargs):
+        return self.client.get(path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.client.post(path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.client.put(path, **kwargs)
+
+    def stop(self):
+        self.client.close()
+        self.process.terminate()
+        self.process.wait(10)
+
+
+@pytest.fixture
+def fake_redis():
+    server = FakeRedisServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def start_node(tmp_path):
+    """Fabryka węzłów: start_node(port=None, **config) uruchamia proces i czeka na /embedded/hello"""
+    nodes = []
+
+    def start(port=None, **config):
+        port = port or free_port()
+        env = dict(
+            os.environ,
+            SAMPLE_PERSISTENCE_ENABLED='false',
+            DEVICE_SNAPSHOT_INTERVAL_SECONDS='0',
+            DEVICE_SNAPSHOT_DIR=str(tmp_path / f"snapshots_{port}"),
+            SCENARIO_CACHE_DIR=str(tmp_path / 'scenario_cache'),
+            **{name: str(value) for name, value in config.items()}
+        )
+        process = subprocess.Popen(
+            [sys.executable, '-c', NODE_SCRIPT, str(port)],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        node = Node(process, f"http://127.0.0.1:{port}")
+        nodes.append(node)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                node.get('/embedded/hello')
+                return node
+            except httpx.TransportError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"Node on port {port} did not start")
+                time.sleep(0.2)
+
+    yield start
+    for node in nodes:
+        node.stop()
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+from app.audio_jobs import (
+    AudioJobQueue, JobQueueFull, EXPIRED_ERROR, PREEMPTED_ERROR,
+    PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_REM
+)
+
+
+@pytest.fixture
+def queue():
+    """Kolejka z 2 wątkami, z których 1 jest zarezerwowany dla REM"""
+    queue = AudioJobQueue()
+    queue.max_workers = 2
+    queue.rem_reserved_workers = 1
+    queue.max_pending = 8
+    return queue
+
+
+@pytest.fixture
+def gate():
+    """Blokada zadań testowych - otwierana na końcu testu, by wątki robocze nie zostały zawieszone"""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.01)
+
+
+def test_bulk_jobs_never_take_reserved_worker(queue, gate):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def bulk_job():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        gate.wait(5)
+        with lock:
+            running.pop()
+
+    bulk_ids = [queue.submit(bulk_job, priority=PRIORITY_BULK, user=f"M{i}")['job_id'] for i in range(3)]
+    wait_until(lambda: queue.stats()['running']['bulk'] == 1)
+    time.sleep(0.1)
+    assert queue.stats()['running']['bulk'] == 1
+    assert queue.stats()['queued']['bulk'] == 2
+
+    # Wolny wątek czeka na REM - zadanie REM nie stoi za paczką bulk
+    rem_job = queue.submit(lambda: 'rem', priority=PRIORITY_REM, user='D1')
+    assert queue.wait(rem_job['job_id'], timeout=5)['status'] == 'done'
+
+    gate.set()
+    for job in queue.as_completed(bulk_ids, timeout=5):
+        assert job['status'] == 'done'
+    assert max(peak) == 1
+
+
+def test_round_robin_between_users_within_class(queue, gate):
+    order = []
+    blocker = queue.submit(gate.wait, 5, priority=PRIORITY_BULK, user='X')
+    wait_until(lambda: queue.stats()['running']['bulk'] == 1)
+
+    job_ids = [
+        queue.submit(order.append, name, priority=PRIORITY_BULK, user=name[0])['job_id']
+        for name in ('A1', 'A2', 'A3', 'B1', 'B2')
+    ]
+    gate.set()
+    assert len(list(queue.as_completed([blocker['job_id']] + job_ids, timeout=5))) == 6
+    assert order == ['A1', 'B1', 'A2', 'B2', 'A3']
+
+
+def test_rem_submit_to_full_queue_preempts_newest_bulk_job(queue, gate):
+    queue.max_pending = 5
+    queue.submit(gate.wait, 5, priority=PRIORITY_BULK, user='X')
+    wait_until(lambda: queue.stats()['running']['bulk'] == 1)
+    a_jobs = [queue.submit(gate.wait, 5, priority=PRIORITY_BULK, user='A') for _ in range(2)]
+    b_job = queue.submit(gate.wait, 5, priority=PRIORITY_BULK, user='B')
+    interactive = queue.submit(gate.wait, 5, priority=PRIORITY_INTERACTIVE, user='C')
+    assert queue.stats()['pending'] == 5
+
+    # Najnowsze zadanie bulk użytkownika z najdłuższą kolejką (A) oddaje miejsce zadaniu REM
+    rem_job = queue.submit(gate.wait, 5, priority=PRIORITY_REM, user='D1')
+    preempted = queue.get(a_jobs[1]['job_id'])
+    assert preempted['status'] == 'error'
+    assert preempted['error'] == PREEMPTED_ERROR
+    assert preempted['preempted'] is True
+    assert queue.get(a_jobs[0]['job_id'])['status'] == 'queued'
+    assert queue.get(b_job['job_id'])['status'] == 'queued'
+    assert queue.get(interactive['job_id'])['status'] == 'queued'
+    # Miejsce przechodzi na nowe zadanie - licznik oczekujących się nie zmienia
+    assert queue.stats()['pending'] == 5
+    assert queue.stats()['queued']['bulk'] == 2
+
+    # Bulk nie wypiera zadań tej samej ani wyższej klasy
+    with pytest.raises(JobQueueFull):
+        queue.submit(gate.wait, 5, priority=PRIORITY_BULK, user='E')
+
+    gate.set()
+    assert queue.wait(rem_job['job_id'], timeout=5)['status'] == 'done'
+
+
+def test_as_completed_reports_jobs_trimmed_from_history(queue):
+    queue.history_size = 2
+    first = queue.submit(lambda: 'first', user='A')
+    assert queue.wait(first['job_id'], timeout=5)['status'] == 'done'
+    for _ in range(3):
+        job = queue.submit(lambda: 'next', user='A')
+        queue.wait(job['job_id'], timeout=5)
+    assert queue.get(first['job_id']) is None
+
+    results = list(queue.as_completed([first['job_id'], job['job_id']], timeout=5))
+    assert [result['job_id'] for result in results] == [first['job_id'], job['job_id']]
+    assert results[0]['status'] == 'error'
+    assert results[0]['error'] == EXPIRED_ERROR
+    assert results[1]['status'] == 'done'
+    assert queue.wait('unknown', timeout=1)['error'] == EXPIRED_ERROR
+
+
+def test_awaited_job_is_not_trimmed_from_history(queue, gate):
+    queue.history_size = 1
+    awaited = queue.submit(lambda: 'awaited', user='A')
+    iterator = queue.as_completed([awaited['job_id']], timeout=5)
+    result = next(iterator)
+    assert result['status'] == 'done'
+
+    # Iteracja trwa (zadanie oczekiwane) - kolejne zadania nie usuwają go z historii
+    for _ in range(3):
+        job = queue.submit(lambda: 'next', user='B')
+        queue.wait(job['job_id'], timeout=5)
+    assert queue.get(awaited['job_id']) is not None
+
+    iterator.close()
+    queue.submit(lambda: 'last', user='B')
+    assert queue.get(awaited['job_id']) is None
@@ -0,0 +1,94 @@
+import pytest
+
+from app.shard_map import ConsistentHashRing, FORWARDED_HEADER, SECRET_HEADER
+from conftest import free_port
+
+SECRET = 'test-cluster-secret'
+AUTH = {SECRET_HEADER: SECRET}
+DEVICES = ['D1', 'D2', 'D3', 'D4', 'D5', 'D6']
+
+
+def hr_packet(device_id, count=30):
+    return {
+        'device_id': device_id,
+        'sensor_data': {'plethysmometer': [{'heart_rate': 60, 'spo2': 98} for _ in range(count)]}
+    }
+
+
+def stored_hr(node, device_id):
+    response = node.post('/embedded/sensor_data', json={'device_id': device_id, 'sensor_data': {}})
+    assert response.status_code == 200
+    return response.json()['total_samples_stored']['hr']
+
+
+def local_devices(node):
+    response = node.get('/cluster/nodes', headers=AUTH)
+    assert response.status_code == 200
+    return set(response.json()['local_devices'])
+
+
+@pytest.fixture
+def cluster(start_node):
+    """Trzy węzły z shardingiem: dwa w CLUSTER_NODES i trzeci spoza listy (przekazuje wszystko)"""
+    ports = [free_port() for _ in range(3)]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    nodes = [
+        start_node(port, CLUSTER_NODES=','.join(urls[:2]), CLUSTER_NODE_URL=url, CLUSTER_SECRET=SECRET)
+        for port, url in zip(ports, urls)
+    ]
+    return nodes, urls
+
+
+def test_device_requests_are_handled_by_owner(cluster):
+    nodes, urls = cluster
+    ring = ConsistentHashRing(urls[:2])
+    for round_index in range(4):
+        for device_id in DEVICES:
+            assert nodes[round_index % 3].post('/embedded/sensor_data', json=hr_packet(device_id)).status_code == 200
+
+    # Każdy węzeł widzi to samo okno - próbki trafiły do jednego właściciela
+    for device_id in DEVICES:
+        assert {stored_hr(node, device_id) for node in nodes} == {120}
+    for node, url in zip(nodes, urls):
+        assert local_devices(node) == {device_id for device_id in DEVICES if ring.owner(device_id) == url}
+
+
+def test_join_hands_off_devices_to_new_owner(cluster):
+    nodes, urls = cluster
+    for device_id in DEVICES:
+        nodes[0].post('/embedded/sensor_data', json=hr_packet(device_id))
+
+    response = nodes[0].put('/cluster/nodes', json={'nodes': urls}, headers=AUTH)
+    assert response.status_code == 200
+
+    ring = ConsistentHashRing(urls)
+    assert response.json()['broadcast'] == {urls[1]: 200, urls[2]: 200}
+    for device_id in DEVICES:
+        # Okno przekazane w snapshocie - nowy właściciel nie zaczyna od zera
+        assert stored_hr(nodes[0], device_id) == 30
+    for node, url in zip(nodes, urls):
+        assert local_devices(node) == {device_id for device_id in DEVICES if ring.owner(device_id) == url}
+
+
+def test_cluster_endpoints_require_secret(cluster):
+    nodes, urls = cluster
+    assert nodes[0].get('/cluster/nodes').status_code == 403
+    assert nodes[0].get('/cluster/nodes', headers={SECRET_HEADER: 'wrong'}).status_code == 403
+    assert nodes[0].put('/cluster/nodes', json={'nodes': urls[:1]}).status_code == 403
+    assert nodes[0].post('/cluster/handoff/D1', content=b'DSNAP1').status_code == 403
+    assert nodes[0].get('/cluster/nodes', headers=AUTH).json()['nodes'] == sorted(urls[:2])
+
+
+def test_forwarded_header_requires_secret(cluster):
+    nodes, urls = cluster
+    # Węzeł spoza listy nie jest właścicielem - sfałszowany nagłówek nie może wymusić obsługi lokalnej
+    forged = nodes[2].post('/embedded/sensor_data', json=hr_packet('D1'), headers={FORWARDED_HEADER: urls[0]})
+    assert forged.status_code == 403
+    forwarded = nodes[2].post('/embedded/sensor_data', json=hr_packet('D1'), headers={FORWARDED_HEADER: urls[0], **AUTH})
+    assert forwarded.status_code == 200
+    assert local_devices(nodes[2]) == {'D1'}
+
+
+def test_cluster_endpoints_absent_without_sharding(start_node):
+    node = start_node()
+    assert node.get('/cluster/nodes', headers=AUTH).status_code == 404
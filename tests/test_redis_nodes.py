@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def nodes(fake_redis, start_node, tmp_path):
+    """Dwa węzły API (STORAGE_BACKEND=redis) za umownym load balancerem"""
+    audio_file = tmp_path / 'tts.mp3'
+    audio_file.write_bytes(b'ID3' + b'\x00' * 1024)
+    config = {'STORAGE_BACKEND': 'redis', 'REDIS_URL': fake_redis.url, 'TEST_FAKE_AUDIO_FILE': audio_file}
+    return start_node(**config), start_node(**config)
+
+
+def wait_for_job(node, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        response = node.get(f"/mobile/jobs/{job_id}")
+        assert response.status_code == 200
+        job = response.json()['job']
+        if job['status'] in ('done', 'error') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.1)
+
+
+def test_job_and_handle_visible_on_other_node(nodes):
+    node_a, node_b = nodes
+
+    response = node_a.post('/mobile/generate_audio?async=true', json={'key_words': 'ocean', 'place': 'beach'})
+    assert response.status_code == 202
+    job_id = response.json()['job_id']
+
+    # Status i wynik zadania zleconego na A dostępne na B
+    assert wait_for_job(node_b, job_id)['status'] == 'done'
+    result_b = node_b.get(f"/mobile/jobs/{job_id}/result")
+    assert result_b.status_code == 200
+    handle_id = result_b.json()['audio_download_info']['handle_id']
+
+    # Kolejny odczyt wyniku na A zwraca ten sam handle
+    result_a = node_a.get(f"/mobile/jobs/{job_id}/result")
+    assert result_a.json()['audio_download_info']['handle_id'] == handle_id
+
+    # Handle utworzony na B pobierany przez A
+    download = node_a.get(f"/mobile/download_audio/{handle_id}/tts")
+    assert download.status_code == 200
+    assert download.content.startswith(b'ID3')
+
+
+def test_unknown_job_and_handle_are_not_found(nodes):
+    node_a, _ = nodes
+    assert node_a.get('/mobile/jobs/missing').status_code == 404
+    assert node_a.get('/mobile/download_audio/missing/tts').status_code == 404
+
+
+def test_polling_etag_is_not_reused_across_nodes(nodes):
+    node_a, node_b = nodes
+    node_a.post('/mobile/connect_device', json={'mobile_id': 'M1', 'device_id': 'D1'})
+
+    etag_a = node_a.get('/mobile/polling?mobile_id=M1').headers['ETag']
+    assert node_a.get('/mobile/polling?mobile_id=M1', headers={'If-None-Match': etag_a}).status_code == 304
+
+    # Rewizje są lokalne dla procesu - ETag węzła A nie może dać 304 na węźle B
+    response_b = node_b.get('/mobile/polling?mobile_id=M1', headers={'If-None-Match': etag_a})
+    assert response_b.status_code == 200
+    assert response_b.headers['ETag'] != etag_a
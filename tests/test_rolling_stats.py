@@ -0,0 +1,85 @@
+import os
+import random
+
+import pytest
+
+from app.rolling_stats import RollingWindowStats
+from app.sensor_buffers import HrRingBuffer, HR_RECENT_SAMPLES, HR_WINDOW_SAMPLES
+from app.storage_backends import SharedMemoryBackend
+
+
+def assert_matches_window(buffer):
+    """Statystyki kroczące bufora równe średniej/min/max liczonym od zera z okna heart_rates(n)"""
+    stats = buffer.stats
+    for name, size in (('all', buffer.capacity), ('detection', HR_WINDOW_SAMPLES), ('recent', HR_RECENT_SAMPLES)):
+        window = list(buffer.heart_rates(size))
+        window_stats = stats[name]
+        assert window_stats.count == len(window), name
+        if not window:
+            continue
+        assert window_stats.mean == pytest.approx(sum(window) / len(window)), name
+        assert window_stats.min == min(window), name
+        assert window_stats.max == max(window), name
+
+
+def heart_rate_packets(rng, packets, max_size=40):
+    for _ in range(packets):
+        yield [{'heart_rate': rng.randint(40, 160), 'spo2': 97} for _ in range(rng.randint(1, max_size))]
+
+
+def test_rolling_window_stats_matches_brute_force():
+    rng = random.Random(3)
+    window_stats = RollingWindowStats(7)
+    values = []
+    for _ in range(200):
+        value = rng.uniform(40, 160)
+        leaving = values[-7] if len(values) >= 7 else None
+        window_stats.push(value, leaving)
+        values.append(value)
+        window = values[-7:]
+        assert window_stats.count == len(window)
+        assert window_stats.mean == pytest.approx(sum(window) / len(window))
+        assert window_stats.min == min(window)
+        assert window_stats.max == max(window)
+        if window_stats.needs_resync():
+            window_stats.resync(window)
+
+
+def test_hr_buffer_stats_across_wrap_around_and_clear():
+    rng = random.Random(1)
+    buffer = HrRingBuffer(HR_WINDOW_SAMPLES + 100)
+    # Kilka pełnych obiegów bufora - wartości wypadające z okien i okresowy resync sumy
+    for packet in heart_rate_packets(rng, 150):
+        buffer.add_samples(packet)
+        assert_matches_window(buffer)
+    assert buffer.total_appended > 3 * buffer.capacity
+
+    buffer.clear()
+    assert_matches_window(buffer)
+    assert buffer.stats['detection'].count == 0
+
+    for packet in heart_rate_packets(rng, 40):
+        buffer.add_samples(packet)
+        assert_matches_window(buffer)
+
+
+def test_hr_buffer_stats_rebuilt_after_writes_by_other_process():
+    namespace = f"test_stats_{os.getpid()}"
+    backend = SharedMemoryBackend(namespace, max_devices=2)
+    try:
+        # Dwa bufory na tych samych segmentach - jak w dwóch workerach na hoście
+        local = HrRingBuffer(backend=backend, device_id='D1')
+        other = HrRingBuffer(backend=backend, device_id='D1')
+        rng = random.Random(2)
+        for round_index, packet in enumerate(heart_rate_packets(rng, 120)):
+            (other if round_index % 3 else local).add_samples(packet)
+            # Znacznik statystyk nieaktualny po zapisach drugiego bufora - przeliczenie z okna
+            assert_matches_window(local)
+            assert_matches_window(other)
+
+        other.clear()
+        local.add_samples([{'heart_rate': 70}])
+        assert_matches_window(local)
+        assert local.stats['all'].count == 1
+    finally:
+        backend.unlink_all()